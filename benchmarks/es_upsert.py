@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# upsert round trips against a stand-in elasticsearch, no cluster needed
+#
+# the stand-in answers every request after --latency ms and never finds an existing document, so
+# this measures the request pattern of IndicatorManager.upsert rather than elasticsearch itself
+#
+# $ python benchmarks/es_upsert.py --count 5000 --batch 1000 --latency 2
+# $ python benchmarks/es_upsert.py --upsert-id
+
+import os
+import threading
+import time
+from argparse import ArgumentParser
+from collections import Counter
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+import ujson as json
+
+p = ArgumentParser(prog='es_upsert')
+p.add_argument('--count', type=int, default=5000)
+p.add_argument('--batch', type=int, default=1000)
+p.add_argument('--latency', type=float, default=2, help='ms the stand-in waits before answering')
+p.add_argument('--upsert-id', action='store_true', help='deterministic id upserts instead of search-then-write')
+args = p.parse_args()
+
+# these are read when the plugin is imported
+os.environ['CIF_STORE_ES_UPSERT_MODE'] = '1'
+if args.upsert_id:
+    os.environ['CIF_STORE_ES_UPSERT_ID'] = '1'
+
+from elasticsearch_dsl.connections import connections
+from cif.store.zelasticsearch.indicator import IndicatorManager
+from sqlite_upsert import _indicators
+
+TOKEN = {'username': 'bench', 'groups': ['everyone'], 'token': 'bench', 'admin': True}
+
+REQUESTS = Counter()
+LATENCY = args.latency / 1000.0
+
+
+class StandIn(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body=None):
+        time.sleep(LATENCY)
+
+        body = json.dumps(body if body is not None else {}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _body(self):
+        n = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(n).decode('utf-8') if n else ''
+
+    def _handle(self):
+        path = self.path.split('?')[0]
+        body = self._body()
+        endpoint = path.rstrip('/').split('/')[-1]
+        REQUESTS[endpoint if endpoint.startswith('_') else self.command] += 1
+
+        if endpoint == '_msearch':
+            n = len([l for l in body.splitlines() if l.strip()]) // 2
+            return self._reply({'responses': [{'hits': {'total': 0, 'hits': []}} for _ in range(n)]})
+
+        if endpoint == '_search':
+            return self._reply({'hits': {'total': 0, 'hits': []}})
+
+        if endpoint == '_bulk':
+            items = []
+            for l in body.splitlines():
+                l = json.loads(l) if l.strip() else {}
+                for op in ('index', 'create', 'update', 'delete'):
+                    if op in l:
+                        items.append({op: {'status': 201, 'result': 'created', '_id': l[op].get('_id', 'x')}})
+
+            return self._reply({'took': 1, 'errors': False, 'items': items})
+
+        # claiming the index is closed lets the mapping init push its analysis settings without a compare
+        if path.startswith('/_cluster/state'):
+            return self._reply({'metadata': {'indices': {endpoint: {'state': 'close'}}}})
+
+        if endpoint == '_nodes':
+            return self._reply({'_nodes': {'total': 1}, 'nodes': {}})
+
+        if endpoint == '_settings':
+            return self._reply({path.split('/')[1]: {'settings': {'index': {}}}})
+
+        if endpoint == '_mapping':
+            return self._reply({path.split('/')[1]: {'mappings': {}}})
+
+        self._reply({'acknowledged': True})
+
+    do_GET = do_POST = do_PUT = do_HEAD = do_DELETE = _handle
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def main():
+    server = Server(('127.0.0.1', 0), StandIn)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+
+    connections.create_connection(hosts=['127.0.0.1:{}'.format(server.server_address[1])])
+    indicators = IndicatorManager()
+
+    data = _indicators(args.count)
+    for i in data:
+        i['tags'] = i['tags'][0]
+
+    REQUESTS.clear()
+    n = 0
+    start = time.time()
+    for x in range(0, len(data), args.batch):
+        n += indicators.upsert(TOKEN, data[x:x + args.batch])
+
+    t = time.time() - start
+    batches = (len(data) + args.batch - 1) // args.batch
+
+    print('upserted {} of {} indicators in {:0.2f}s ({:0.0f}/sec)'.format(n, len(data), t, len(data) / t))
+    print('{} requests ({:0.1f}/batch): {}'.format(sum(REQUESTS.values()), sum(REQUESTS.values()) / float(batches),
+                                                  dict(REQUESTS)))
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
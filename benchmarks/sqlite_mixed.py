@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# feed pulls against the sqlite store while it's taking a steady stream of writes
+#
+# $ python benchmarks/sqlite_mixed.py --rate 1000 --readers 4 --duration 30
+# $ python benchmarks/sqlite_mixed.py --journal-mode MEMORY --readers 0
+
+import os
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+
+p = ArgumentParser(prog='sqlite_mixed')
+p.add_argument('--seed', type=int, default=50000, help='indicators to load before the clock starts')
+p.add_argument('--rate', type=int, default=1000, help='indicators/sec to write')
+p.add_argument('--batch', type=int, default=100)
+p.add_argument('--feeds', type=int, default=2, help='threads pulling feeds')
+p.add_argument('--feed-limit', type=int, default=500)
+p.add_argument('--duration', type=int, default=20)
+p.add_argument('--readers', default='4', help='read-only connection pool size')
+p.add_argument('--journal-mode', default='WAL')
+p.add_argument('--dbfile', default=None)
+args = p.parse_args()
+
+# these are read when the plugin is imported
+os.environ['CIF_STORE_SQLITE_JOURNAL_MODE'] = args.journal_mode
+os.environ['CIF_STORE_SQLITE_READERS'] = args.readers
+
+from cif.store import Store
+from sqlite_upsert import _indicators
+
+TOKEN = {'username': 'bench', 'groups': ['everyone'], 'token': 'bench'}
+
+
+def _pct(l, p):
+    if not l:
+        return 0
+    l = sorted(l)
+    return l[min(len(l) - 1, int(len(l) * p))]
+
+
+def main():
+    dbfile = args.dbfile or tempfile.mktemp()
+
+    with Store(store_type='sqlite', dbfile=dbfile) as s:
+        s._load_plugin(dbfile=dbfile)
+        indicators = s.store.indicators
+
+        for x in range(0, args.seed, 1000):
+            indicators.upsert(TOKEN, _indicators(min(1000, args.seed - x), offset=x))
+
+        stop = threading.Event()
+        written = []
+        pulls = []
+        errors = []
+
+        def writer():
+            n = args.seed
+            interval = float(args.batch) / args.rate
+            while not stop.is_set():
+                start = time.time()
+                try:
+                    written.append(indicators.upsert(TOKEN, _indicators(args.batch, offset=n)))
+                except Exception as e:
+                    errors.append(e)
+                n += args.batch
+
+                time.sleep(max(0, interval - (time.time() - start)))
+
+            s.store.handle.remove()
+
+        def feed():
+            while not stop.is_set():
+                start = time.time()
+                try:
+                    indicators.search(TOKEN, {'itype': 'fqdn', 'limit': args.feed_limit})
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                pulls.append(time.time() - start)
+
+            s.store.read_handle.remove()
+
+        threads = [threading.Thread(target=writer)] + [threading.Thread(target=feed) for _ in range(args.feeds)]
+        start = time.time()
+        for t in threads:
+            t.start()
+
+        time.sleep(args.duration)
+        stop.set()
+        for t in threads:
+            t.join()
+
+        t = time.time() - start
+
+        print('journal_mode={} readers={}'.format(args.journal_mode, args.readers))
+        print('writes: {} in {:0.1f}s ({:0.0f}/sec, target {}/sec)'.format(sum(written), t, sum(written) / t,
+                                                                          args.rate))
+        print('feed pulls: {} ({:0.2f}/sec) p50={:0.3f}s p95={:0.3f}s'.format(len(pulls), len(pulls) / t,
+                                                                             _pct(pulls, 0.5), _pct(pulls, 0.95)))
+        if errors:
+            print('errors: {} ({})'.format(len(errors), errors[0]))
+
+    if not args.dbfile:
+        for f in [dbfile, dbfile + '-wal', dbfile + '-shm']:
+            if os.path.isfile(f):
+                os.unlink(f)
+
+
+if __name__ == '__main__':
+    main()
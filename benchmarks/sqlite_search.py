@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# feed pull timings for the sqlite indicator store
+#
+# $ python benchmarks/sqlite_search.py --count 100000 --limit 50000
+
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from cif.store import Store
+from sqlite_upsert import _indicators
+
+TOKEN = {'username': 'bench', 'groups': ['everyone'], 'token': 'bench'}
+
+
+def main():
+    p = ArgumentParser(prog='sqlite_search')
+    p.add_argument('--count', type=int, default=100000, help='indicators to load')
+    p.add_argument('--limit', type=int, default=50000)
+    p.add_argument('--itype', default='fqdn')
+    p.add_argument('--runs', type=int, default=3)
+    p.add_argument('--dbfile', default=None)
+    args = p.parse_args()
+
+    dbfile = args.dbfile or tempfile.mktemp()
+
+    with Store(store_type='sqlite', dbfile=dbfile) as s:
+        s._load_plugin(dbfile=dbfile)
+
+        for x in range(0, args.count, 1000):
+            s.store.indicators.upsert(TOKEN, _indicators(min(1000, args.count - x), offset=x))
+
+        for _ in range(args.runs):
+            start = time.time()
+            rv = s.store.indicators.search(TOKEN, {'itype': args.itype, 'limit': args.limit})
+            t = time.time() - start
+            print('pulled {} {} indicators in {:0.3f}s ({:0.1f}us/row)'.format(len(rv), args.itype, t,
+                                                                           t / max(len(rv), 1) * 1000000))
+
+    if not args.dbfile:
+        for f in [dbfile, dbfile + '-wal', dbfile + '-shm']:
+            if os.path.isfile(f):
+                os.unlink(f)
+
+
+if __name__ == '__main__':
+    main()
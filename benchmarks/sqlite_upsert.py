@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# rough ingest benchmark for the sqlite indicator store
+#
+# $ python benchmarks/sqlite_upsert.py --count 100000 --batch 1000
+
+import os
+import tempfile
+import time
+import random
+from argparse import ArgumentParser
+
+import arrow
+
+from cif.store import Store
+
+TAGS = ['botnet', 'malware', 'phishing', 'scanner', 'spam']
+PROVIDERS = ['csirtg.io', 'spamhaus.org', 'dshield.org', 'example.org']
+
+
+def _indicators(count, dupes=0.1, offset=0):
+    now = arrow.utcnow()
+    rv = []
+    for n in range(offset, offset + count):
+        # re-submit a slice of what we've already seen so the update path gets exercised too
+        if n and random.random() < dupes:
+            n = random.randint(0, n - 1)
+
+        ts = now.shift(seconds=n).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        if n % 3 == 0:
+            i = '{}.{}.{}.{}'.format(10 + (n >> 24) % 200, (n >> 16) % 256, (n >> 8) % 256, n % 256)
+            itype = 'ipv4'
+        elif n % 3 == 1:
+            i = 'host{}.example{}.com'.format(n, n % 1000)
+            itype = 'fqdn'
+        else:
+            i = 'http://example{}.com/{}'.format(n % 1000, n)
+            itype = 'url'
+
+        rv.append({
+            'indicator': i,
+            'itype': itype,
+            'tags': [TAGS[n % len(TAGS)]],
+            'provider': PROVIDERS[n % len(PROVIDERS)],
+            'group': 'everyone',
+            'confidence': 7,
+            'tlp': 'amber',
+            'firsttime': ts,
+            'lasttime': ts,
+            'reporttime': ts,
+        })
+
+    return rv
+
+
+def main():
+    p = ArgumentParser(prog='sqlite_upsert')
+    p.add_argument('--count', type=int, default=100000)
+    p.add_argument('--batch', type=int, default=1000)
+    p.add_argument('--dbfile', default=None)
+    args = p.parse_args()
+
+    dbfile = args.dbfile or tempfile.mktemp()
+
+    with Store(store_type='sqlite', dbfile=dbfile) as s:
+        s._load_plugin(dbfile=dbfile)
+        token = {'username': 'bench', 'groups': ['everyone'], 'token': 'bench'}
+
+        data = _indicators(args.count)
+
+        n = 0
+        start = time.time()
+        for x in range(0, len(data), args.batch):
+            n += s.store.indicators.upsert(token, data[x:x + args.batch])
+
+        t = time.time() - start
+        print('upserted {} of {} indicators in {:0.2f}s ({:0.0f}/sec)'.format(n, len(data), t, len(data) / t))
+
+    if not args.dbfile and os.path.isfile(dbfile):
+        os.unlink(dbfile)
+
+
+if __name__ == '__main__':
+    main()
@@ -21,7 +21,7 @@ class CifStore(Auth):
     name = 'cif_store'
 
     def __init__(self, **kwargs):
-        self.token_cache = kwargs.get('token_cache', {})
+        self.token_cache = kwargs.get('token_cache')
         self.store = Store(store_type=STORE_DEFAULT, nodes=STORE_NODES)
         self.store._load_plugin(store_type=STORE_DEFAULT, 
             nodes=STORE_NODES, token_cache=self.token_cache)
@@ -30,13 +30,22 @@ HUNTER_ADDR = os.environ.get('CIF_HUNTER_ADDR', HUNTER_ADDR)
 HUNTER_SINK_ADDR = 'ipc://{}'.format(os.path.join(RUNTIME_PATH, 'hunter_sink.ipc'))
 HUNTER_SINK_ADDR = os.environ.get('CIF_HUNTER_SINK_ADDR', HUNTER_SINK_ADDR)
 
+# httpd's own requests, whitelist fetches and health checks, scheduled with the frontend's rather than the hunters'
+INTERNAL_ADDR = 'ipc://{}'.format(os.path.join(RUNTIME_PATH, 'internal.ipc'))
+INTERNAL_ADDR = os.environ.get('CIF_INTERNAL_ADDR', INTERNAL_ADDR)
+
 GATHERER_ADDR = 'ipc://{}'.format(os.path.join(RUNTIME_PATH, 'gatherer.ipc'))
 GATHERER_ADDR = os.environ.get('CIF_GATHERER_ADDR', GATHERER_ADDR)
 
 GATHERER_SINK_ADDR = 'ipc://{}'.format(os.path.join(RUNTIME_PATH, 'gatherer_sink.ipc'))
 GATHERER_SINK_ADDR = os.environ.get('CIF_GATHERER_SINK_ADDR', GATHERER_SINK_ADDR)
 
+# the itypes feeds are pulled by, each has a change marker of its own
+FEED_ITYPES = ['ipv4', 'ipv6', 'fqdn', 'url', 'email', 'md5', 'sha1', 'sha256', 'sha512', 'ssdeep']
+
 TOKEN_CACHE_DELAY = 45
+# tokens each process keeps cached
+TOKEN_CACHE_SIZE = int(os.environ.get('CIF_TOKEN_CACHE_SIZE', 10000))
 
 HUNTER_RESOLVER_TIMEOUT = os.environ.get('CIF_HUNTER_RESOLVER_TIMEOUT', 5)
 
@@ -45,5 +54,28 @@ FEEDS_WHITELIST_LIMIT = os.environ.get('CIF_FEEDS_WHITELIST_LIMIT', 25000)
 
 HTTPD_FEED_WHITELIST_CONFIDENCE = os.environ.get('CIF_HTTPD_FEED_WHITELIST_CONFIDENCE', 5)
 
+# seconds a compiled feed whitelist is served before it's rebuilt in the background
+HTTPD_FEED_WHITELIST_TTL = int(os.environ.get('CIF_HTTPD_FEED_WHITELIST_TTL', 300))
+# compiled whitelists kept per httpd worker, 0 builds one per request
+HTTPD_FEED_WHITELIST_CACHE = int(os.environ.get('CIF_HTTPD_FEED_WHITELIST_CACHE', 64))
+# seconds after a whitelist write to rebuild, single submissions wait in the store's create queue (CIF_STORE_QUEUE_FLUSH)
+HTTPD_FEED_WHITELIST_WRITE_DELAY = int(os.environ.get('CIF_HTTPD_FEED_WHITELIST_WRITE_DELAY', 5))
+
+# seconds a built feed is served (and its etag holds) when the store sees no writes
+HTTPD_FEED_CACHE_TTL = int(os.environ.get('CIF_HTTPD_FEED_CACHE_TTL', 300))
+# built feeds kept per httpd worker, 0 builds one per request
+HTTPD_FEED_CACHE = int(os.environ.get('CIF_HTTPD_FEED_CACHE', 16))
+
+# long-lived router connections per httpd worker, request threads wait on one when they're all in use
+HTTPD_ROUTER_POOL = int(os.environ.get('CIF_HTTPD_ROUTER_POOL', 8))
+
+# indicators per message /indicators/bulk forwards to the router, and how many of those wait on the store at once
+HTTPD_BULK_CHUNK = int(os.environ.get('CIF_HTTPD_BULK_CHUNK', 500))
+HTTPD_BULK_INFLIGHT = int(os.environ.get('CIF_HTTPD_BULK_INFLIGHT', 4))
+
+# indicators one /search/batch request can look up, and results kept per indicator unless it sets a limit
+HTTPD_SEARCH_BATCH_MAX = int(os.environ.get('CIF_HTTPD_SEARCH_BATCH_MAX', 1000))
+SEARCH_BATCH_LIMIT = int(os.environ.get('CIF_SEARCH_BATCH_LIMIT', 25))
+
 AUTH_ADDR = 'ipc://{}'.format(os.path.join(RUNTIME_PATH, 'auth.ipc'))
 AUTH_ENABLED = os.environ.get('CIF_AUTH_REQUIRED', True)
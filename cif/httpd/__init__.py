@@ -20,12 +20,14 @@ from cifsdk.utils import get_argument_parser, setup_logging, setup_signals, setu
 import zlib
 import time
 import uuid
-from .common import pull_token
+from .common import pull_token, response_compress, compress
 from .views.ping import PingAPI
 from .views.help import HelpAPI
 from .views.health import HealthAPI
 from .views.tokens import TokensAPI
 from .views.indicators import IndicatorsAPI
+from .views.bulk import BulkAPI
+from .views.search_batch import SearchBatchAPI
 from .views.feed import FeedAPI
 from .views.confidence import ConfidenceAPI
 from .views.u.indicators import IndicatorsUI, DataTables
@@ -124,7 +126,9 @@ app.add_url_rule('/health', view_func=HealthAPI.as_view('health'))
 app.add_url_rule('/ping', view_func=PingAPI.as_view('ping'))
 app.add_url_rule('/tokens', view_func=TokensAPI.as_view('tokens'))
 app.add_url_rule('/indicators', view_func=IndicatorsAPI.as_view('indicators'))
+app.add_url_rule('/indicators/bulk', view_func=BulkAPI.as_view('bulk'))
 app.add_url_rule('/search', view_func=IndicatorsAPI.as_view('search'))
+app.add_url_rule('/search/batch', view_func=SearchBatchAPI.as_view('search_batch'))
 app.add_url_rule('/feed', view_func=FeedAPI.as_view('feed'))
 app.add_url_rule('/help/confidence', view_func=ConfidenceAPI.as_view('confidence'))
 
@@ -138,6 +142,10 @@ def decompress():
     if '/u/' in request.path:
         return
 
+    # bulk submissions are inflated a line at a time as they're read
+    if request.path == '/indicators/bulk':
+        return
+
     if request.headers.get('Content-Encoding') and request.headers['Content-Encoding'] == 'deflate':
         logger.debug('decompressing request: %d' % len(request.data))
         request.data = zlib.decompress(request.data)
@@ -150,10 +158,17 @@ def process_response(response):
     if '/u/' in request.path or not hasattr(g, 'request_start_time'):
         return response
 
-    if request.headers.get('Accept-Encoding') == 'deflate':
+    # cached feeds and streams come back already compressed, a 304 has no body to compress
+    if response.headers.get('Content-Encoding') or response.is_streamed or response.status_code == 304:
+        ctype = None
+    else:
+        ctype = response_compress()
+        response.vary.add('Accept-Encoding')
+
+    if ctype:
         logger.debug('compressing resp: %d' % len(response.data))
-        response.data = zlib.compress(response.data)
-        response.headers['Content-Encoding'] = 'deflate'
+        response.data = compress(response.data, ctype)
+        response.headers['Content-Encoding'] = ctype
 
         size = len(response.data)
         response.headers['Content-Length'] = size
@@ -232,7 +247,7 @@ def login():
         return render_template('login.html')
 
     if request.method == 'POST':
-        from cifsdk.client.zeromq import ZMQ as Client
+        from cif.utils.client_pool import PooledClient as Client
         if request.form['token'] == '':
             return render_template('login.html')
 
@@ -1,15 +1,29 @@
-from flask import request, jsonify
+from flask import request, jsonify, Response
+import itertools
 import re
 import zlib
 import gzip
+import ujson as json
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 VALID_FILTERS = {
     'indicator', 'itype', 'confidence', 'provider', 'limit', 'application', 'nolog', 'tags', 'days',
     'hours', 'groups', 'reporttime', 'cc', 'asn', 'asn_desc', 'rdata', 'firsttime', 'lasttime', 'region', 'id',
-    'portlist', 'protocol', 'tlp', 'sort',
+    'portlist', 'protocol', 'tlp', 'sort', 'dedup',
 }
 TOKEN_FILTERS = ['username', 'token']
 
+NDJSON = 'application/x-ndjson'
+
+# in order of preference when a client rates them the same, zstd only if the zstandard library is installed
+COMPRESS_TYPES = ['gzip', 'deflate']
+if zstandard:
+    COMPRESS_TYPES.insert(0, 'zstd')
+
 
 def pull_token():
     t = None
@@ -26,6 +40,12 @@ def request_v2():
             return True
 
 
+def request_ndjson():
+    if request.headers.get('Accept'):
+        if NDJSON in request.headers['Accept']:
+            return True
+
+
 def jsonify_unauth(msg='unauthorized'):
     response = jsonify({
         "message": msg,
@@ -63,24 +83,26 @@ def jsonify_success(data=[], code=200):
 
 
 def response_compress():
+    """
+    the encoding to send the response in, negotiated from Accept-Encoding (q-values and all)
+    :return: one of COMPRESS_TYPES, or None to send it as is
+    """
     if request.args.get('nocompress'):
-        return False
+        return
 
     if request.args.get('gzip'):
         return 'gzip'
 
-    if request.headers.get('Accept-Encoding'):
-        if request.headers['Accept-Encoding'] == 'gzip':
-            return 'gzip'
-
-        if request.headers['Accept-Encoding'] == 'deflate':
-            return 'deflate'
+    return request.accept_encodings.best_match(COMPRESS_TYPES)
 
 
 def compress(data, ctype='deflate'):
     if ctype == 'deflate':
         return zlib.compress(data)
 
+    if ctype == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+
     return gzip.compress(data)
 
 
@@ -101,3 +123,94 @@ def aggregate(data, field='indicator', sort='confidence', sort_secondary='report
 
     rv = sorted(rv, key=lambda x: x[sort_secondary], reverse=True)
     return rv
+
+
+def stream_primed(it):
+    """
+    pulls the first item before any of the response goes out, so a failed search can still get its status code
+    :param it: iterable
+    :return: iterator over the same items
+    """
+    it = iter(it)
+    try:
+        first = next(it)
+    except StopIteration:
+        return iter([])
+
+    return itertools.chain([first], it)
+
+
+def stream_json(pages, meta=None):
+    """
+    the {"message": "success", "data": [...]} envelope, encoded a page at a time
+    :param pages: iterable of lists of dicts
+    :param meta: fn() -> dict of keys that follow data, called once the pages run out
+    """
+    yield '{"message":"success","data":['
+
+    sep = ''
+    for page in pages:
+        if not page:
+            continue
+
+        yield sep + ','.join(json.dumps(i) for i in page)
+        sep = ','
+
+    yield ']'
+
+    if meta:
+        for k, v in meta().items():
+            yield ',{}:{}'.format(json.dumps(k), json.dumps(v))
+
+    yield '}'
+
+
+def stream_ndjson(pages, meta=None):
+    """
+    one json document per line, then a last line with message and the meta keys if there are any
+    :param pages: iterable of lists of dicts
+    :param meta: fn() -> dict, called once the pages run out
+    """
+    for page in pages:
+        if page:
+            yield ''.join(json.dumps(i) + '\n' for i in page)
+
+    if meta:
+        m = meta()
+        m['message'] = 'success'
+        yield json.dumps(m) + '\n'
+
+
+def stream_compress(chunks, ctype='deflate'):
+    if ctype == 'zstd':
+        z = zstandard.ZstdCompressor().compressobj()
+    elif ctype == 'gzip':
+        z = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    else:
+        z = zlib.compressobj()
+
+    for c in chunks:
+        if not isinstance(c, bytes):
+            c = c.encode('utf-8')
+
+        c = z.compress(c)
+        if c:
+            yield c
+
+    yield z.flush()
+
+
+def stream_response(chunks, mimetype='application/json'):
+    """
+    a streamed response, compressed as it goes in whatever encoding the client takes
+    :param chunks: iterable of str
+    :return: flask.Response
+    """
+    headers = {'Vary': 'Accept-Encoding'}
+
+    ctype = response_compress()
+    if ctype:
+        chunks = stream_compress(chunks, ctype)
+        headers['Content-Encoding'] = ctype
+
+    return Response(chunks, mimetype=mimetype, headers=headers)
@@ -0,0 +1,213 @@
+from collections import deque
+import logging
+import zlib
+
+from flask import request, current_app, jsonify
+from flask.views import MethodView
+import ujson as json
+from cifsdk.exceptions import AuthError
+from cifsdk.msg import Msg
+
+from cif.constants import ROUTER_ADDR, HTTPD_BULK_CHUNK, HTTPD_BULK_INFLIGHT
+from cif.utils.client_pool import PooledClient as Client
+from ..common import pull_token, jsonify_unauth, jsonify_unknown, jsonify_success
+from .indicators import _whitelist_itypes
+from .feed import whitelist_cache
+
+logger = logging.getLogger('cif-httpd')
+
+READ_SIZE = 65536
+
+# per chunk, the rest of a chunk's rejected lines are only counted
+ERRORS_MAX = 10
+
+
+def _lines(stream, encoding=None):
+    """
+    the request body a line at a time, inflated as it's read if it was sent compressed
+    :param stream: file-like request body
+    :param encoding: Content-Encoding, gzip or deflate
+    """
+    z = None
+    if encoding == 'gzip':
+        z = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    elif encoding == 'deflate':
+        z = zlib.decompressobj()
+
+    buf = b''
+    while True:
+        block = stream.read(READ_SIZE)
+        if not block:
+            break
+
+        if z:
+            block = z.decompress(block)
+
+        lines = (buf + block).split(b'\n')
+        buf = lines.pop()
+        for l in lines:
+            yield l
+
+    if z:
+        buf += z.flush()
+
+    for l in buf.split(b'\n'):
+        yield l
+
+
+def _parse(line):
+    try:
+        i = json.loads(line)
+    except ValueError:
+        return None, 'invalid json'
+
+    if not isinstance(i, dict):
+        return None, 'not an indicator object'
+
+    if not i.get('indicator'):
+        return None, 'missing required "indicator" field'
+
+    return i, None
+
+
+def _chunk(n, line):
+    return {'chunk': n, 'lines': [line, line], 'submitted': 0, 'stored': None, 'rejected': 0, 'errors': []}
+
+
+class BulkAPI(MethodView):
+    """
+    NDJSON submissions (one indicator per line, optionally gzip or deflate encoded) of any size
+
+    lines are checked as they're read and forwarded to the router HTTPD_BULK_CHUNK at a time, with at most
+    HTTPD_BULK_INFLIGHT chunks waiting on the store, so httpd never holds more than that much of the body
+    """
+    def post(self):
+        remote = current_app.config.get('CIF_ROUTER_ADDR', ROUTER_ADDR)
+        cli = Client(remote, pull_token())
+
+        inflight = deque()
+        chunks = []
+        itypes = set()
+        summary = None
+        batch = []
+
+        def _send(batch, summary):
+            if current_app.config.get('dummy'):
+                summary['stored'] = len(batch)
+                return True
+
+            try:
+                s = cli.pool.get()
+            except Exception as e:
+                logger.error(e)
+                summary['error'] = str(e)
+                return False
+
+            try:
+                cli._request(s, Msg.INDICATORS_CREATE, json.dumps(batch))
+            except Exception as e:
+                logger.error(e)
+                s.close()
+                cli.pool.put(s)
+                summary['error'] = str(e)
+                return False
+
+            inflight.append((s, summary))
+            return True
+
+        def _wait():
+            s, summary = inflight.popleft()
+            try:
+                summary['stored'] = cli._check(json.loads(cli._reply(s))).get('data')
+
+            except AuthError:
+                raise
+
+            except Exception as e:
+                logger.error(e)
+                s.close()
+                summary['error'] = str(e)
+
+            finally:
+                cli.pool.put(s)
+
+        try:
+            for n, line in enumerate(_lines(request.stream, request.headers.get('Content-Encoding')), 1):
+                line = line.strip()
+                if not line:
+                    continue
+
+                if summary is None:
+                    summary = _chunk(len(chunks) + 1, n)
+                    chunks.append(summary)
+
+                summary['lines'][1] = n
+
+                i, err = _parse(line)
+                if err:
+                    summary['rejected'] += 1
+                    if len(summary['errors']) < ERRORS_MAX:
+                        summary['errors'].append({'line': n, 'error': err})
+                    continue
+
+                batch.append(i)
+                if len(batch) < HTTPD_BULK_CHUNK:
+                    continue
+
+                if itypes is not None:
+                    x = _whitelist_itypes(batch)
+                    itypes = None if x is None else itypes | x
+
+                while len(inflight) >= min(HTTPD_BULK_INFLIGHT, cli.pool.size):
+                    _wait()
+
+                summary['submitted'] = len(batch)
+                sent = _send(batch, summary)
+                batch = []
+                summary = None
+
+                # the router can't be reached, stop here and report what made it in so far
+                if not sent:
+                    break
+
+            if batch:
+                if itypes is not None:
+                    x = _whitelist_itypes(batch)
+                    itypes = None if x is None else itypes | x
+
+                summary['submitted'] = len(batch)
+                _send(batch, summary)
+
+            while inflight:
+                _wait()
+
+        except AuthError:
+            return jsonify_unauth()
+
+        except zlib.error as e:
+            logger.error(e)
+            return jsonify_unknown('submission failed: unable to decompress the request body', 400)
+
+        finally:
+            # anything still waiting has a reply on the way, so none of these go back to the pool
+            while inflight:
+                s, _ = inflight.popleft()
+                s.close()
+                cli.pool.put(s)
+
+        if itypes is None or itypes:
+            whitelist_cache.invalidate(itypes)
+
+        rv = {
+            'accepted': sum(c['submitted'] for c in chunks),
+            'rejected': sum(c['rejected'] for c in chunks),
+            'stored': sum(c['stored'] or 0 for c in chunks),
+            'chunks': chunks,
+        }
+
+        if not rv['accepted']:
+            response = jsonify({'message': 'submission failed: no valid indicators', 'data': rv})
+            response.status_code = 422
+            return response
+
+        return jsonify_success(rv, code=201)
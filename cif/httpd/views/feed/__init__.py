@@ -1,12 +1,14 @@
 from ...common import pull_token, jsonify_success, jsonify_unauth, jsonify_unknown, \
-    aggregate, VALID_FILTERS
+    aggregate, VALID_FILTERS, NDJSON, request_ndjson, response_compress, stream_primed, stream_json, stream_ndjson, \
+    stream_response
 from flask.views import MethodView
 from flask import request, current_app, g, make_response
-from cifsdk.client.zeromq import ZMQ as Client
+from cif.utils.client_pool import PooledClient as Client
 from cifsdk.client.dummy import Dummy as DummyClient
-from cif.constants import ROUTER_ADDR, HUNTER_SINK_ADDR, FEEDS_LIMIT, FEEDS_WHITELIST_LIMIT, \
+from cif.constants import ROUTER_ADDR, INTERNAL_ADDR, FEEDS_LIMIT, FEEDS_WHITELIST_LIMIT, \
     HTTPD_FEED_WHITELIST_CONFIDENCE
 from cif.utils import strtobool
+from cif.utils.search_client import SearchClient
 from cifsdk.exceptions import InvalidSearch, AuthError
 import logging
 import copy
@@ -24,6 +26,9 @@ from .sha1 import Sha1
 from .sha256 import Sha256
 from .sha512 import Sha512
 from .ssdeep import Ssdeep
+from .whitelist import WhitelistCache
+from .cache import FeedCache
+from . import cursor
 
 TRACE = strtobool(os.getenv('CIF_HTTPD_TRACE', False))
 
@@ -83,7 +88,30 @@ logger.setLevel(log_level)
 logger.addHandler(console)
 
 remote = ROUTER_ADDR
-internal_remote = HUNTER_SINK_ADDR
+internal_remote = INTERNAL_ADDR
+
+
+def _whitelist_fetch(token, filters):
+    return aggregate(Client(internal_remote, token).indicators_search(filters), dedup_only=True)
+
+
+def _whitelist_compile(itype, whitelist):
+    return feed_factory(itype)().whitelist(whitelist)
+
+
+# feed pulls only pay for the filter pass, not the whitelist fetch and build
+whitelist_cache = WhitelistCache(_whitelist_fetch, _whitelist_compile)
+
+# repeat polls for the same feed are served from memory until the store sees a write
+feed_cache = FeedCache()
+
+
+class FeedError(Exception):
+    def __init__(self, msg='failed', code=503):
+        super(FeedError, self).__init__(msg)
+        self.msg = msg
+        self.code = code
+
 
 class FeedAPI(MethodView):
     def get(self):
@@ -119,6 +147,18 @@ class FeedAPI(MethodView):
             err = "invalid feed itype: {}, valid types are [{}]".format(filters['itype'], '|'.join(FEED_PLUGINS))
             return jsonify_unknown(err, 400)
 
+        # a delta pull, only what's been added or updated since a previous pull's cursor
+        since = None
+        if request.args.get('since'):
+            try:
+                since = cursor.decode(request.args['since'])
+            except ValueError as e:
+                return jsonify_unknown('invalid since cursor', 400)
+
+            filters.pop('days', None)
+            filters.pop('hours', None)
+            filters['reporttime'] = since[0]
+
         if not filters.get('reporttime'):
             if not filters.get('days'):
                 if not filters.get('itype'):
@@ -132,36 +172,117 @@ class FeedAPI(MethodView):
         # for feed pulls we want values sorted first by conf DESC and second by reporttime DESC
         filters['sort'] = '-confidence,-reporttime'
 
-        if current_app.config.get('dummy'):
-            if current_app.config.get('feed'):
-                r = DummyClient(remote, pull_token()).indicators_search(filters,
-                                                                        decode=True,
-                                                                        test_data=current_app.config['feed']['data'],
-                                                                        test_wl=current_app.config['feed']['wl'])
-            else:
-                r = DummyClient(remote, pull_token()).indicators_search(filters)
-                return jsonify_success(r)
+        # deltas go oldest first, if the limit cuts one short the next pull picks up from its cursor
+        if since:
+            filters['sort'] = 'reporttime,indicator'
 
-        else:
-            logger.debug('%s building feed' % id)
-            logger.debug('%s getting dataset' % id)
+        # one row per indicator from the store, limit then means unique indicators
+        filters['dedup'] = True
+
+        if current_app.config.get('dummy') and not current_app.config.get('feed'):
+            r = DummyClient(remote, pull_token()).indicators_search(filters)
+            return jsonify_success(r)
+
+        token = pull_token()
+        ndjson = request_ndjson()
+
+        # ndjson is always streamed, never built whole for the cache
+        changes = None
+        if not current_app.config.get('dummy') and feed_cache.size and not ndjson:
             try:
-                r = Client(remote, pull_token()).indicators_search(filters)
+                changes = SearchClient(remote, token).changes(filters.get('itype'), filters.get('groups'))
+
             except AuthError:
                 return jsonify_unauth()
 
-            except RuntimeError as e:
-                return jsonify_unknown('search failed', 403)
-
-            except InvalidSearch as e:
-                logger.error(e)
-                return jsonify_unknown('invalid search', 400)
-
             except Exception as e:
+                # no change marker, stream it uncached
                 logger.error(e)
-                return jsonify_unknown(msg='search failed')
 
-        r = aggregate(r, dedup_only=True)
+        try:
+            if not changes:
+                pages, meta = self._feed(filters, token, since)
+
+            else:
+                key = feed_cache.key(dict(filters, since=request.args.get('since', ''), acl=changes.get('acl'),
+                                          admin=changes.get('admin')), changes['groups'])
+                etag = feed_cache.etag(key, changes['changes'])
+
+                if request.if_none_match.contains_weak(etag):
+                    logger.debug('%s not modified' % id)
+                    response = make_response('', 304)
+                    response.set_etag(etag, weak=True)
+                    return response
+
+                body = feed_cache.get(key, etag, lambda: ''.join(stream_json(*self._feed(filters, token, since))))
+
+        except AuthError:
+            return jsonify_unauth()
+
+        except FeedError as e:
+            return jsonify_unknown(e.msg, e.code)
+
+        if not changes:
+            logger.debug('%s streaming: %s' % (id, str((time.time() - start))))
+            if ndjson:
+                return stream_response(stream_ndjson(pages, meta), mimetype=NDJSON)
+
+            return stream_response(stream_json(pages, meta))
+
+        logger.debug('%s done: %s' % (id, str((time.time() - start))))
+
+        # hot feeds are compressed once per encoding, process_response leaves them alone
+        ctype = response_compress()
+        if ctype:
+            response = make_response(body.compressed(ctype))
+            response.headers['Content-Encoding'] = ctype
+        else:
+            response = make_response(body.data)
+
+        response.vary.add('Accept-Encoding')
+
+        response.headers['Content-Type'] = 'application/json'
+        response.status_code = 200
+        response.set_etag(etag, weak=True)
+
+        return response
+
+    def _search_pages(self, filters, token):
+        if current_app.config.get('dummy'):
+            yield DummyClient(remote, token).indicators_search(filters,
+                                                              decode=True,
+                                                              test_data=current_app.config['feed']['data'],
+                                                              test_wl=current_app.config['feed']['wl'])
+            return
+
+        try:
+            for page in SearchClient(remote, token).indicators_search_pages(filters):
+                yield page
+
+        except AuthError:
+            raise
+
+        except RuntimeError as e:
+            raise FeedError('search failed', 403)
+
+        except InvalidSearch as e:
+            logger.error(e)
+            raise FeedError('invalid search', 400)
+
+        except Exception as e:
+            logger.error(e)
+            raise FeedError('search failed')
+
+    def _feed(self, filters, token, since=None):
+        """
+        the feed as whitelist filtered pages, read from the store a page at a time as they're consumed
+
+        the whitelist, the removals and the first page are all fetched before this returns, so a failure
+        there is still a FeedError rather than a truncated stream
+
+        :return: (pages, meta), meta is fn() -> the cursor and removals, good once pages runs out
+        """
+        id = g.sid
 
         wl_filters = copy.deepcopy(filters)
 
@@ -186,30 +307,65 @@ class FeedAPI(MethodView):
         logger.debug('gathering whitelist..')
         if current_app.config.get('feed') and current_app.config.get('feed').get('wl'):
             wl = current_app.config.get('feed').get('wl')
+            wl = _whitelist_compile(filters['itype'], aggregate(wl, dedup_only=True))
         else:
             try:
-                wl = Client(internal_remote, pull_token()).indicators_search(wl_filters)
+                wl = whitelist_cache.get(filters['itype'], token, wl_filters)
             except Exception as e:
                 logger.error(e)
-                return jsonify_unknown('feed query failed', 503)
+                raise FeedError('feed query failed', 503)
 
-        logger.debug('%s aggregating' % id)
-        wl = aggregate(wl, dedup_only=True)
+        # whitelist entries made since the cursor, anything they cover should come out of the consumer's copy
+        removed = None
+        if since:
+            try:
+                removed = self._whitelisted_since(filters['itype'], token, wl_filters, since)
+            except Exception as e:
+                logger.error(e)
+                raise FeedError('feed query failed', 503)
 
-        f = feed_factory(filters['itype'])
+        f = feed_factory(filters['itype'])()
+        state = {'cursor': since}
 
-        logger.debug('%s merging' % id)
-        r = f().process(r, wl)
+        def _pages(pages):
+            seen = set()
+            for page in pages:
+                rv = []
+                for i in page:
+                    if i['indicator'] in seen:
+                        continue
 
-        logger.debug('%s done: %s' % (id, str((time.time() - start))))
-        # manually make flask Response obj rather than use jsonify
-        # to take advantage of ujson speed for large str
-        response = make_response(json.dumps({
-            "message": "success",
-            "data": r
-        }))
+                    seen.add(i['indicator'])
+                    rv.append(i)
 
-        response.headers['Content-Type'] = 'application/json'
-        response.status_code = 200
+                # the store's reporttime bound is inclusive, drop what the last pull already had
+                if since:
+                    rv = [i for i in rv if cursor.key(i) > since]
 
-        return response
+                # whitelisted indicators still move the cursor on
+                hw = cursor.high_water(rv)
+                if hw and (not state['cursor'] or hw > state['cursor']):
+                    state['cursor'] = hw
+
+                yield f.filter(rv, wl)
+
+        def _meta():
+            rv = {'cursor': cursor.encode(state['cursor'])}
+            if removed is not None:
+                rv['removed'] = removed
+
+            return rv
+
+        logger.debug('%s getting dataset' % id)
+        return _pages(stream_primed(self._search_pages(filters, token))), _meta
+
+    def _whitelisted_since(self, itype, token, wl_filters, since):
+        if current_app.config.get('feed') and current_app.config.get('feed').get('wl'):
+            wl = current_app.config.get('feed').get('wl')
+        else:
+            wl_filters = dict(wl_filters)
+            wl_filters.pop('days', None)
+            wl_filters['reporttime'] = since[0]
+            wl = _whitelist_fetch(token, wl_filters)
+
+        return sorted(set(i['indicator'] for i in wl if i.get('reporttime') and cursor.key(i)[0] >= since[0]))
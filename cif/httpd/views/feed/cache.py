@@ -0,0 +1,105 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import ujson as json
+
+from cif.constants import HTTPD_FEED_CACHE_TTL, HTTPD_FEED_CACHE
+from cif.httpd.common import compress
+
+logger = logging.getLogger('gunicorn.error')
+
+
+class FeedBody(object):
+    """
+    a built feed response body, plus a compressed copy per encoding once a client has asked for it
+    """
+    def __init__(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+
+        self.data = data
+        self.encoded = {}
+
+    def compressed(self, ctype):
+        # two requests racing on a new encoding both compress it, the body never changes so either copy will do
+        if ctype not in self.encoded:
+            self.encoded[ctype] = compress(self.data, ctype)
+
+        return self.encoded[ctype]
+
+
+class FeedCache(object):
+    """
+    built feed bodies, keyed by the normalized feed filters and the groups the token resolves to
+
+    an entry is only good for the etag it was built under. the etag covers the store's change marker, so any
+    indicator write retires every entry, and a ttl bucket, so day-window feeds still age out with no writes.
+    concurrent misses on the same key wait on the one build rather than each running the feed query
+
+    :param ttl: seconds a built feed is served for without any writes
+    :param size: feeds to hold, 0 turns the cache off
+    """
+    def __init__(self, ttl=HTTPD_FEED_CACHE_TTL, size=HTTPD_FEED_CACHE):
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def key(self, filters, groups):
+        return json.dumps([sorted((k, str(v)) for k, v in filters.items()), sorted(groups or [])])
+
+    def etag(self, key, changes):
+        bucket = int(time.time() // self.ttl) if self.ttl else 0
+        return hashlib.sha1('{}|{}|{}'.format(key, changes, bucket).encode('utf-8')).hexdigest()
+
+    def get(self, key, etag, build):
+        """
+        :param key: FeedCache.key()
+        :param etag: FeedCache.etag() for this key as of now
+        :param build: fn() -> feed body (str), called on a miss
+        :return: FeedBody
+        """
+        if not self.size:
+            return FeedBody(build())
+
+        with self.lock:
+            e = self.entries.get(key)
+            if e and e['etag'] == etag:
+                self.entries[key] = self.entries.pop(key)
+                return e['body']
+
+            f = self.inflight.get((key, etag))
+            leader = f is None
+            if leader:
+                f = self.inflight[(key, etag)] = Future()
+
+        if not leader:
+            return f.result()
+
+        try:
+            body = FeedBody(build())
+
+        except BaseException as e:
+            f.set_exception(e)
+            raise
+
+        else:
+            f.set_result(body)
+
+        finally:
+            with self.lock:
+                self.inflight.pop((key, etag), None)
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = {'etag': etag, 'body': body}
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+        return body
@@ -0,0 +1,55 @@
+import arrow
+import ujson as json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def _reporttime(ts):
+    return arrow.get(ts).to('utc').strftime(TIMESTAMP_FORMAT)
+
+
+def key(i):
+    """
+    where an indicator sits in delta order, reporttime then indicator to break ties
+    :param i: indicator dict
+    :return: (reporttime, indicator)
+    """
+    return _reporttime(i['reporttime']), i['indicator']
+
+
+def high_water(data, since=None):
+    """
+    the furthest point in delta order a feed has reached
+    :param data: list of indicator dicts
+    :param since: cursor the feed started from, if any
+    :return: (reporttime, indicator) or since if the feed is empty
+    """
+    data = [i for i in data if i.get('reporttime')]
+    if not data:
+        return since
+
+    # store timestamps are all the same iso format, so the raw strings order the same as the times
+    i = max(data, key=lambda x: (x['reporttime'], x['indicator']))
+    return key(i)
+
+
+def encode(cursor):
+    if not cursor:
+        return
+
+    return urlsafe_b64encode(json.dumps(list(cursor)).encode('utf-8')).decode('utf-8').rstrip('=')
+
+
+def decode(cursor):
+    """
+    :param cursor: str from encode()
+    :return: (reporttime, indicator)
+    :raises ValueError: not a cursor
+    """
+    try:
+        rt, indicator = json.loads(urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)).decode('utf-8'))
+        return _reporttime(rt), indicator
+
+    except Exception:
+        raise ValueError('invalid cursor: {}'.format(cursor))
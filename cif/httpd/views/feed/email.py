@@ -1,29 +1,25 @@
+from .fqdn import SuffixSet
+
 PERM_WHITELIST = []
 
 
 class Email(object):
 
     def __init__(self):
-        self.wl = set()
-        for w in PERM_WHITELIST:
-            self.wl.add(w)
+        pass
 
     def match_whitelist(self, wl, d):
-        bits = d.split('.')
-
-        for i, b in enumerate(bits):
-            if '.'.join(bits) in wl:
-                return True
-            bits.pop(0)
-
-    # https://github.com/jsommers/pytricia
-    def process(self, data, whitelist):
+        return d in wl
 
-        wl = self.wl
+    def whitelist(self, whitelist):
+        wl = SuffixSet(PERM_WHITELIST)
 
         for w in whitelist:
             wl.add(w['indicator'])
 
+        return wl
+
+    def filter(self, data, wl):
         rv = []
         for x in data:
             if not self.match_whitelist(wl, x['indicator']):
@@ -31,5 +27,5 @@ class Email(object):
 
         return rv
 
-
-
+    def process(self, data, whitelist):
+        return self.filter(data, self.whitelist(whitelist))
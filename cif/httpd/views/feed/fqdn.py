@@ -19,30 +19,41 @@ PERM_WHITELIST = [
 ]
 
 
+class SuffixSet(set):
+    """
+    whitelisted names, matched on the name or any parent of it
+    probing at each label boundary of the name beats splitting and re-joining it per lookup
+    """
+    def __contains__(self, d):
+        if set.__contains__(self, d):
+            return True
+
+        i = d.find('.')
+        while i != -1:
+            if set.__contains__(self, d[i + 1:]):
+                return True
+            i = d.find('.', i + 1)
+
+        return False
+
+
 class Fqdn(object):
 
     def __init__(self):
-        self.wl = set()
-        for w in PERM_WHITELIST:
-            self.wl.add(w)
+        pass
 
     def match_whitelist(self, wl, d):
-        bits = d.split('.')
-        bits2 = list(bits)
+        return d in wl
 
-        for i, b in enumerate(bits2):
-            if '.'.join(bits) in wl:
-                return True
-            bits.pop(0)
-
-    # https://github.com/jsommers/pytricia
-    def process(self, data, whitelist):
-
-        wl = self.wl
+    def whitelist(self, whitelist):
+        wl = SuffixSet(PERM_WHITELIST)
 
         for w in whitelist:
             wl.add(w['indicator'])
 
+        return wl
+
+    def filter(self, data, wl):
         rv = []
         for x in data:
             if not self.match_whitelist(wl, x['indicator']):
@@ -50,5 +61,5 @@ class Fqdn(object):
 
         return rv
 
-
-
+    def process(self, data, whitelist):
+        return self.filter(data, self.whitelist(whitelist))
@@ -33,7 +33,7 @@ class Ipv4(object):
         pass
 
     # https://github.com/jsommers/pytricia
-    def process(self, data, whitelist=[]):
+    def whitelist(self, whitelist):
         wl = pytricia.PyTricia()
         for x in PERM_WHITELIST:
             wl[x] = True
@@ -44,6 +44,9 @@ class Ipv4(object):
                 y = '{}/32'.format(y)
             wl[y] = True
 
+        return wl
+
+    def filter(self, data, wl):
         # this could be done with generators...
         rv = []
 
@@ -54,6 +57,5 @@ class Ipv4(object):
 
         return rv
 
-
-
-
+    def process(self, data, whitelist=[]):
+        return self.filter(data, self.whitelist(whitelist))
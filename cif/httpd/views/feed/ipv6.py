@@ -16,13 +16,16 @@ class Ipv6(object):
         self.logger = logging.getLogger(__name__)
         pass
 
-    def process(self, data, whitelist=[]):
+    def whitelist(self, whitelist):
         wl = pytricia.PyTricia(128)
 
         [wl.insert(x, True) for x in PERM_WHITELIST]
 
         [wl.insert(str(y['indicator']), True) for y in whitelist]
 
+        return wl
+
+    def filter(self, data, wl):
         rv = []
         for y in data:
             if str(y['indicator']) not in wl:
@@ -30,6 +33,5 @@ class Ipv6(object):
 
         return rv
 
-
-
-
+    def process(self, data, whitelist=[]):
+        return self.filter(data, self.whitelist(whitelist))
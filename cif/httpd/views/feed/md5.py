@@ -3,11 +3,14 @@ class Md5(object):
     def __init__(self):
         pass
 
-    def process(self, data, whitelist):
+    def whitelist(self, whitelist):
         wl = set()
         for x in whitelist:
             wl.add(x['indicator'])
 
+        return wl
+
+    def filter(self, data, wl):
         rv = []
         for x in data:
             if x['indicator'] not in wl:
@@ -15,5 +18,5 @@ class Md5(object):
 
         return rv
 
-
-
+    def process(self, data, whitelist):
+        return self.filter(data, self.whitelist(whitelist))
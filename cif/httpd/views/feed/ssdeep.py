@@ -3,14 +3,20 @@ class Ssdeep(object):
     def __init__(self):
         pass
 
-    def process(self, data, allowlist):
+    def whitelist(self, allowlist):
         allowed = set()
         for x in allowlist:
             allowed.add(x['indicator'])
 
+        return allowed
+
+    def filter(self, data, allowed):
         rv = []
         for x in data:
             if x['indicator'] not in allowed:
                 rv.append(x)
 
         return rv
+
+    def process(self, data, allowlist):
+        return self.filter(data, self.whitelist(allowlist))
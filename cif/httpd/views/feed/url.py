@@ -1,13 +1,59 @@
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+
+def _split(u):
+    if '://' not in u:
+        u = 'http://{}'.format(u)
+
+    try:
+        return urlsplit(u)
+    except ValueError:
+        return
+
+
+class UrlIndex(object):
+    """
+    whitelisted urls, plus the hosts of any that are just a host (http://example.com/) which cover
+    every url on that host
+    """
+    def __init__(self):
+        self.urls = set()
+        self.hosts = set()
+
+    def add(self, u):
+        self.urls.add(u)
+
+        u = _split(u)
+        if u and u.hostname and u.path in ('', '/') and not u.query and not u.fragment:
+            self.hosts.add(u.hostname)
+
+    def __contains__(self, u):
+        if u in self.urls:
+            return True
+
+        if not self.hosts:
+            return False
+
+        u = _split(u)
+        return bool(u) and u.hostname in self.hosts
+
+
 class Url(object):
 
     def __init__(self):
         pass
 
-    def process(self, data, whitelist):
-        wl = set()
+    def whitelist(self, whitelist):
+        wl = UrlIndex()
         for x in whitelist:
             wl.add(x['indicator'])
 
+        return wl
+
+    def filter(self, data, wl):
         rv = []
         for x in data:
             if x['indicator'] not in wl:
@@ -15,5 +61,5 @@ class Url(object):
 
         return rv
 
-
-
+    def process(self, data, whitelist):
+        return self.filter(data, self.whitelist(whitelist))
@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from cif.constants import HTTPD_FEED_WHITELIST_TTL, HTTPD_FEED_WHITELIST_CACHE, HTTPD_FEED_WHITELIST_WRITE_DELAY
+
+logger = logging.getLogger('gunicorn.error')
+
+
+class WhitelistCache(object):
+    """
+    compiled whitelist matchers, keyed by itype and the whitelist filters (groups included)
+
+    whitelists are fetched over the router's internal address, under the hunter token whoever's asking, so every
+    token shares the one entry and the caller's token only goes along with the fetch. a miss is fetched and built
+    inline, an entry past its ttl (or one a whitelist write has invalidated) is still served while it's rebuilt in
+    the background
+
+    :param fetch: fn(token, filters) -> whitelist indicators
+    :param compile: fn(itype, whitelist) -> matcher
+    """
+    def __init__(self, fetch, compile, ttl=HTTPD_FEED_WHITELIST_TTL, size=HTTPD_FEED_WHITELIST_CACHE):
+        self.fetch = fetch
+        self.compile = compile
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def _key(self, itype, filters):
+        return itype, tuple(sorted((k, str(v)) for k, v in filters.items()))
+
+    def _build(self, itype, token, filters):
+        return self.compile(itype, self.fetch(token, dict(filters)))
+
+    def get(self, itype, token, filters):
+        if not self.size:
+            return self._build(itype, token, filters)
+
+        key = self._key(itype, filters)
+
+        with self.lock:
+            # re-inserted to mark it used, py2's OrderedDict has no move_to_end()
+            e = self.entries.pop(key, None)
+            if e:
+                self.entries[key] = e
+
+        if not e:
+            start = time.time()
+            matcher = self._build(itype, token, filters)
+            self._set(key, matcher, start, itype, token, filters)
+            return matcher
+
+        if (time.time() - e['built']) > self.ttl:
+            self._refresh(key)
+
+        return e['matcher']
+
+    def _set(self, key, matcher, built, itype, token, filters):
+        with self.lock:
+            # a whitelist write that landed while this was being fetched leaves it stale
+            invalidated = self.entries[key]['invalidated'] if key in self.entries else 0
+            if invalidated >= built:
+                built = 0
+
+            self.entries.pop(key, None)
+            self.entries[key] = {'matcher': matcher, 'built': built, 'invalidated': invalidated, 'itype': itype,
+                                 'token': token, 'filters': dict(filters)}
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def _refresh(self, key):
+        with self.lock:
+            if key in self.refreshing or key not in self.entries:
+                return
+
+            self.refreshing.add(key)
+            e = self.entries[key]
+
+        t = threading.Thread(target=self._rebuild, args=(key, e['itype'], e['token'], e['filters']))
+        t.daemon = True
+        t.start()
+
+    def _rebuild(self, key, itype, token, filters):
+        start = time.time()
+        try:
+            self._set(key, self._build(itype, token, filters), start, itype, token, filters)
+
+        except Exception as e:
+            # keep serving what we have, the next request past the ttl tries again
+            logger.error('whitelist refresh for {} failed: {}'.format(itype, e))
+
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def invalidate(self, itypes=None, delay=HTTPD_FEED_WHITELIST_WRITE_DELAY):
+        """
+        rebuilds the cached whitelists for these itypes (all of them if None) in the background
+        :param itypes: list of itypes a whitelist write touched
+        :param delay: seconds until the write is searchable, anything fetched before then is still stale
+        """
+        with self.lock:
+            keys = [k for k, e in self.entries.items() if itypes is None or e['itype'] in itypes]
+            for k in keys:
+                self.entries[k]['built'] = 0
+                self.entries[k]['invalidated'] = time.time() + delay
+
+        for k in keys:
+            if not delay:
+                self._refresh(k)
+                continue
+
+            t = threading.Timer(delay, self._refresh, args=(k,))
+            t.daemon = True
+            t.start()
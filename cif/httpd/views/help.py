@@ -13,7 +13,9 @@ class HelpAPI(MethodView):
             'GET /ping': 'ping the router interface',
             'GET /search?{q,limit,itype,indicator,confidence,tags,reporttime}': 'search for an indicator',
             'GET /indicators?{q,limit,indicator,confidence,tags,reporttime}': 'search for a set of indicators',
+            'POST /search/batch?{limit,confidence,tags,reporttime}': 'look up a list of indicators at once, results grouped by indicator',
             'POST /indicators': 'post indicators to the router',
+            'POST /indicators/bulk': 'post newline delimited json indicators (optionally gzip) to the router in chunks',
             'GET /feed?{q,limit,itype,confidence,tags,reporttime}': 'filter for a data-set, aggregate and apply respective whitelist',
             'GET /tokens?{username,token}': 'search for a set of tokens',
             'POST /tokens': 'create a token or set of tokens',
@@ -1,17 +1,22 @@
 from ..common import pull_token, jsonify_success, jsonify_unauth, jsonify_unknown, \
-    jsonify_busy, VALID_FILTERS
+    jsonify_busy, VALID_FILTERS, NDJSON, request_ndjson, stream_primed, stream_ndjson, stream_response
 from flask.views import MethodView
 from flask import request, current_app
-from cifsdk.client.zeromq import ZMQ as Client
+from cif.utils.client_pool import PooledClient as Client
 from cifsdk.client.dummy import Dummy as DummyClient
 from cif.constants import ROUTER_ADDR, PYVERSION
 from cifsdk.exceptions import AuthError, TimeoutError, InvalidSearch, SubmissionFailed, CIFBusy
 import logging
 from cif.utils import strtobool
+from cif.utils.search_client import SearchClient
+from csirtg_indicator import resolve_itype
 import ujson as json
+from .feed import whitelist_cache
 
 remote = ROUTER_ADDR
 
+SUCCESS_PREFIX = '{"status":"success"'
+
 logger = logging.getLogger('cif-httpd')
 
 if PYVERSION > 2:
@@ -20,6 +25,25 @@ else:
     basestring = (str, unicode)
 
 
+def _whitelist_itypes(indicators):
+    # itypes of the whitelist-tagged indicators in a submission, None if one can't be worked out
+    itypes = set()
+    for i in indicators:
+        tags = i.get('tags') or []
+        if isinstance(tags, basestring):
+            tags = tags.split(',')
+
+        if 'whitelist' not in [t.strip() for t in tags]:
+            continue
+
+        try:
+            itypes.add(i.get('itype') or resolve_itype(i['indicator']))
+        except Exception:
+            return
+
+    return itypes
+
+
 class IndicatorsAPI(MethodView):
     def get(self):
         filters = {}
@@ -50,6 +74,11 @@ class IndicatorsAPI(MethodView):
             return jsonify_success(r)
 
         try:
+            # a page at a time from the store straight out to the client
+            if request_ndjson():
+                pages = stream_primed(SearchClient(remote, pull_token()).indicators_search_pages(filters))
+                return stream_response(stream_ndjson(pages), mimetype=NDJSON)
+
             with Client(remote, pull_token()) as cli:
                 r = cli.indicators_search(filters, decode=False)
 
@@ -67,10 +96,11 @@ class IndicatorsAPI(MethodView):
             logger.error(e)
             return jsonify_unknown(msg='search failed, system may be too busy, check back later')
 
+        # the store's reply envelope goes out as is, the feed inside it is never decoded here
         response = current_app.response_class(r, mimetype='application/json')
 
-        if isinstance(r, basestring):
-            if '"message":"unauthorized"' in r and '"message":"unauthorized"' in r:
+        if isinstance(r, basestring) and not r.startswith(SUCCESS_PREFIX):
+            if '"message":"unauthorized"' in r:
                 response.status_code = 401
                 return response
 
@@ -110,6 +140,11 @@ class IndicatorsAPI(MethodView):
                                           fireball=fireball)
             if nowait:
                 r = 'pending'
+
+            # cached feed whitelists are rebuilt now rather than when their ttl runs out
+            itypes = _whitelist_itypes(indicators_to_send)
+            if itypes is None or itypes:
+                whitelist_cache.invalidate(itypes)
             
             if errored_indicators:
                 raise SubmissionFailed(
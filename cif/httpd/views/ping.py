@@ -1,5 +1,5 @@
 from flask import request, current_app
-from cifsdk.client.zeromq import ZMQ as Client
+from cif.utils.client_pool import PooledClient as Client
 from cifsdk.client.dummy import Dummy as DummyClient
 from cif.constants import ROUTER_ADDR
 from cifsdk.exceptions import TimeoutError, AuthError
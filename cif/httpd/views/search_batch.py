@@ -0,0 +1,77 @@
+import logging
+
+from flask import request, current_app
+from flask.views import MethodView
+import ujson as json
+from cifsdk.exceptions import AuthError, InvalidSearch
+
+from cif.constants import ROUTER_ADDR, HTTPD_SEARCH_BATCH_MAX, PYVERSION
+from cif.utils.client_pool import PooledClient as Client
+from ..common import pull_token, jsonify_success, jsonify_unauth, jsonify_unknown, VALID_FILTERS
+
+remote = ROUTER_ADDR
+
+logger = logging.getLogger('cif-httpd')
+
+if PYVERSION > 2:
+    basestring = (str, bytes)
+
+
+class SearchBatchAPI(MethodView):
+    """
+    looks up a list of indicators in one request, results grouped by indicator
+
+    the body is a list of indicators, or {"indicators": [...]} with any search filters alongside. filters can
+    also go in the query string, limit is per indicator
+    """
+    def post(self):
+        try:
+            data = json.loads(request.data.decode('utf-8'))
+        except ValueError:
+            return jsonify_unknown('invalid search: body is not json', 400)
+
+        if isinstance(data, list):
+            data = {'indicators': data}
+
+        if not isinstance(data, dict) or not isinstance(data.get('indicators'), list):
+            return jsonify_unknown('invalid search: missing a list of indicators', 400)
+
+        indicators = []
+        for i in data['indicators']:
+            if not isinstance(i, basestring) or not i.strip():
+                return jsonify_unknown('invalid search: indicators must be non-empty strings', 400)
+
+            if i.strip() not in indicators:
+                indicators.append(i.strip())
+
+        if len(indicators) > HTTPD_SEARCH_BATCH_MAX:
+            return jsonify_unknown('invalid search: at most {} indicators per batch'.format(HTTPD_SEARCH_BATCH_MAX),
+                                   400)
+
+        filters = {}
+        for f in VALID_FILTERS.intersection(set(request.args)):
+            filters[f] = ','.join(request.args.getlist(f))
+
+        for f in VALID_FILTERS.intersection(set(data)):
+            filters[f] = data[f]
+
+        filters.pop('indicator', None)
+        filters['indicators'] = indicators
+
+        if current_app.config.get('dummy'):
+            return jsonify_success({i: [] for i in indicators})
+
+        try:
+            r = Client(remote, pull_token()).indicators_search(filters)
+
+        except InvalidSearch as e:
+            return jsonify_unknown(msg='invalid search', code=400)
+
+        except AuthError:
+            return jsonify_unauth()
+
+        except Exception as e:
+            logger.error(e)
+            return jsonify_unknown(msg='search failed, system may be too busy, check back later')
+
+        return jsonify_success(r)
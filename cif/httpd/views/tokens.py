@@ -1,5 +1,5 @@
 from flask import request, current_app
-from cifsdk.client.zeromq import ZMQ as Client
+from cif.utils.client_pool import PooledClient as Client
 from cifsdk.exceptions import AuthError
 from ..common import pull_token, jsonify_success, jsonify_unauth, jsonify_unknown
 from flask.views import MethodView
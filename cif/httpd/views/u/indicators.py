@@ -1,7 +1,7 @@
 from flask.views import MethodView
 from flask import flash
 from flask import request, render_template, session
-from cifsdk.client.zeromq import ZMQ as Client
+from cif.utils.client_pool import PooledClient as Client
 from cif.constants import ROUTER_ADDR
 import logging
 import arrow
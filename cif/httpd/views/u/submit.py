@@ -3,7 +3,7 @@ from flask import request, render_template, session, redirect, flash
 from cif.constants import ROUTER_ADDR
 import logging
 from csirtg_indicator import Indicator, InvalidIndicator
-from cifsdk.client.zeromq import ZMQ as Client
+from cif.utils.client_pool import PooledClient as Client
 
 remote = ROUTER_ADDR
 
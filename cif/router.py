@@ -2,25 +2,33 @@
 
 import ujson as json
 import logging
+import re
 import textwrap
 import traceback
+import uuid
+import zlib
+from collections import OrderedDict
+from functools import partial
 from argparse import ArgumentParser
 from argparse import RawDescriptionHelpFormatter
 from time import sleep
 import zmq
 import os
 from cif.constants import ROUTER_ADDR, STORE_ADDR, HUNTER_ADDR, GATHERER_ADDR, GATHERER_SINK_ADDR, HUNTER_SINK_ADDR, \
-            RUNTIME_PATH, AUTH_ENABLED, AUTH_ADDR, CTRL_ADDR
+            RUNTIME_PATH, AUTH_ENABLED, AUTH_ADDR, CTRL_ADDR, INTERNAL_ADDR, FEED_ITYPES
 from cifsdk.constants import CONFIG_PATH
 from cifsdk.utils import setup_logging, get_argument_parser, setup_signals, setup_runtime_path, read_config
 from cif.hunter import Hunter
 from cif.store import Store
+from cif.store.token_cache import TokenCache
 from cif.gatherer import Gatherer
 import time
 import multiprocessing as mp
-from cifsdk.msg import Msg
+from cifsdk.msg import MAP
+import msgpack
 from cif.auth import Auth
 from cif.utils import strtobool
+from cif.utils.fair_queue import FairQueue
 
 AUTH_TYPE = 'cif_store'
 AUTH_PLUGINS = ['cif.auth.cif_store']
@@ -37,7 +45,22 @@ ZMQ_HWM = 1000000
 ZMQ_SNDTIMEO = 5000
 ZMQ_RCVTIMEO = 5000
 FRONTEND_TIMEOUT = os.environ.get('CIF_FRONTEND_TIMEOUT', 100)
-BACKEND_TIMEOUT = os.environ.get('CIF_BACKEND_TIMEOUT', 10)
+
+# requests are queued by class as they come in and handed out by weight, at most ROUTER_BUDGET per pass of the loop
+ROUTER_WEIGHTS = os.environ.get('CIF_ROUTER_WEIGHTS', 'read:8,write:4,gatherer:2,hunter:1')
+ROUTER_BUDGET = int(os.environ.get('CIF_ROUTER_BUDGET', 64))
+# per class, past this the router stops reading that class's socket and leaves senders to zmq's hwm
+ROUTER_QUEUE_DEPTH = int(os.environ.get('CIF_ROUTER_QUEUE_DEPTH', 10000))
+# ms a frontend read can wait before it goes ahead of everything else
+ROUTER_READ_DEADLINE = float(os.environ.get('CIF_ROUTER_READ_DEADLINE', 50))
+
+# prefixed to a request's id on its way to the backends, and stripped off the reply to route it back
+TAG_FRONTEND = b'f'
+TAG_HUNTER = b'h'
+TAG_INTERNAL = b'i'
+
+WRITE_TYPES = ['indicators_create', 'indicators_delete', 'tokens_create', 'tokens_delete', 'tokens_edit',
+               'ping_write']
 
 HUNTER_TOKEN = os.environ.get('CIF_HUNTER_TOKEN', None)
 
@@ -48,6 +71,11 @@ if not os.path.isfile(CONFIG_PATH):
 STORE_DEFAULT = os.getenv('CIF_STORE_STORE', STORE_DEFAULT)
 STORE_NODES = os.getenv('CIF_STORE_NODES')
 
+# store processes behind the router, searches are spread across them and writes go to the one that owns the indicator
+STORE_WORKERS = os.getenv('CIF_STORE_WORKERS', 1)
+# seconds a store worker has to answer a write before the router fails it back to the client
+STORE_WRITE_TIMEOUT = float(os.getenv('CIF_STORE_WRITE_TIMEOUT', 300))
+
 PIDFILE = os.getenv('CIF_ROUTER_PIDFILE', '{}/cif_router.pid'.format(RUNTIME_PATH))
 
 TRACE = strtobool(os.environ.get('CIF_ROUTER_TRACE', False))
@@ -59,6 +87,37 @@ if TRACE:
     logger.setLevel(logging.DEBUG)
 
 
+def frame_bytes(f):
+    return f.bytes if isinstance(f, zmq.Frame) else f
+
+
+def frame_mtype(m):
+    return MAP[msgpack.unpackb(frame_bytes(m[3]))]
+
+
+def parse_weights(weights):
+    """
+    'read:8,write:4' to [('read', 8), ('write', 4), ..], any class left out keeps its default weight
+    """
+    defaults = [w.split(':') for w in 'read:8,write:4,gatherer:2,hunter:1'.split(',')]
+    given = dict(w.strip().split(':') for w in (weights or '').split(',') if ':' in w)
+
+    return [(c, int(given.get(c, w))) for c, w in defaults]
+
+
+def shard_address(address, n):
+    """
+    the write address of store worker n, next to the store address
+
+    ipc://store.ipc becomes ipc://store.ipc.n and tcp://host:port becomes tcp://host:port+1+n
+    """
+    m = re.match(r'^(tcp://.+):(\d+)$', address)
+    if m:
+        return '{}:{}'.format(m.group(1), int(m.group(2)) + 1 + n)
+
+    return '{}.{}'.format(address, n)
+
+
 class Router(object):
 
     def __enter__(self):
@@ -70,13 +129,24 @@ class Router(object):
     def __init__(self, listen=ROUTER_ADDR, hunter=HUNTER_ADDR, store_type=STORE_DEFAULT, store_address=STORE_ADDR,
                  store_nodes=None, hunter_token=HUNTER_TOKEN, hunter_threads=HUNTER_THREADS,
                  gatherer_threads=GATHERER_THREADS, auth_required=AUTH_ENABLED, auth_address=AUTH_ADDR, 
-                 auth_type=AUTH_TYPE, test=False):
+                 auth_type=AUTH_TYPE, store_workers=STORE_WORKERS, test=False):
 
         self.logger = logging.getLogger(__name__)
 
         self.context = zmq.Context()
 
-        self.token_cache = mp.Manager().dict()
+        # each process caches its own lookups, edits and deletes clear them all through a shared generation
+        self.token_cache = TokenCache()
+
+        # with more than one store worker each has a write socket of its own, and the writes it still owes a reply
+        # on, oldest first. each goes out under a sequence number of the router's, which the reply is matched on
+        self.store_workers = max(1, int(store_workers or 1))
+        self.store_shards = []
+        self.store_pending = []
+        self.store_seq = 0
+
+        self.queue = FairQueue(parse_weights(ROUTER_WEIGHTS), budget=ROUTER_BUDGET, depth=ROUTER_QUEUE_DEPTH,
+                               deadline=('read', ROUTER_READ_DEADLINE / 1000.0))
 
         if test:
             return
@@ -84,7 +154,15 @@ class Router(object):
         self.store_s = self.context.socket(zmq.DEALER)
         self.store_s.bind(store_address)
 
-        self.store_p = None
+        if self.store_workers > 1:
+            for n in range(self.store_workers):
+                s = self.context.socket(zmq.DEALER)
+                s.set_hwm(ZMQ_HWM)
+                s.bind(shard_address(store_address, n))
+                self.store_shards.append(s)
+                self.store_pending.append(OrderedDict())
+
+        self.stores = []
         self._init_store(self.context, store_address, store_type, nodes=store_nodes)
 
         self.gatherer_s = self.context.socket(zmq.PUSH)
@@ -99,6 +177,9 @@ class Router(object):
         self.hunter_sink_s = self.context.socket(zmq.ROUTER)
         self.hunter_sink_s.bind(HUNTER_SINK_ADDR)
 
+        self.internal_s = self.context.socket(zmq.ROUTER)
+        self.internal_s.bind(INTERNAL_ADDR)
+
         self.hunter_token_dict = None
         self.hunter_token_dict_as_str = ''
         self.ctrl_sink_s = self.context.socket(zmq.PULL)
@@ -131,7 +212,6 @@ class Router(object):
         self.count_start = time.time()
 
         self.poller = zmq.Poller()
-        self.poller_backend = zmq.Poller()
 
         self.terminate = False
 
@@ -151,10 +231,23 @@ class Router(object):
 
     def _init_store(self, context, store_address, store_type, nodes=False):
         self.logger.info('launching store...')
-        p = mp.Process(target=Store(store_address=store_address, store_type=store_type, nodes=nodes,
-          token_cache=self.token_cache).start)
-        p.start()
-        self.store_p = p
+        if not self.store_shards:
+            p = mp.Process(target=Store(store_address=store_address, store_type=store_type, nodes=nodes,
+              token_cache=self.token_cache).start)
+            p.start()
+            self.stores.append(p)
+            return
+
+        # every worker answers a ping with the same change marker, no matter which of them the writes went to. a
+        # counter per feed itype and one for the rest
+        changes = mp.Array('L', len(FEED_ITYPES) + 1)
+        changes_id = uuid.uuid4().hex[:8]
+        for n in range(self.store_workers):
+            p = mp.Process(target=Store(store_address=store_address, store_type=store_type, nodes=nodes,
+              token_cache=self.token_cache, shard_address=shard_address(store_address, n), worker=n,
+              workers=self.store_workers, changes=changes, changes_id=changes_id).start)
+            p.start()
+            self.stores.append(p)
 
     def _init_auth(self, auth_address, auth_type):
         self.logger.info('launching auth...')
@@ -177,67 +270,129 @@ class Router(object):
         self.auth_p.terminate()
 
         self.logger.info('stopping store..')
-        self.store_p.terminate()
+        for s in self.stores:
+            s.terminate()
 
         sleep(0.01)
 
     def start(self):
         self.logger.debug('starting loop')
 
-        self.poller_backend.register(self.ctrl_sink_s, zmq.POLLIN)
-        self.poller_backend.register(self.hunter_sink_s, zmq.POLLIN)
-        self.poller_backend.register(self.gatherer_sink_s, zmq.POLLIN)
-        self.poller.register(self.store_s, zmq.POLLIN)
+        for s in [self.ctrl_sink_s, self.hunter_sink_s, self.internal_s, self.gatherer_sink_s, self.store_s,
+                  self.frontend_s] + self.store_shards:
+            self.poller.register(s, zmq.POLLIN)
         if self.auth_required:
             self.poller.register(self.auth_s, zmq.POLLIN)
-        self.poller.register(self.frontend_s, zmq.POLLIN)
 
-        # we use this instead of a loop so we can make sure to get front end queries as they come in
-        # that way hunters don't over burden the store, think of it like QoS
-        # it's weighted so front end has a higher chance of getting a faster response
+        # requests are read off their sockets into a queue per class (frontend reads and writes, hunters,
+        # gatherers) and dispatched by weight, so a storm of one kind can't starve the others. that way hunters
+        # don't over burden the store, think of it like QoS. replies go straight back out, they've already had
+        # their turn
         while not self.terminate:
-            items = dict(self.poller_backend.poll(BACKEND_TIMEOUT))
-
-            if self.gatherer_sink_s in items and items[self.gatherer_sink_s] == zmq.POLLIN:
-                self.handle_message_gatherer(self.gatherer_sink_s)
-
-            if self.hunter_sink_s in items and items[self.hunter_sink_s] == zmq.POLLIN:
-                self.handle_message_backend_request(self.hunter_sink_s)
+            items = dict(self.poller.poll(0 if len(self.queue) else FRONTEND_TIMEOUT))
 
             # handle recv hunter token as data one time, then save/shutdown this sink
             if not self.hunter_token_dict and self.ctrl_sink_s and self.ctrl_sink_s in items and items[self.ctrl_sink_s] == zmq.POLLIN:
                 self.logger.debug('Recving hunter token from store...')
                 self.hunter_token_dict_as_str = self.ctrl_sink_s.recv_string()
                 self.hunter_token_dict = json.loads(self.hunter_token_dict_as_str)
+                self.poller.unregister(self.ctrl_sink_s)
                 self.ctrl_sink_s.close()
-                self.poller_backend.unregister(self.ctrl_sink_s)
                 self.ctrl_sink_s = None
 
-            items = dict(self.poller.poll(FRONTEND_TIMEOUT))
+            if self.store_s in items:
+                self._drain_replies(self.store_s, self.handle_message_response)
 
-            if self.frontend_s in items and items[self.frontend_s] == zmq.POLLIN:
-                if self.auth_required:
-                    self.handle_message_auth_request(self.frontend_s)
-                else:
-                    self.handle_message_backend_request(self.frontend_s)
+            for n, s in enumerate(self.store_shards):
+                if s in items:
+                    self._drain_replies(s, lambda s, n=n: self.handle_message_shard_response(n))
 
-            if self.auth_required and self.auth_s in items and items[self.auth_s] == zmq.POLLIN:
-                self.handle_message_auth_response(self.auth_s)
+            if self.store_shards:
+                self._store_expire()
 
-            if self.store_s in items and items[self.store_s] == zmq.POLLIN:
-                self.handle_message_response(self.store_s)
+            if self.auth_required and self.auth_s in items:
+                self._drain_replies(self.auth_s, self.handle_message_auth_response)
 
+            if self.frontend_s in items:
+                if self.auth_required:
+                    self._drain(self.frontend_s, self.handle_message_auth_request)
+                # backend requests wait on the hunter token
+                elif self.hunter_token_dict:
+                    self._drain(self.frontend_s, partial(self.handle_message_backend_request, origin=TAG_FRONTEND))
+
+            # httpd's internal requests go in with the frontend's reads and writes
+            if self.internal_s in items and self.hunter_token_dict:
+                self._drain(self.internal_s, partial(self.handle_message_backend_request, origin=TAG_INTERNAL))
+
+            if self.hunter_sink_s in items and self.hunter_token_dict:
+                self._drain(self.hunter_sink_s, self.handle_message_backend_request, c='hunter')
+
+            if self.gatherer_sink_s in items:
+                self._drain(self.gatherer_sink_s, self.handle_message_gatherer, c='gatherer')
+
+            for handler, m in self.queue.batch():
+                try:
+                    handler(*m)
+                except Exception as e:
+                    self.logger.error(e)
+
+    def _readable(self, s):
+        return s.getsockopt(zmq.EVENTS) & zmq.POLLIN
+
+    def _drain(self, s, handler, c=None):
+        """
+        queues up what's waiting on a request socket
+
+        :param s: socket
+        :param handler: fn(frames) to dispatch a request to
+        :param c: class, frontend requests are 'read' or 'write' by message type
+        """
+        classes = [c] if c else ['read', 'write']
+        n = 0
+
+        while n < self.queue.budget and self._readable(s):
+            if any(self.queue.full(x) for x in classes):
+                return
+
+            m = s.recv_multipart(copy=False)
+            n += 1
+
+            # [id, null, token, mtype, data], only the mtype is decoded to class the request
+            if len(m) != 5:
+                self.logger.error('dropping malformed request: {} frames'.format(len(m)))
+                continue
+
+            try:
+                x = c or ('write' if frame_mtype(m) in WRITE_TYPES else 'read')
+            except Exception as e:
+                self.logger.error('dropping malformed request: {}'.format(e))
+                continue
+
+            self.queue.push(x, (handler, (m,)))
+
+    def _drain_replies(self, s, handler):
+        n = 0
+        while n < self.queue.budget and self._readable(s):
+            handler(s)
+            n += 1
+
+    def queue_depths(self):
+        """
+        requests waiting per class, with how long the oldest of each has been waiting (ms)
+        """
+        return dict((c, {'depth': n, 'wait': int(self.queue.wait(c) * 1000)}) for c, n in self.queue.depths().items())
 
     def _log_counter(self):
         self.count += 1
         if (self.count % 100) == 0:
             t = (time.time() - self.count_start)
             n = self.count / t
-            self.logger.info('processing {} msgs per {} sec'.format(round(n, 2), round(t, 2)))
+            self.logger.info('processing {} msgs per {} sec, queued {}'.format(round(n, 2), round(t, 2),
+                                                                              self.queue_depths()))
             self.count = 0
             self.count_start = time.time()
 
-    def handle_message_backend_request(self, s):
+    def handle_message_backend_request(self, m, origin=TAG_HUNTER):
         # if something comes directly to the backend, that implies it was an internal request
         # such as from a hunter (or no auth enabled). therefore, use hunter token for request
         if not self.hunter_token_dict:
@@ -246,84 +401,191 @@ class Router(object):
             # 5-10 secs after startup, there may be an issue
             self.logger.info('Got backend request before hunter token was ready. Skipping...')
             return
-        id, token, mtype, data = Msg().recv(s)
-        token = self.hunter_token_dict_as_str
-        self.handle_message_request(id, token, mtype, data)
+        m[2] = self.hunter_token_dict_as_str.encode('utf-8')
+        self.handle_message_request(m, origin)
+
+    def handle_message_request(self, m, origin):
+        """
+        :param m: request frames, [id, null, token, mtype, data]
+        :param origin: TAG_FRONTEND, TAG_HUNTER or TAG_INTERNAL, carried on the id so the reply finds its way back
+        """
+        mtype = frame_mtype(m)
+        m[0] = origin + frame_bytes(m[0])
 
-    def handle_message_request(self, id, token, mtype, data):
         handler = self.handle_message_default
-        if mtype in ['indicators_create', 'indicators_search', 'ping_write']:
+        if mtype in ['indicators_create', 'indicators_search', 'indicators_delete', 'ping_write']:
             handler = getattr(self, "handle_" + mtype)
 
         try:
-            handler(id, mtype, token, data)
+            handler(m)
         except Exception as e:
             self.logger.error(e)
 
         self._log_counter()
 
-    def handle_message_default(self, id, mtype, token, data='[]'):
-        Msg(id=id, mtype=mtype, token=token, data=data).send(self.store_s)
+    def handle_message_default(self, m):
+        self.store_s.send_multipart(m, copy=False)
 
-    def handle_ping_write(self, id, mtype, token, data):
+    def handle_ping_write(self, m):
         # format the token as is expected by cifsdk for a data field resp
-        token = json.loads(token)
+        token = json.loads(frame_bytes(m[2]))
         data = json.dumps({ 'status': 'success', 'data': token })
-        # respond to appropriate socket
-        if token.get('username') == self.hunter_token_dict.get('username'):
-            Msg(id=id, mtype=mtype, data=data).send(self.hunter_sink_s)
-        else:
-            Msg(id=id, mtype=mtype, data=data).send(self.frontend_s)
+        self._reply_client(m[0], m[3], data.encode('utf-8'))
 
-    def handle_indicators_search(self, id, mtype, token, data):
-        self.handle_message_default(id, mtype, token, data)
+    def handle_indicators_search(self, m):
+        self.handle_message_default(m)
 
         if self.hunters:
-            Msg(id=id, mtype=mtype, token=token, data=data).send(self.hunters_s)
+            self.hunters_s.send_multipart(m, copy=False)
 
-    def handle_indicators_create(self, id, mtype, token, data):
-        Msg(id=id, mtype=mtype, token=token, data=data).send(self.gatherer_s)
+    def handle_indicators_create(self, m):
+        self.gatherer_s.send_multipart(m, copy=False)
 
-    def handle_message_response(self, s):
-        # re-routing from store to frontend or hunter_sink (as based on the username for a source)
-        id, token, mtype, data = Msg().recv(s)
-        token = json.loads(token)
-        if token.get('username') == self.hunter_token_dict.get('username'):
-            Msg(id=id, mtype=mtype, data=data).send(self.hunter_sink_s)
-        else:
-            Msg(id=id, mtype=mtype, data=data).send(self.frontend_s)
+    def handle_indicators_delete(self, m):
+        self.store_write(m)
+
+    def _shard(self, indicator):
+        # crc32 rather than hash(), which is salted per process
+        if not indicator:
+            return 0
+
+        if not isinstance(indicator, bytes):
+            indicator = str(indicator).encode('utf-8')
+
+        return zlib.crc32(indicator) % self.store_workers
+
+    def _store_split(self, data):
+        """
+        a write's indicators grouped by the store worker that owns them, in the order they came in
+
+        :param data: json str, an indicator or a list of them
+        :return: {worker: json str}, the data as it came in when it all belongs to the one worker
+        """
+        try:
+            rv = json.loads(data)
+        except ValueError:
+            return {0: data}
+
+        if isinstance(rv, dict):
+            return {self._shard(rv.get('indicator')): data}
+
+        if not isinstance(rv, list):
+            return {0: data}
+
+        parts = {}
+        for i in rv:
+            parts.setdefault(self._shard(i.get('indicator') if isinstance(i, dict) else None), []).append(i)
+
+        if len(parts) < 2:
+            return {n: data for n in parts} or {0: data}
+
+        return {n: json.dumps(parts[n]) for n in parts}
+
+    def store_write(self, m):
+        if not self.store_shards:
+            self.store_s.send_multipart(m, copy=False)
+            return
+
+        parts = self._store_split(frame_bytes(m[4]).decode('utf-8'))
+
+        r = {'id': m[0], 'mtype': m[3], 'left': len(parts), 'data': 0, 'error': None}
+        for n in sorted(parts):
+            self.store_seq += 1
+            seq = str(self.store_seq).encode('utf-8')
+            self.store_pending[n][seq] = (time.time(), r)
 
-    def handle_message_gatherer(self, s):
-        id, token, mtype, data = Msg().recv(s)
+            data = parts[n]
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
 
-        Msg(id=id, mtype=mtype, token=token, data=data).send(self.store_s)
+            self.store_shards[n].send_multipart([seq] + m[1:4] + [data], copy=False)
+
+    def _store_merge(self, n, seq, data):
+        """
+        folds worker n's reply into the write it answers
+
+        :return: the write once every worker it went to has answered, else None
+        """
+        p = self.store_pending[n].pop(seq, None)
+        if not p:
+            self.logger.error('store worker %d answered write %s after it timed out', n, seq)
+            return
+
+        r = p[1]
+        r['left'] -= 1
+
+        try:
+            data = json.loads(data)
+        except ValueError:
+            data = {'status': 'failed', 'message': 'unknown failure'}
+
+        if data.get('status') == 'success':
+            if isinstance(data.get('data'), int) and not isinstance(data.get('data'), bool):
+                r['data'] += data['data']
+        elif not r['error']:
+            r['error'] = data
+
+        if r['left']:
+            return
+
+        return r
+
+    def _store_expire(self):
+        # a worker that never answers fails its part of the write, rather than holding the client up for good
+        cutoff = time.time() - STORE_WRITE_TIMEOUT
+        for n, pending in enumerate(self.store_pending):
+            while pending:
+                seq, (sent, _) = next(iter(pending.items()))
+                if sent > cutoff:
+                    break
+
+                self.logger.error('store worker %d never answered write %s', n, seq)
+                r = self._store_merge(n, seq, json.dumps({'status': 'failed', 'message': 'timeout'}))
+                if r:
+                    self._store_reply(r)
+
+    def _store_reply(self, r):
+        # one part failing fails the write, as it would have with the one store
+        data = r['error'] or {'status': 'success', 'data': r['data']}
+        self._reply_client(r['id'], r['mtype'], json.dumps(data).encode('utf-8'))
+
+    def handle_message_shard_response(self, n):
+        m = self.store_shards[n].recv_multipart(copy=False)
+
+        r = self._store_merge(n, frame_bytes(m[0]), frame_bytes(m[4]))
+        if r:
+            self._store_reply(r)
+
+    def _reply_client(self, id, mtype, data):
+        # re-routing from store to frontend, hunter_sink or internal, by the origin tag the request was given on its
+        # way in
+        id = frame_bytes(id)
+        s = {TAG_HUNTER: self.hunter_sink_s, TAG_INTERNAL: self.internal_s}.get(id[:1], self.frontend_s)
+        s.send_multipart([id[1:], b'', mtype, data], copy=False)
+
+    def handle_message_response(self, s):
+        # the reply's data frame goes back out as it came in, never copied or decoded
+        m = s.recv_multipart(copy=False)
+        self._reply_client(m[0], m[3], m[4])
+
+    def handle_message_gatherer(self, m):
+        self.store_write(m)
 
         if self.hunters:
-            Msg(id=id, mtype=mtype, token=token, data=data).send(self.hunters_s)
+            self.hunters_s.send_multipart(m, copy=False)
 
-    def handle_message_auth_request(self, s):
-        id, token, mtype, data = Msg().recv(s)
-        Msg(id=id, mtype=mtype, token=token, data=data).send(self.auth_s)
+    def handle_message_auth_request(self, m):
+        self.auth_s.send_multipart(m, copy=False)
 
     def handle_message_auth_response(self, s):
-        id, token, mtype, data = Msg().recv(s)
+        m = s.recv_multipart(copy=False)
 
-        try:
-            data_dict = json.loads(data)
-        except Exception as e:
-            # this can happen if invalid json passed in request
-            # e.g., PATCH to /tokens with { "token": "longtokenhere_followedbymissingdblquote, "groups": ["everyone"] }
-            data_dict = { 'status': 'failed', 'message': 'invalid JSON'}
-            logger.error('Could not decode auth resp data {}. Error {}'.format(data, e))
-            data = json.dumps(data_dict)
-
-        # route based on resp
-        if isinstance(data_dict, dict) and data_dict.get('status') == 'failed':
-            # route auth failure back to frontend
-            Msg(id=id, mtype=mtype, data=data).send(self.frontend_s)
+        # auth hands back an empty token, and the error as the data, when it turns a request down
+        if frame_bytes(m[2]) == b'[]':
+            self.frontend_s.send_multipart([m[0], b'', m[3], m[4]], copy=False)
         else:
             # if we get here, authN/authZ succeeded
-            self.handle_message_request(id, token, mtype, data)
+            self.handle_message_request(m, TAG_FRONTEND)
 
 def main():
     p = get_argument_parser()
@@ -338,6 +600,7 @@ def main():
             CIF_HUNTER_THREADS
             CIF_GATHERER_THREADS
             CIF_STORE_ADDR
+            CIF_STORE_WORKERS
 
         example usage:
             $ cif-router --listen 0.0.0.0 -d
@@ -366,6 +629,8 @@ def main():
                    default=STORE_DEFAULT)
 
     p.add_argument('--store-nodes', help='specify storage nodes address [default: %(default)s]', default=STORE_NODES)
+    p.add_argument('--store-workers', help='specify number of store processes to run [default: %(default)s]',
+                   default=STORE_WORKERS)
 
     p.add_argument('--logging-ignore', help='set logging to WARNING for specific modules')
 
@@ -408,7 +673,7 @@ def main():
 
     with Router(listen=args.listen, hunter=args.hunter, store_type=args.store, store_address=args.store_address,
                 store_nodes=args.store_nodes, hunter_token=args.hunter_token, hunter_threads=args.hunter_threads,
-                gatherer_threads=args.gatherer_threads) as r:
+                gatherer_threads=args.gatherer_threads, store_workers=args.store_workers) as r:
         try:
             logger.info('starting router..')
             r.start()
@@ -13,17 +13,26 @@ import traceback
 import yaml
 import arrow
 import multiprocessing
-from csirtg_indicator import Indicator
+from csirtg_indicator import Indicator, resolve_itype
 import zmq
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
 
 from cifsdk.msg import Msg
 import cif.store
-from cif.constants import STORE_ADDR, PYVERSION, AUTH_ENABLED, CTRL_ADDR
-from cif.utils import strtobool
+from cif.constants import STORE_ADDR, PYVERSION, AUTH_ENABLED, CTRL_ADDR, RUNTIME_PATH, FEED_ITYPES
+from cif.utils import strtobool, es_hits_to_array
 from cifsdk.constants import REMOTE_ADDR, CONFIG_PATH
 from cifsdk.exceptions import AuthError, InvalidSearch
 from cif.exceptions import StoreLockError
+from cif.store.create_log import CreateLog
 from csirtg_indicator import InvalidIndicator
 from cifsdk.utils import setup_logging, get_argument_parser, setup_signals
 import binascii
@@ -47,6 +56,19 @@ CREATE_QUEUE_TIMEOUT = os.environ.get('CIF_STORE_TIMEOUT', 300)
 # queue max to flush before we hit CIF_STORE_QUEUE_FLUSH mark
 CREATE_QUEUE_MAX = os.environ.get('CIF_STORE_QUEUE_MAX', 1000)
 
+# bytes a token can have waiting in the queue before its submissions are turned away as busy
+CREATE_QUEUE_BYTES = os.environ.get('CIF_STORE_QUEUE_BYTES', 4 * 1024 * 1024)
+
+# where queued submissions are logged until they're upserted, so a restart replays them. empty to keep them in memory
+CREATE_QUEUE_LOG = os.environ.get('CIF_STORE_QUEUE_LOG', os.path.join(RUNTIME_PATH, 'create_queue'))
+CREATE_QUEUE_SEGMENT = os.environ.get('CIF_STORE_QUEUE_SEGMENT', 16 * 1024 * 1024)
+
+# ms a queued submission waits to be acked, the log is synced once for everything that came in meanwhile
+CREATE_QUEUE_SYNC = os.environ.get('CIF_STORE_QUEUE_SYNC', 5)
+
+# flushes a token's queued submissions are tried for while the store is busy, before they're dropped
+CREATE_QUEUE_RETRIES = os.environ.get('CIF_STORE_QUEUE_RETRIES', 10)
+
 # require provider to match the token username
 STRICT_PROVIDERS = os.environ.get('CIF_STRICT_PROVIDERS', False)
 # allow these users to override provider - csv list
@@ -58,6 +80,12 @@ if STRICT_PROVIDERS in [1, '1']:
 else:
     STRICT_PROVIDERS = False
 
+# threads to run indicator searches on so a long feed pull doesn't stall ingest, 0 to search inline
+SEARCH_WORKERS = int(os.environ.get('CIF_STORE_SEARCH_WORKERS', 0))
+
+# indicators per reply frame when a search asks to be streamed (stream=1)
+SEARCH_PAGE_SIZE = int(os.environ.get('CIF_STORE_SEARCH_PAGE_SIZE', 5000))
+
 MORE_DATA_NEEDED = -2
 
 TRACE = strtobool(os.environ.get('CIF_STORE_TRACE', False))
@@ -88,8 +116,31 @@ class Store(multiprocessing.Process):
         self.create_queue_limit = CREATE_QUEUE_LIMIT
         self.create_queue_wait = CREATE_QUEUE_TIMEOUT
         self.create_queue_max = CREATE_QUEUE_MAX
+        self.create_queue_bytes = CREATE_QUEUE_BYTES
+        self.create_queue_retries = CREATE_QUEUE_RETRIES
         self.create_queue_count = 0
+        self.create_log_path = kwargs.pop('create_log', CREATE_QUEUE_LOG)
+        self.create_log = None
+        self.create_acks = []
         self.hunter_token = hunter_token
+        self.search_workers = kwargs.pop('search_workers', SEARCH_WORKERS)
+        self.search_pool = None
+        self.searches = set()
+        self.search_replies = Queue()
+
+        # a sharded worker also takes the writes for its share of indicators on an address of its own, only the
+        # primary one sets up the admin and hunter tokens
+        self.shard_addr = kwargs.pop('shard_address', None)
+        self.worker = kwargs.pop('worker', None)
+        self.workers = kwargs.pop('workers', None)
+        self.primary = not self.worker
+
+        # a counter per feed itype (and one for the rest) bumped by the writes of that itype, what httpd's feed
+        # cache keys its etags on. sharded workers are handed the one id and shared counters so any of them answers
+        # with the same marker
+        self.changes_id = kwargs.pop('changes_id', None) or uuid.uuid4().hex[:8]
+        self.changes_shared = kwargs.pop('changes', None)
+        self.changes_count = [0] * (len(FEED_ITYPES) + 1)
 
     def _load_plugin(self, **kwargs):
         # TODO replace with cif.utils.load_plugin
@@ -146,33 +197,50 @@ class Store(multiprocessing.Process):
 
     def start(self):
         self._load_plugin(**self.kwargs)
+        self._replay_create_log()
+
         self.context = zmq.Context()
         self.router = self.context.socket(zmq.ROUTER)
 
-        self.token_create_admin()
+        if self.primary:
+            self.token_create_admin()
 
-        # one time push of this info to router
-        self.ctrl_sink_s = self.context.socket(zmq.PUSH)
-        self.ctrl_sink_s.setsockopt(zmq.LINGER, -1)
-        self.ctrl_sink_s.bind(CTRL_ADDR)
-        hunter_token_dict = self.token_create_hunter()
-        self.ctrl_sink_s.send_string(json.dumps(hunter_token_dict))
-        hunter_token_dict = None
+            # one time push of this info to router
+            self.ctrl_sink_s = self.context.socket(zmq.PUSH)
+            self.ctrl_sink_s.setsockopt(zmq.LINGER, -1)
+            self.ctrl_sink_s.bind(CTRL_ADDR)
+            hunter_token_dict = self.token_create_hunter()
+            self.ctrl_sink_s.send_string(json.dumps(hunter_token_dict))
+            hunter_token_dict = None
 
         logger.debug('connecting to router: {}'.format(self.store_addr))
         self.router.connect(self.store_addr)
 
+        if self.shard_addr:
+            logger.debug('connecting to router: {}'.format(self.shard_addr))
+            self.router.connect(self.shard_addr)
+
         logger.info('connected')
 
         logger.debug('starting loop')
 
+        if self.search_workers:
+            self.search_pool = ThreadPoolExecutor(max_workers=self.search_workers)
+
         poller = zmq.Poller()
         poller.register(self.router, zmq.POLLIN)
 
         last_flushed = time.time()
         while not self.exit.is_set():
             try:
-                m = dict(poller.poll(1000))
+                # tighten the loop while searches are out so their replies go back promptly
+                timeout = 1000
+                if self.searches or not self.search_replies.empty():
+                    timeout = 10
+                if self.create_acks:
+                    timeout = min(timeout, int(float(CREATE_QUEUE_SYNC)) or 1)
+
+                m = dict(poller.poll(timeout))
             except SystemExit or KeyboardInterrupt:
                 break
 
@@ -180,20 +248,27 @@ class Store(multiprocessing.Process):
                 m = Msg().recv(self.router)
                 self.handle_message(m)
 
-            if len(self.create_queue) > 0 and ((time.time() - last_flushed) > self.create_queue_flush) or (self.create_queue_count >= self.create_queue_max):
-                self._flush_create_queue()
-                for t in list(self.create_queue):
-                    self.create_queue[t]['messages'] = []
+            if self.searches or not self.search_replies.empty():
+                self._reply_searches()
 
-                    # if we've not seen activity in 300s reset the counter
-                    if self.create_queue[t]['count'] > 0:
-                        if (time.time() - self.create_queue[t]['last_activity']) > self.create_queue_wait:
-                            logger.debug('pruning {} from create_queue'.format(t))
-                            del self.create_queue[t]
+            if self.create_acks and (time.time() - self.create_acks[0][0]) * 1000 >= float(CREATE_QUEUE_SYNC):
+                self._ack_creates()
 
-                self.create_queue_count = 0
+            if len(self.create_queue) > 0 and ((time.time() - last_flushed) > float(self.create_queue_flush)) or (self.create_queue_count >= int(self.create_queue_max)):
+                self._ack_creates()
+                self._flush_create_queue()
+                self._prune_create_queue()
+                self.create_queue_count = sum(len(q['messages']) for q in self.create_queue.values())
                 last_flushed = time.time()
 
+        if self.search_pool:
+            self.search_pool.shutdown(wait=True)
+            self._reply_searches()
+
+        self._ack_creates()
+        if self.create_log:
+            self.create_log.close()
+
     def terminate(self):
         self.exit.set()
 
@@ -218,9 +293,14 @@ class Store(multiprocessing.Process):
                             }
             except ValueError as e:
                 logger.error(e)
-                data = json.dumps({"status": "failed"})
-                token = json.dumps(token)
-                Msg(id=id, client_id=client_id, mtype=mtype, token=token, data=data).send(self.router)
+                rv = {"status": "failed", "message": "invalid JSON"}
+
+                # the writes ahead of it are still waiting on their acks, it goes out behind them
+                if self.create_acks:
+                    self.create_acks.append((time.time(), id, client_id, mtype, token, rv))
+                    return
+
+                self._reply(id, client_id, mtype, token, rv)
                 return
 
         handler = getattr(self, "handle_" + mtype)
@@ -228,8 +308,54 @@ class Store(multiprocessing.Process):
             logger.error('message type {0} unknown'.format(mtype))
             Msg(id=id, data='0')
 
+        # searches are checked and logged here, then run on a worker and answered from the main loop
+        if mtype == 'indicators_search' and (self.search_pool or self._search_streamed(data)):
+            stream = self._search_streamed(data, pop=True)
+            rv = self._handle(self._search_prepare, token, data)
+            if rv['status'] == 'success':
+                if not self.search_pool:
+                    return self._search_stream(token, data, partial(self._reply, id, client_id, mtype, token))
+
+                reply = partial(self._queue_reply, id, client_id, mtype, token)
+                if stream:
+                    f = self.search_pool.submit(self._search_stream, token, data, reply)
+                else:
+                    f = self.search_pool.submit(self._search_once, token, data, reply)
+
+                self.searches.add(f)
+                return
+        else:
+            logged = self.create_log.unsynced if self.create_log else 0
+            rv = self._handle(handler, token, data, id=id, client_id=client_id)
+
+            # a queued submission is acked once it's synced to the create log, the writes behind it wait their turn
+            if mtype in ['indicators_create', 'indicators_delete'] and self.create_log and \
+                    (self.create_acks or self.create_log.unsynced > logged):
+                self.create_acks.append((time.time(), id, client_id, mtype, token, rv))
+                return
+
+        self._reply(id, client_id, mtype, token, rv)
+
+    def _ack_creates(self):
+        if not self.create_acks:
+            return
+
+        try:
+            self.create_log.sync()
+
+        except Exception as e:
+            # they're still queued, only a crash before the next flush would lose them now
+            logger.error(e)
+            traceback.print_exc()
+
+        acks, self.create_acks = self.create_acks, []
+        for a in acks:
+            self._reply(*a[1:])
+
+    def _handle(self, handler, token, data, **kwargs):
+        err = None
         try:
-            rv = handler(token, data, id=id, client_id=client_id)
+            rv = handler(token, data, **kwargs)
             if rv == MORE_DATA_NEEDED:
                 rv = {"status": "success", "data": 1}
             else:
@@ -260,8 +386,22 @@ class Store(multiprocessing.Process):
         if err:
             rv = {'status': 'failed', 'message': err}
 
+        return rv
+
+    def _reply_raw(self, rv):
+        # a raw search body goes out inside the envelope as it came in, no decode/encode of the feed
+        if rv.get('status') != 'success' or not isinstance(rv.get('data'), basestring):
+            return
+
+        data = es_hits_to_array(rv['data'])
+        if data is None:
+            return
+
+        return '{"status":"success","data":' + data + '}'
+
+    def _reply(self, id, client_id, mtype, token, rv):
         try:
-            data = json.dumps(rv)
+            data = self._reply_raw(rv) or json.dumps(rv)
         except Exception as e:
             logger.error(e)
             traceback.print_exc()
@@ -270,14 +410,35 @@ class Store(multiprocessing.Process):
         token = json.dumps(token)
         Msg(id=id, client_id=client_id, mtype=mtype, token=token, data=data).send(self.router)
 
+    def _queue_reply(self, *args):
+        # zmq sockets aren't thread safe, workers hand their replies to the main loop to send
+        self.search_replies.put(args)
+
+    def _reply_searches(self):
+        # anything a finished worker queued is already in the queue by the time it reads as done
+        done = [f for f in self.searches if f.done()]
+
+        while True:
+            try:
+                self._reply(*self.search_replies.get_nowait())
+            except Empty:
+                break
+
+        self.searches.difference_update(done)
+
     def _flush_create_queue(self):
+        # what a busy store couldn't take stays queued, and logged, for the next flush. a failure that trying
+        # again won't fix, or one that's outlasted its retries, is logged and dropped
+        keep = []
+
         for t in self.create_queue:
             if len(self.create_queue[t]['messages']) == 0:
                 continue
 
             logger.debug('flushing queue...')
-            data = [msg[0] for _, _, msg in self.create_queue[t]['messages']]
+            data = [msg[0] for _, _, msg, _ in self.create_queue[t]['messages']]
             _t = self.create_queue[t]
+            busy = False
 
             try:
                 start_time = time.time()
@@ -323,6 +484,7 @@ class Store(multiprocessing.Process):
                     self._timestamps_fix(i)
 
                 n = self.store.indicators.upsert(_t, data)
+                self._changed(n, data)
 
                 t_time = time.time() - start_time
                 logger.info('actually inserted %d indicators.. took %0.2f seconds (%0.2f/sec)', n, t_time, (n / t_time))
@@ -337,14 +499,95 @@ class Store(multiprocessing.Process):
 
             except StoreLockError:
                 rv = {'status': 'failed', 'message': 'busy'}
+                busy = True
+
+            except Exception as e:
+                logger.error(e)
+                traceback.print_exc()
+                rv = {'status': 'failed', 'message': 'unknown failure'}
 
-            for id, client_id, _ in self.create_queue[t]['messages']:
+            for id, client_id, _, _ in self.create_queue[t]['messages']:
                 Msg(id=id, client_id=client_id, mtype=Msg.INDICATORS_CREATE, data=rv)
 
+            _t['attempts'] = _t.get('attempts', 0) + 1 if busy else 0
+            if busy and _t['attempts'] < int(self.create_queue_retries):
+                keep.extend(r for _, _, _, r in _t['messages'])
+            else:
+                if rv['status'] != 'success':
+                    logger.error('dropping %d queued indicators from %s: %s', len(data), _t.get('username'),
+                                 rv['message'])
+
+                _t['messages'] = []
+                _t['bytes'] = 0
+                _t['attempts'] = 0
+
             logger.debug('queue flushed..')
 
+        if self.create_log:
+            self.create_log.truncate(keep)
+
+    def _prune_create_queue(self):
+        for t in list(self.create_queue):
+            # if we've not seen activity in 300s reset the counter, a token with records still waiting on a busy
+            # store keeps its place, they're in the log with nothing else to flush them
+            if self.create_queue[t]['count'] > 0 and not self.create_queue[t]['messages']:
+                if (time.time() - self.create_queue[t]['last_activity']) > self.create_queue_wait:
+                    logger.debug('pruning {} from create_queue'.format(t))
+                    del self.create_queue[t]
+
     def handle_indicators_delete(self, token, data=None, id=None, client_id=None):
-        return self.store.indicators.delete(token, data=data, id=id)
+        rv = self.store.indicators.delete(token, data=data, id=id)
+        self._changed(rv)
+        return rv
+
+    def _change_slots(self, itypes):
+        other = len(FEED_ITYPES)
+        return set(FEED_ITYPES.index(i) if i in FEED_ITYPES else other for i in itypes)
+
+    def _changed(self, n, indicators=None):
+        """
+        moves the change marker of the itypes written
+
+        :param n: indicators written, nothing moves for 0
+        :param indicators: what was written, without it every itype's marker moves
+        """
+        if not n:
+            return
+
+        if indicators is None:
+            slots = range(len(FEED_ITYPES) + 1)
+        else:
+            itypes = []
+            for i in indicators:
+                try:
+                    itypes.append(i.get('itype') or resolve_itype(i.get('indicator')))
+                except Exception:
+                    itypes.append(None)
+
+            slots = self._change_slots(itypes)
+
+        if self.changes_shared is None:
+            for x in slots:
+                self.changes_count[x] += 1
+            return
+
+        with self.changes_shared.get_lock():
+            for x in slots:
+                self.changes_shared[x] += 1
+
+    def changes(self, itype=None):
+        """
+        :param itype: an itype or a list of them, all of them by default
+        :return: a marker that moves with every write of those itypes
+        """
+        counts = self.changes_count if self.changes_shared is None else self.changes_shared[:]
+
+        if itype is None:
+            slots = range(len(counts))
+        else:
+            slots = self._change_slots(itype if isinstance(itype, list) else [itype])
+
+        return '{}.{}'.format(self.changes_id, sum(counts[x] for x in slots))
 
     def handle_indicators_create(self, token, data, id=None, client_id=None, flush=False):
         token_str = token['token']
@@ -396,6 +639,7 @@ class Store(multiprocessing.Process):
                 self._timestamps_fix(i)
 
             n = self.store.indicators.upsert(token, data, flush=flush)
+            self._changed(n, data)
 
             t = time.time() - start_time
             logger.info('actually inserted %d indicators.. took %0.2f seconds (%0.2f/sec)', n, t, (n/t))
@@ -410,62 +654,233 @@ class Store(multiprocessing.Process):
             except (TypeError, binascii.Error) as e:
                 pass
 
+        q = self.create_queue.get(token_str)
+        if q and (len(q['messages']) >= int(self.create_queue_limit) or q['bytes'] >= int(self.create_queue_bytes)):
+            raise StoreLockError('create queue full for {}'.format(token['username']))
+
+        # only the token str goes to disk, it's looked up again on replay
+        record = json.dumps([token_str, data]).encode('utf-8')
+        if self.create_log:
+            self.create_log.append(record)
+
+        self._queue_create(token, data, record, id=id, client_id=client_id)
+
+        return MORE_DATA_NEEDED
+
+    def _queue_create(self, token, data, record, id=None, client_id=None):
+        token_str = token['token']
+
         if not self.create_queue.get(token_str):
-            self.create_queue[token_str] = {'count': 0, "messages": []}
+            self.create_queue[token_str] = {'count': 0, "messages": [], 'bytes': 0}
             for k in token:
                 self.create_queue[token_str][k] = token[k]
 
         self.create_queue[token_str]['count'] += 1
         self.create_queue_count += 1
         self.create_queue[token_str]['last_activity'] = time.time()
+        self.create_queue[token_str]['bytes'] += len(record)
 
-        self.create_queue[token_str]['messages'].append((id, client_id, [data]))
-
-        return MORE_DATA_NEEDED
+        self.create_queue[token_str]['messages'].append((id, client_id, [data], record))
 
-    def _log_search(self, t, data):
-        if not data.get('indicator'):
+    def _replay_create_log(self):
+        """
+        queues up whatever an earlier run acked but never upserted, it goes out with the first flush
+        """
+        if not self.create_log_path:
             return
 
+        path = self.create_log_path
+        if self.worker is not None:
+            path = os.path.join(path, str(self.worker))
+
+        self.create_log = CreateLog(path, int(CREATE_QUEUE_SEGMENT))
+
+        n = 0
+        for token, data, record in self._replay_records(self.create_log):
+            self._queue_create(token, data, record)
+            n += 1
+
+        if n:
+            logger.info('replaying %d queued indicators from %s', n, path)
+
+        if self.primary:
+            self._adopt_create_logs()
+
+    def _replay_records(self, log):
+        # each record's token is looked up as it is now, one revoked or without write since takes its records with it
+        tokens = {}
+        for token_str, data in log.replay():
+            if token_str not in tokens:
+                tokens[token_str] = next(iter(self.store.tokens.search({'token': token_str}) or []), None)
+
+            token = tokens[token_str]
+            if not token or not token.get('write'):
+                logger.error('dropping queued indicator %s, its token is gone or can no longer write',
+                             data.get('indicator'))
+                continue
+
+            yield token, data, json.dumps([token_str, data]).encode('utf-8')
+
+    def _adopt_create_logs(self):
+        """
+        takes on the logs no worker of this run will open, left by a run with a different number of workers. they're
+        moved into this store's own log before they're dropped
+        """
+        root = self.create_log_path
+        paths = [os.path.join(root, d) for d in sorted(os.listdir(root), key=lambda d: (len(d), d))
+                 if d.isdigit() and (self.worker is None or int(d) >= int(self.workers or 1))]
+
+        if self.worker is not None:
+            paths.insert(0, root)
+
+        for path in paths:
+            if not os.path.isdir(path):
+                continue
+
+            log = CreateLog(path, int(CREATE_QUEUE_SEGMENT))
+
+            n = 0
+            for token, data, record in self._replay_records(log):
+                self.create_log.append(record)
+                self._queue_create(token, data, record)
+                n += 1
+
+            self.create_log.sync()
+            log.truncate()
+
+            if path != root:
+                try:
+                    os.rmdir(path)
+                except OSError as e:
+                    logger.error(e)
+
+            if n:
+                logger.info('replaying %d queued indicators from %s', n, path)
+
+    def _log_search(self, t, data):
         if data.get('nolog') in ['1', 'True', 1, True]:
             return
 
-        if '*' in data.get('indicator'):
+        # a batch lookup logs all of its indicators in the one upsert
+        indicators = data.get('indicators') or [data.get('indicator')]
+        indicators = [i for i in indicators if i and '*' not in i and '%' not in i]
+        if not indicators:
             return
 
-        if '%' in data.get('indicator'):
+        ts = arrow.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        rv = []
+        for i in indicators:
+            try:
+                s = Indicator(
+                    indicator=i,
+                    tlp='amber',
+                    confidence=10,
+                    tags='search',
+                    provider=t['username'],
+                    firsttime=ts,
+                    lasttime=ts,
+                    reporttime=ts,
+                    group=t['groups'][0],
+                    count=1,
+                )
+            except InvalidIndicator:
+                # a single search still fails on these, one in a batch just comes back empty
+                if 'indicators' not in data:
+                    raise
+                continue
+
+            rv.append(s.__dict__())
+
+        if not rv:
             return
 
-        ts = arrow.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-        s = Indicator(
-            indicator=data['indicator'],
-            tlp='amber',
-            confidence=10,
-            tags='search',
-            provider=t['username'],
-            firsttime=ts,
-            lasttime=ts,
-            reporttime=ts,
-            group=t['groups'][0],
-            count=1,
-        )
-        self.store.indicators.upsert(t, [s.__dict__()])
+        # a store that can't log the search still answers it
+        try:
+            self._changed(self.store.indicators.upsert(t, rv), rv)
+        except Exception as e:
+            logger.error(e)
 
     def handle_indicators_search(self, token, data, **kwargs):
+        self._search_prepare(token, data)
+        return self._search(token, data)
+
+    def _search_streamed(self, data, pop=False):
+        if not isinstance(data, dict):
+            return False
+
+        return strtobool(data.pop('stream', False) if pop else data.get('stream', False))
+
+    def _search_once(self, token, data, reply):
+        reply(self._handle(self._search, token, data))
+
+    def _search_stream(self, token, data, reply):
+        """Sends the results back a page per reply frame, each flagged with whether more are coming
+
+        the last frame is an empty success with more=False, or the failure that cut the stream short
+        """
+        pages = self.store.indicators.search_pages(token, data, page_size=SEARCH_PAGE_SIZE)
+
+        while True:
+            rv = self._handle(self._search_next, token, pages)
+            if rv['status'] != 'success':
+                return reply(rv)
+
+            if rv['data'] is None:
+                break
+
+            rv['more'] = True
+            reply(rv)
+
+        reply({'status': 'success', 'data': [], 'more': False})
+
+    def _search_next(self, token, pages, **kwargs):
+        try:
+            return next(pages, None)
+
+        except InvalidSearch:
+            raise
+
+        except Exception as e:
+            logger.error(e)
+
+            if logger.getEffectiveLevel() == logging.DEBUG:
+                logger.error(traceback.print_exc())
+
+            raise InvalidSearch(': {}'.format(e))
+
+    def _search_prepare(self, token, data, **kwargs):
 
         if PYVERSION == 2:
             if data.get('indicator'):
                 if isinstance(data['indicator'], str):
                     data['indicator'] = unicode(data['indicator'])
 
-        # token acl check
-        if token.get('acl') and token.get('acl') != ['']:
-            if data.get('itype') and data.get('itype') not in token['acl']:
-                raise AuthError('unauthorized to access itype {}'.format(data['itype']))
+        self._search_acl(token, data)
 
-            if not data.get('itype'):
-                data['itype'] = token['acl']
-        
+        self._search_groups(token, data)
+
+        now = arrow.utcnow()
+        if not data.get('reporttime'):
+            if data.get('days'):
+                data['reporttimeend'] = '{0}Z'.format(now.format('YYYY-MM-DDTHH:mm:ss'))
+                now = now.shift(days=-int(data['days']))
+                data['reporttime'] = '{0}Z'.format(now.format('YYYY-MM-DDTHH:mm:ss'))
+
+            if data.get('hours'):
+                data['reporttimeend'] = '{0}Z'.format(now.format('YYYY-MM-DDTHH:mm:ss'))
+                now = now.shift(hours=-int(data['hours']))
+                data['reporttime'] = '{0}Z'.format(now.format('YYYY-MM-DDTHH:mm:ss'))
+        else:
+            if ',' in data.get('reporttime', ''):
+                low, high = data['reporttime'].split(',')
+                data['reporttime'] = low
+                data['reporttimeend'] = high
+            else:
+                data['reporttimeend'] = '{0}Z'.format(now.format('YYYY-MM-DDTHH:mm:ss'))
+
+        self._log_search(token, data)
+
+    def _search_groups(self, token, data):
         # verify group filter matches token permissions
         if data.get('groups') and (not token.get('admin') or token.get('admin') == ''):
             if isinstance(data['groups'], basestring):
@@ -486,31 +901,23 @@ class Store(multiprocessing.Process):
             else:
                 data['groups'] = '{}'
 
-        now = arrow.utcnow()
-        if not data.get('reporttime'):
-            if data.get('days'):
-                data['reporttimeend'] = '{0}Z'.format(now.format('YYYY-MM-DDTHH:mm:ss'))
-                now = now.shift(days=-int(data['days']))
-                data['reporttime'] = '{0}Z'.format(now.format('YYYY-MM-DDTHH:mm:ss'))
+    def _search_acl(self, token, data):
+        # token acl check
+        if token.get('acl') and token.get('acl') != ['']:
+            if data.get('itype') and data.get('itype') not in token['acl']:
+                raise AuthError('unauthorized to access itype {}'.format(data['itype']))
 
-            if data.get('hours'):
-                data['reporttimeend'] = '{0}Z'.format(now.format('YYYY-MM-DDTHH:mm:ss'))
-                now = now.shift(hours=-int(data['hours']))
-                data['reporttime'] = '{0}Z'.format(now.format('YYYY-MM-DDTHH:mm:ss'))
-        else:
-            if ',' in data.get('reporttime', ''):
-                low, high = data['reporttime'].split(',')
-                data['reporttime'] = low
-                data['reporttimeend'] = high
-            else:
-                data['reporttimeend'] = '{0}Z'.format(now.format('YYYY-MM-DDTHH:mm:ss'))
+            if not data.get('itype'):
+                data['itype'] = token['acl']
 
+    def _search(self, token, data, **kwargs):
         s = time.time()
 
-        self._log_search(token, data)
-
         try:
-            x = self.store.indicators.search(token, data)
+            if isinstance(data.get('indicators'), list):
+                x = self.store.indicators.search_batch(token, data)
+            else:
+                x = self.store.indicators.search(token, data)
             logger.debug('done')
         except Exception as e:
             logger.error(e)
@@ -530,6 +937,28 @@ class Store(multiprocessing.Process):
 
     def handle_ping(self, token, data='[]', **kwargs):
         logger.debug('handling ping message')
+
+        # httpd's feed cache asks for the change marker and what its token resolves to, a token that couldn't run
+        # the feed search doesn't get to key a cached one
+        if isinstance(data, dict) and data.get('changes'):
+            if not token.get('read'):
+                raise AuthError('unauthorized to read')
+
+            self._search_acl(token, data)
+
+            # the groups the search will filter on, an admin's aren't narrowed and without a filter aren't applied
+            # at all on elasticsearch, so admin goes in the key as well
+            self._search_groups(token, data)
+            groups = data.get('groups') or token.get('groups') or []
+            if groups == '{}':
+                groups = []
+            elif isinstance(groups, basestring):
+                groups = [g.strip() for g in groups.split(',')]
+
+            return {'changes': self.changes(data.get('itype')), 'groups': sorted(groups),
+                    'admin': bool(token.get('admin')) and token.get('admin') != '',
+                    'acl': sorted(a for a in token.get('acl') or [] if a)}
+
         return self.store.ping()
 
     def handle_tokens_search(self, token, data, **kwargs):
@@ -541,10 +970,14 @@ class Store(multiprocessing.Process):
         return self.store.tokens.create(data, token=token)
 
     def handle_tokens_delete(self, token, data, **kwargs):
-        return self.store.tokens.delete(data)
+        rv = self.store.tokens.delete(data)
+        self.store.tokens.cache_invalidate()
+        return rv
 
     def handle_tokens_edit(self, token, data, **kwargs):
-        return self.store.tokens.edit(data, token=token)
+        rv = self.store.tokens.edit(data, token=token)
+        self.store.tokens.cache_invalidate()
+        return rv
 
     def token_create_admin(self, token=None, groups=['everyone']):
         logger.info('testing for tokens...')
@@ -0,0 +1,132 @@
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+import ujson as json
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct('<II')
+
+
+class CreateLog(object):
+    """
+    single-indicator submissions, appended to memory-mapped segment files until the store has upserted them
+
+    a record is <length, crc32> and its json, written through the mmap of a preallocated segment. nothing is
+    durable until sync(), so a run of appends shares the one msync. replay() hands back what a previous run never
+    got to upsert, stopping at the first torn record of a segment
+
+    :param path: directory to keep the segments in
+    :param segment_size: bytes preallocated per segment
+    """
+    def __init__(self, path, segment_size):
+        self.path = path
+        self.segment_size = segment_size
+        self.unsynced = 0
+        self.current = None
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.segments = sorted(f for f in os.listdir(path) if f.endswith('.log'))
+        self.seq = int(self.segments[-1].split('.')[0]) if self.segments else 0
+
+    def _open(self, size):
+        self.seq += 1
+        name = '{:012d}.log'.format(self.seq)
+
+        f = open(os.path.join(self.path, name), 'w+b')
+        f.truncate(size)
+        os.fsync(f.fileno())
+        self._sync_dir()
+
+        self.segments.append(name)
+        self.current = {'file': f, 'mmap': mmap.mmap(f.fileno(), size), 'size': size, 'offset': 0}
+
+    def _close(self):
+        if not self.current:
+            return
+
+        self.current['mmap'].close()
+        self.current['file'].close()
+        self.current = None
+
+    def _sync_dir(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def append(self, data):
+        """
+        :param data: json encoded record (bytes)
+        """
+        n = HEADER.size + len(data)
+        if not self.current or self.current['offset'] + n > self.current['size']:
+            if self.current:
+                self.sync()
+                self._close()
+
+            # the zeroed header after the last record is what marks the end of a segment
+            self._open(max(self.segment_size, n + HEADER.size))
+
+        c = self.current
+        c['mmap'][c['offset']:c['offset'] + n] = HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff) + data
+        c['offset'] += n
+        self.unsynced += 1
+
+    def sync(self):
+        if self.current and self.unsynced:
+            self.current['mmap'].flush()
+
+        self.unsynced = 0
+
+    def replay(self):
+        """
+        the records left by an earlier run, oldest first
+        """
+        for name in list(self.segments):
+            with open(os.path.join(self.path, name), 'rb') as f:
+                buf = f.read()
+
+            offset = 0
+            while offset + HEADER.size <= len(buf):
+                size, crc = HEADER.unpack_from(buf, offset)
+                data = buf[offset + HEADER.size:offset + HEADER.size + size]
+                if not size or len(data) < size or zlib.crc32(data) & 0xffffffff != crc:
+                    break
+
+                yield json.loads(data)
+                offset += HEADER.size + size
+
+    def truncate(self, keep=None):
+        """
+        drops every record written so far, once the store has upserted them
+
+        :param keep: records (bytes) to carry over, written and synced before the old segments go
+        """
+        old = self.segments
+        self._close()
+        self.segments = []
+        self.unsynced = 0
+
+        for r in keep or []:
+            self.append(r)
+        self.sync()
+
+        for name in old:
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError as e:
+                logger.error(e)
+
+        if old:
+            self._sync_dir()
+
+    def close(self):
+        self.sync()
+        self._close()
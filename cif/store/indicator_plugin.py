@@ -19,6 +19,21 @@ class IndicatorManagerPlugin(object):
     def upsert(self, data):
         raise NotImplementedError
 
+    def search_pages(self, token, filters, page_size=1000):
+        # stores that can't page natively run the whole search and hand it back in slices
+        rv = self.search(token, filters)
+        for x in range(0, len(rv), page_size):
+            yield rv[x:x + page_size]
+
+    def search_batch(self, token, filters):
+        # stores without a batch lookup of their own run a search per indicator
+        filters = dict(filters)
+        rv = {}
+        for i in filters.pop('indicators'):
+            rv[i] = self.search(token, dict(filters, indicator=i))
+
+        return rv
+
     def _check_token_groups(self, t, i):
         if not i.get('group'):
             raise InvalidIndicator('missing group')
@@ -5,6 +5,7 @@ from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
 import sqlite3
 
 from cifsdk.constants import RUNTIME_PATH
@@ -35,6 +36,15 @@ else:
     AUTOFLUSH = True
 
 
+# https://www.sqlite.org/wal.html - lets readers run alongside the writer
+JOURNAL_MODE = os.environ.get('CIF_STORE_SQLITE_JOURNAL_MODE', 'WAL')
+
+# size of the read-only connection pool used by searches, 0 to search on the writer
+READERS = int(os.environ.get('CIF_STORE_SQLITE_READERS', 4))
+
+# ms a connection waits on a lock before giving up with "database is locked"
+BUSY_TIMEOUT = os.environ.get('CIF_STORE_SQLITE_BUSY_TIMEOUT', 5000)
+
 # https://www.sqlite.org/pragma.html#pragma_cache_size
 CACHE_SIZE = os.environ.get('CIF_STORE_SQLITE_CACHE_SIZE', 512000000)  # 256MB
 
@@ -54,13 +64,20 @@ if PYVERSION > 2:
 def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor = dbapi_connection.cursor()
     cursor.execute("PRAGMA foreign_keys=ON")
-    cursor.execute("PRAGMA journal_mode = MEMORY")
+    cursor.execute("PRAGMA journal_mode = {}".format(JOURNAL_MODE))
+    cursor.execute("PRAGMA busy_timeout = {}".format(BUSY_TIMEOUT))
     cursor.execute("PRAGMA synchronous = {}".format(SYNC))
     cursor.execute("PRAGMA temp_store = MEMORY")
     cursor.execute("PRAGMA cache_size = {}".format(CACHE_SIZE))
     cursor.close()
 
 
+def set_sqlite_readonly(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA query_only = ON")
+    cursor.close()
+
+
 class SQLite(Store):
     # http://www.pythoncentral.io/sqlalchemy-orm-examples/
     name = 'sqlite'
@@ -85,12 +102,21 @@ class SQLite(Store):
 
         Base.metadata.create_all(self.engine)
 
+        # searches get their own pool of read-only connections so a long feed pull doesn't hold up the writer
+        # (and vice versa), scoped per thread so the store can hand searches off to workers
+        self.read_handle = self.handle
+        if READERS and self.dbfile != ':memory:':
+            self.read_engine = create_engine(self.path, echo=echo, poolclass=QueuePool, pool_size=READERS,
+                                             connect_args={'check_same_thread': False})
+            event.listen(self.read_engine, 'connect', set_sqlite_readonly)
+            self.read_handle = scoped_session(sessionmaker(bind=self.read_engine, autoflush=False))
+
         self.logger.debug('database path: {}'.format(self.path))
 
-        self.token_cache = kwargs.get('token_cache', {})
+        self.token_cache = kwargs.get('token_cache')
         
         self.tokens = TokenManager(self.handle, self.engine, token_cache=self.token_cache)
-        self.indicators = IndicatorManager(self.handle, self.engine)
+        self.indicators = IndicatorManager(self.handle, self.engine, read_handle=self.read_handle)
 
     def ping(self):
         return True
@@ -1,8 +1,12 @@
 import os
 
 import arrow
-from sqlalchemy import Column, Integer, String, Float, DateTime, UnicodeText, asc, desc, ForeignKey, or_, Index
-from sqlalchemy.orm import relationship, backref, class_mapper, lazyload
+from sqlalchemy import Column, Integer, String, Float, DateTime, UnicodeText, LargeBinary, asc, desc, ForeignKey, \
+    or_, and_, Index, select, func, bindparam, inspect, text, type_coerce, table, column, literal_column, \
+    literal, union_all
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import relationship, backref, class_mapper
 
 from cifsdk.constants import RUNTIME_PATH, PYVERSION
 import ujson as json
@@ -10,14 +14,17 @@ from base64 import b64decode, b64encode
 from csirtg_indicator import resolve_itype
 from csirtg_indicator.exceptions import InvalidIndicator
 from cif.store.indicator_plugin import IndicatorManagerPlugin
+from cif.utils import reverse_fqdn, strtobool
+from cif.constants import SEARCH_BATCH_LIMIT
 from cifsdk.exceptions import InvalidSearch
-import ipaddress
-from .ip import Ip
+from cif.exceptions import StoreLockError
+from .ip import Ip, ip_range, ip_supernets
 from sqlalchemy.ext.declarative import declarative_base
-import re
 import logging
 import time
 from collections import OrderedDict
+from hashlib import sha256
+from datetime import datetime
 
 logger = logging.getLogger('cif.store.sqlite')
 
@@ -25,6 +32,16 @@ DB_FILE = os.path.join(RUNTIME_PATH, 'cif.sqlite')
 REQUIRED_FIELDS = ['provider', 'indicator', 'tags', 'group', 'itype']
 HASH_TYPES = ['sha1', 'sha256', 'sha512', 'md5', 'ssdeep']
 
+# keep IN () lists under SQLITE_MAX_VARIABLE_NUMBER on older sqlite builds
+UPSERT_CHUNK = 500
+
+# batch lookups bind up to 3 params an indicator (a range and an exact match)
+BATCH_CHUNK = 200
+
+# https://www.sqlite.org/fts5.html - free text over message, description and asn_desc
+FTS_TABLE = 'indicators_fts'
+FTS_COLUMNS = ['message', 'description', 'asn_desc']
+
 from cif.httpd.common import VALID_FILTERS
 
 if PYVERSION > 2:
@@ -62,6 +79,9 @@ class Indicator(Base):
     rdata = Column(UnicodeText, index=True)
     count = Column(Integer)
     region = Column(String, index=True)
+    upsert_key = Column(String)
+
+    __table_args__ = (Index('ix_indicators_upsert_key', 'upsert_key', unique=True),)
 
     tags = relationship(
         'Tag',
@@ -135,12 +155,16 @@ class Ipv4(Base):
     id = Column(Integer, primary_key=True)
     ipv4 = Column(Ip, index=True)
     mask = Column(Integer, default=32)
+    range_start = Column(Integer)
+    range_end = Column(Integer)
 
     indicator_id = Column(Integer, ForeignKey('indicators.id', ondelete='CASCADE'))
     indicator = relationship(
         Indicator,
     )
 
+    __table_args__ = (Index('ix_indicators_ipv4_range', 'range_start', 'range_end'),)
+
 
 class Ipv6(Base):
     __tablename__ = 'indicators_ipv6'
@@ -148,18 +172,23 @@ class Ipv6(Base):
     id = Column(Integer, primary_key=True)
     ip = Column(Ip(version=6), index=True)
     mask = Column(Integer, default=64)
+    range_start = Column(LargeBinary(16))
+    range_end = Column(LargeBinary(16))
 
     indicator_id = Column(Integer, ForeignKey('indicators.id', ondelete='CASCADE'))
     indicator = relationship(
         Indicator,
     )
 
+    __table_args__ = (Index('ix_indicators_ipv6_range', 'range_start', 'range_end'),)
+
 
 class Fqdn(Base):
     __tablename__ = 'indicators_fqdn'
 
     id = Column(Integer, primary_key=True)
     fqdn = Column(UnicodeText, index=True)
+    fqdn_rev = Column(UnicodeText, index=True)
 
     indicator_id = Column(Integer, ForeignKey('indicators.id', ondelete='CASCADE'))
     indicator = relationship(
@@ -197,7 +226,7 @@ class Tag(Base):
     id = Column(Integer, primary_key=True)
     tag = Column(String, index=True)
 
-    indicator_id = Column(Integer, ForeignKey('indicators.id', ondelete='CASCADE'))
+    indicator_id = Column(Integer, ForeignKey('indicators.id', ondelete='CASCADE'), index=True)
     indicator = relationship(
         Indicator,
     )
@@ -211,23 +240,98 @@ class Message(Base):
     id = Column(Integer, primary_key=True)
     message = Column(UnicodeText)
 
-    indicator_id = Column(Integer, ForeignKey('indicators.id', ondelete='CASCADE'))
+    indicator_id = Column(Integer, ForeignKey('indicators.id', ondelete='CASCADE'), index=True)
     indicator = relationship(
         Indicator,
     )
 
 
+# one row per indicator (description, asn_desc) plus one per message, all pointing back at indicator_id
+IndicatorFts = table(FTS_TABLE, column('indicator_id'), *[column(c) for c in FTS_COLUMNS])
+
+INDICATOR_FIELDS = [c.name for c in Indicator.__table__.c if c.name not in ['id', 'upsert_key']]
+
+# what search hands back, timestamps come out as the raw stored string and get reformatted in _search_rows
+SEARCH_COLUMNS = [type_coerce(c, String).label(c.name) if isinstance(c.type, DateTime) else c
+                  for c in Indicator.__table__.c if c.name != 'upsert_key']
+SEARCH_TIMESTAMPS = [n for n, c in enumerate(SEARCH_COLUMNS) if c.name.endswith('time')]
+SEARCH_KEYS = [c.name for c in SEARCH_COLUMNS]
+
+
+def _upsert_key(provider, itype, indicator, rdata, tag):
+    # same match the per-indicator SELECT used to make, provider/itype/indicator/rdata and the first tag
+    key = [provider or '', itype or '', indicator or '', rdata or '', tag or '']
+    return sha256('|'.join(key).encode('utf-8')).hexdigest()
+
+
+def _timestamp(ts):
+    if not ts:
+        return arrow.utcnow().naive
+
+    # fast path, Store._timestamps_fix hands us RFC 3339 strings and arrow's parser is slow
+    if isinstance(ts, basestring) and len(ts) == 27 and ts.endswith('Z'):
+        try:
+            return datetime.strptime(ts, '%Y-%m-%dT%H:%M:%S.%fZ')
+        except ValueError:
+            pass
+
+    return arrow.get(ts).to('utc').naive
+
+
+def _format_timestamp(ts):
+    # sqlite DateTime is stored as 'YYYY-MM-DD HH:MM:SS.ffffff', only needs the separator swapped
+    if len(ts) == 26:
+        return ts[:10] + 'T' + ts[11:] + 'Z'
+
+    return arrow.get(ts).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _fts_query(q):
+    # quote each word so user input can't trip the fts5 query syntax, a trailing * stays a prefix search
+    terms = []
+    for t in q.replace('%', '*').split():
+        prefix = t.endswith('*')
+        t = t.strip('*')
+        if not t:
+            continue
+
+        terms.append('"{}"{}'.format(t.replace('"', '""'), '*' if prefix else ''))
+
+    if not terms:
+        raise InvalidSearch('empty search')
+
+    return ' '.join(terms)
+
+
+def _fts_text(message):
+    if isinstance(message, bytes):
+        return message.decode('utf-8', 'replace')
+
+    return message
+
+
+def _chunks(l, n=UPSERT_CHUNK):
+    for x in range(0, len(l), n):
+        yield l[x:x + n]
+
+
 class IndicatorManager(IndicatorManagerPlugin):
 
-    def __init__(self, handle, engine, **kwargs):
+    def __init__(self, handle, engine, read_handle=None, **kwargs):
         super(IndicatorManager, self).__init__(**kwargs)
 
         self.handle = handle
+        self.read_handle = read_handle or handle
+        self.fts = False
         Base.metadata.create_all(engine)
+        self._upgrade(engine)
 
     def to_dict(self, obj):
         d = {}
         for col in class_mapper(obj.__class__).mapped_table.c:
+            if col.name == 'upsert_key':
+                continue
+
             d[col.name] = getattr(obj, col.name)
             if d[col.name] and col.name.endswith('time'):
                 d[col.name] = getattr(obj, col.name).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
@@ -255,7 +359,28 @@ class IndicatorManager(IndicatorManagerPlugin):
     def create(self, token, data):
         return self.upsert(token, data)
 
+    def _filter_ip(self, s, table, i, version, find_relatives=False):
+        start, end, mask = ip_range(i, version)
+
+        if version == 4 and mask < 8:
+            raise InvalidSearch('prefix needs to be >= 8')
+
+        if version == 6 and mask < 32:
+            raise InvalidSearch('prefix needs to be >= 32')
+
+        logger.debug('{} - {}'.format(start, end))
+
+        # the exact ip/CIDR and anything it contains
+        q = and_(table.range_start >= start, table.range_start <= end, table.range_end <= end)
+
+        # plus any CIDR that contains it, a handful of point lookups on (range_start, range_end)
+        if find_relatives:
+            q = or_(q, *[and_(table.range_start == a, table.range_end == b) for a, b in ip_supernets(i, version)])
+
+        return s.join(table).filter(q)
+
     def _filter_indicator(self, filters, s):
+        find_relatives = filters.pop('find_relatives', False)
 
         if not filters.get('indicator'):
             return s
@@ -268,51 +393,25 @@ class IndicatorManager(IndicatorManagerPlugin):
         try:
             itype = resolve_itype(i)
         except InvalidIndicator as e:
-            logger.error(e)
-            s = s.join(Message).filter(Indicator.Message.like('%{}%'.format(i)))
-            return s
+            logger.debug(e)
+            return self._filter_text(s, i)
 
         if itype in ['email']:
             s = s.filter(Indicator.indicator == i)
             return s
 
         if itype == 'ipv4':
-            ip = ipaddress.IPv4Network(i)
-            mask = ip.prefixlen
-
-            if mask < 8:
-                raise InvalidSearch('prefix needs to be >= 8')
-
-            start = str(ip.network_address)
-            end = str(ip.broadcast_address)
-
-            logger.debug('{} - {}'.format(start, end))
-
-            s = s.join(Ipv4).filter(Ipv4.ipv4 >= start)
-            s = s.filter(Ipv4.ipv4 <= end)
-
-            return s
+            return self._filter_ip(s, Ipv4, i, 4, find_relatives)
 
         if itype == 'ipv6':
-            ip = ipaddress.IPv6Network(i)
-            mask = ip.prefixlen
-
-            if mask < 32:
-                raise InvalidSearch('prefix needs to be >= 32')
-
-            start = str(ip.network_address)
-            end = str(ip.broadcast_address)
-
-            logger.debug('{} - {}'.format(start, end))
-
-            s = s.join(Ipv6).filter(Ipv6.ip >= start)
-            s = s.filter(Ipv6.ip <= end)
-            return s
+            return self._filter_ip(s, Ipv6, i, 6, find_relatives)
 
         if itype == 'fqdn':
+            # the domain and any of its subdomains, as a prefix range on the reversed labels
+            rev = reverse_fqdn(i)
             s = s.join(Fqdn).filter(or_(
-                    Fqdn.fqdn.like('%.{}'.format(i)),
-                    Fqdn.fqdn == str(i))
+                    Fqdn.fqdn_rev == rev,
+                    and_(Fqdn.fqdn_rev >= rev + '.', Fqdn.fqdn_rev < rev + '/'))
             )
             return s
 
@@ -326,12 +425,30 @@ class IndicatorManager(IndicatorManagerPlugin):
 
         raise InvalidIndicator
 
+    def _filter_text(self, s, q, col=None):
+        if not self.fts:
+            if col:
+                return s.filter(getattr(Indicator, col).like('%{}%'.format(q)))
+
+            return s.filter(or_(
+                Indicator.description.like('%{}%'.format(q)),
+                Indicator.id.in_(select(Message.indicator_id).where(Message.message.like('%{}%'.format(q))))
+            ))
+
+        target = literal_column(FTS_TABLE)
+        if col:
+            target = IndicatorFts.c[col]
+
+        return s.filter(Indicator.id.in_(
+            select(IndicatorFts.c.indicator_id).where(target.match(_fts_query(q)))
+        ))
+
     def _filter_terms(self, filters, s):
 
         # TODO also you should do for k, v in filters.items():
         # iteritems()?
         for k in filters:
-            if k in ['nolog', 'days', 'hours', 'groups', 'limit']:
+            if k in ['nolog', 'days', 'hours', 'groups', 'limit', 'find_relatives']:
                 continue
 
             if k == 'reporttime':
@@ -363,7 +480,7 @@ class IndicatorManager(IndicatorManagerPlugin):
                 s = s.filter(Indicator.asn == filters[k])
 
             elif k == 'asn_desc':
-                s = s.filter(Indicator.asn_desc.like('%{}%'.format(filters[k])))
+                s = self._filter_text(s, filters[k], 'asn_desc')
 
             elif k == 'cc':
                 s = s.filter(Indicator.cc == filters[k])
@@ -397,15 +514,24 @@ class IndicatorManager(IndicatorManagerPlugin):
         return s
 
     def _filter_sort(self, filters, s):
-        if not filters.get('sort'):
-            return s.order_by(desc(Indicator.reporttime), desc(Indicator.lasttime))
-        else:
-            sort = filters.pop('sort')
+        return s.order_by(*self._sort_columns(filters.pop('sort', None)))
 
-        if isinstance(sort, basestring):
-            sort = [x.strip() for x in sort.split(',')]
-        else:
-            return s.order_by(desc(Indicator.reporttime), desc(Indicator.lasttime))
+    def _filter_dedup(self, s, order):
+        # one row per indicator, the first in the feed's own order, so limit counts unique indicators
+        ranked = s.with_entities(
+            Indicator.id,
+            func.row_number().over(partition_by=Indicator.indicator, order_by=order).label('rank')
+        ).order_by(None).subquery()
+
+        return s.session.query(Indicator).filter(
+            Indicator.id.in_(select(ranked.c.id).where(ranked.c.rank == 1))
+        ).order_by(*order)
+
+    def _sort_columns(self, sort):
+        if not sort or not isinstance(sort, basestring):
+            return [desc(Indicator.reporttime), desc(Indicator.lasttime)]
+
+        sort = [x.strip() for x in sort.split(',')]
 
         # use dict for easy asc/desc lookup later
         filtered_sort = OrderedDict()
@@ -422,26 +548,16 @@ class IndicatorManager(IndicatorManagerPlugin):
                 filtered_sort[col_name] = direction
 
         if len(filtered_sort) == 0:
-            s = s.order_by(desc(Indicator.reporttime), desc(Indicator.lasttime))
-        elif len(filtered_sort) == 1:
-            column_name, direction = list(filtered_sort.items())[0]
-            s = s.order_by(direction(getattr(Indicator, column_name)))
-        elif len(filtered_sort) >=2:
-            col1, col2 = list(filtered_sort.items())[:2]
-            col1_name = col1[0]
-            col1_dir = col1[1]
-            col2_name = col2[0]
-            col2_dir = col2[1]
-            s = s.order_by(col1_dir(getattr(Indicator, col1_name)), col2_dir(getattr(Indicator, col2_name)))
+            return [desc(Indicator.reporttime), desc(Indicator.lasttime)]
 
-        return s
+        return [direction(getattr(Indicator, column_name)) for column_name, direction in filtered_sort.items()]
 
-    def _search(self, filters, token):
+    def _search(self, filters, token, handle=None):
         logger.debug('running search')
 
         myfilters = dict(filters.items())
 
-        s = self.handle().query(Indicator)
+        s = (handle or self.handle)().query(Indicator)
 
         if myfilters.get('sort'):
             s = self._filter_sort(myfilters, s)
@@ -460,13 +576,156 @@ class IndicatorManager(IndicatorManagerPlugin):
         return s
 
     def search(self, token, filters, limit=500):
-        s = self._search(filters, token)
+        dedup = strtobool(filters.pop('dedup', False))
+
+        s = self._search(filters, token, handle=self.read_handle)
 
         limit = filters.pop('limit', limit)
 
-        rv = s.order_by(Indicator.reporttime.desc(), Indicator.lasttime.desc()).limit(limit)
+        s = s.order_by(Indicator.reporttime.desc(), Indicator.lasttime.desc())
 
-        return [self.to_dict(i) for i in rv]
+        if dedup:
+            order = self._sort_columns(filters.get('sort')) + [Indicator.reporttime.desc(), Indicator.lasttime.desc()]
+            s = self._filter_dedup(s, order)
+
+        s = s.limit(limit)
+
+        try:
+            return self._search_rows(s.session, s.with_entities(*SEARCH_COLUMNS))
+        finally:
+            # hand the connection back to the pool, an open read snapshot keeps the WAL from checkpointing
+            if self.read_handle is not self.handle:
+                self.read_handle.remove()
+
+    def _filter_batch(self, s, itype, indicators, limit):
+        # the match _filter_indicator makes for each one, ranked within that indicator's own matches so a domain with
+        # more subdomains than the limit can't crowd the rest of the chunk out
+        order = [desc(Indicator.reporttime), desc(Indicator.lasttime)]
+        matches = union_all(*[
+            self._filter_batch_one(s.order_by(None), itype, i).with_entities(
+                Indicator.id, literal(i).label('lookup'), Indicator.reporttime, Indicator.lasttime).statement
+            for i in indicators
+        ]).subquery()
+
+        ranked = select(
+            matches.c.id,
+            func.row_number().over(partition_by=matches.c.lookup,
+                                   order_by=[desc(matches.c.reporttime), desc(matches.c.lasttime)]).label('rank')
+        ).subquery()
+
+        return s.session.query(Indicator).filter(
+            Indicator.id.in_(select(ranked.c.id).where(ranked.c.rank <= limit))
+        ).order_by(*order)
+
+    def _filter_batch_one(self, s, itype, i):
+        if itype == 'email':
+            return s.filter(Indicator.indicator == i)
+
+        if itype == 'url':
+            return s.join(Url).filter(Url.url == i)
+
+        if itype in HASH_TYPES:
+            return s.join(Hash).filter(Hash.hash == str(i))
+
+        if itype == 'fqdn':
+            rev = reverse_fqdn(i)
+            return s.join(Fqdn).filter(or_(
+                Fqdn.fqdn_rev == rev,
+                and_(Fqdn.fqdn_rev >= rev + '.', Fqdn.fqdn_rev < rev + '/')
+            ))
+
+        table, version = (Ipv4, 4) if itype == 'ipv4' else (Ipv6, 6)
+        start, end, mask = ip_range(i, version)
+        if (version == 4 and mask < 8) or (version == 6 and mask < 32):
+            raise InvalidSearch('prefix needs to be >= {}: {}'.format(8 if version == 4 else 32, i))
+
+        return s.join(table).filter(table.range_start >= start, table.range_start <= end, table.range_end <= end)
+
+    def _batch_matches(self, itype, indicators):
+        # fn(result indicator) -> the looked up indicators it answers
+        if itype == 'fqdn':
+            return lambda x: [i for i in indicators if x.lower() == i.lower() or x.lower().endswith('.' + i.lower())]
+
+        if itype in ['ipv4', 'ipv6']:
+            version = 4 if itype == 'ipv4' else 6
+            ranges = [(i, ip_range(i, version)) for i in indicators]
+
+            def _match(x):
+                start, end, _ = ip_range(x, version)
+                return [i for i, (s, e, _) in ranges if s <= start and end <= e]
+
+            return _match
+
+        return lambda x: [i for i in indicators if x == i]
+
+    def search_batch(self, token, filters):
+        """
+        looks up a set of indicators at once, a query per itype rather than a search per indicator
+
+        :param filters: search filters with 'indicators' (list) in place of 'indicator', limit is per indicator
+        :return: {indicator: [results]}
+        """
+        filters = dict(filters)
+        indicators = filters.pop('indicators')
+        limit = int(filters.pop('limit', SEARCH_BATCH_LIMIT))
+        for k in ['indicator', 'sort', 'dedup', 'find_relatives']:
+            filters.pop(k, None)
+
+        rv = OrderedDict((i, []) for i in indicators)
+
+        itypes = OrderedDict()
+        for i in rv:
+            try:
+                itypes.setdefault(resolve_itype(i), []).append(i)
+            except InvalidIndicator as e:
+                logger.debug(e)
+
+        try:
+            for itype, ii in itypes.items():
+                for chunk in _chunks(ii, BATCH_CHUNK):
+                    s = self._search(dict(filters), token, handle=self.read_handle)
+                    s = self._filter_batch(s, itype, chunk, limit)
+
+                    # a row can answer more than one lookup (example.com and www.example.com), sort them out here
+                    match = self._batch_matches(itype, chunk)
+                    for r in self._search_rows(s.session, s.with_entities(*SEARCH_COLUMNS)):
+                        for i in match(r['indicator']):
+                            if len(rv[i]) < limit:
+                                rv[i].append(r)
+
+        finally:
+            if self.read_handle is not self.handle:
+                self.read_handle.remove()
+
+        return rv
+
+    def _search_rows(self, session, q):
+        # plain column tuples instead of ORM objects, tags and messages are pulled in one IN query per chunk
+        rv = OrderedDict()
+        for row in session.execute(q.statement):
+            if row[0] in rv:
+                continue
+
+            row = list(row)
+            for n in SEARCH_TIMESTAMPS:
+                if row[n]:
+                    row[n] = _format_timestamp(row[n])
+
+            d = dict(zip(SEARCH_KEYS, row))
+            d['tags'] = []
+            d['message'] = []
+            rv[row[0]] = d
+
+        for ids in _chunks(list(rv)):
+            for id, tag in session.execute(select(Tag.indicator_id, Tag.tag)
+                                           .where(Tag.indicator_id.in_(ids)).order_by(Tag.id)):
+                rv[id]['tags'].append(tag)
+
+            for id, message in session.execute(select(Message.indicator_id, Message.message)
+                                               .where(Message.indicator_id.in_(ids)).order_by(Message.id)):
+                rv[id]['message'].append(b64encode(message))
+
+        return list(rv.values())
 
     def delete(self, token, data=None, id=None):
         if type(data) is not list:
@@ -488,201 +747,300 @@ class IndicatorManager(IndicatorManagerPlugin):
 
         s = self.handle().query(Indicator)
         s = s.filter(or_(*ids))
+
+        if self.fts:
+            self.handle().execute(IndicatorFts.delete().where(
+                IndicatorFts.c.indicator_id.in_(s.with_entities(Indicator.id).statement)))
+
         rv = s.delete()
         self.handle().commit()
 
         return rv
 
-    def upsert_indicators(self, s, n, d, token, tmp_added, batch):
-        try:
-            n += 1
-            if not d.get('group'):
-                raise InvalidIndicator('missing group')
+    def _upgrade(self, engine):
+        # create_all() leaves existing tables alone, bring older databases up to the current schema
+        insp = inspect(engine)
+        quote = engine.dialect.identifier_preparer.quote
 
-            if isinstance(d['group'], list):
-                d['group'] = d['group'][0]
+        added = set()
+        with engine.begin() as conn:
+            for t in Base.metadata.sorted_tables:
+                cols = set(c['name'] for c in insp.get_columns(t.name))
+                for c in t.c:
+                    if c.name in cols:
+                        continue
 
-            # raises AuthError if invalid group
-            self._check_token_groups(token, d)
+                    logger.info('adding column {}.{}'.format(t.name, c.name))
+                    conn.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                        quote(t.name), quote(c.name), c.type.compile(dialect=engine.dialect))))
+                    added.add((t.name, c.name))
 
-            if PYVERSION == 2:
-                if isinstance(d['indicator'], str):
-                    d['indicator'] = unicode(d['indicator'])
+            if ('indicators', 'upsert_key') in added:
+                self._upgrade_upsert_key(conn)
 
-            self.test_valid_indicator(d)
+            if ('indicators_ipv4', 'range_start') in added:
+                self._upgrade_ip_range(conn, Ipv4, Ipv4.ipv4, 4)
 
-            tags = d.get("tags", [])
-            if len(tags) > 0:
-                if isinstance(tags, basestring):
-                    tags = tags.split(',')
+            if ('indicators_ipv6', 'range_start') in added:
+                self._upgrade_ip_range(conn, Ipv6, Ipv6.ip, 6)
 
-                del d['tags']
+            if ('indicators_fqdn', 'fqdn_rev') in added:
+                self._upgrade_fqdn_rev(conn)
 
-            i = s.query(Indicator).options(lazyload('*')).filter_by(
-                provider=d['provider'],
-                itype=d['itype'],
-                indicator=d['indicator']
-            ).order_by(Indicator.reporttime.desc(), Indicator.lasttime.desc())
+        for t in Base.metadata.sorted_tables:
+            for idx in t.indexes:
+                idx.create(engine, checkfirst=True)
 
-            if d.get('rdata'):
-                i = i.filter_by(rdata=d['rdata'])
+        self._upgrade_fts(engine, FTS_TABLE in insp.get_table_names())
 
-            if d['itype'] == 'ipv4':
-                match = re.search(r'^(\S+)\/(\d+)$', d['indicator'])  # TODO -- use ipaddress
-                if match:
-                    i = i.join(Ipv4).filter(Ipv4.ipv4 == match.group(1), Ipv4.mask == match.group(2))
-                else:
-                    i = i.join(Ipv4).filter(Ipv4.ipv4 == d['indicator'])
+    def _upgrade_fts(self, engine, exists):
+        if exists:
+            self.fts = True
+            return
 
-            if d['itype'] == 'ipv6':
-                match = re.search(r'^(\S+)\/(\d+)$', d['indicator'])  # TODO -- use ipaddress
-                if match:
-                    i = i.join(Ipv6).filter(Ipv6.ip == match.group(1), Ipv6.mask == match.group(2))
-                else:
-                    i = i.join(Ipv6).filter(Ipv6.ip == d['indicator'])
+        with engine.begin() as conn:
+            try:
+                conn.execute(text('CREATE VIRTUAL TABLE {} USING fts5(indicator_id UNINDEXED, {})'.format(
+                    FTS_TABLE, ', '.join(FTS_COLUMNS))))
+            except OperationalError as e:
+                logger.warning('sqlite built without fts5, falling back to LIKE for text searches: {}'.format(e))
+                return
+
+            logger.info('building {} for existing indicators..'.format(FTS_TABLE))
+            conn.execute(IndicatorFts.insert().from_select(
+                ['indicator_id', 'description', 'asn_desc'],
+                select(Indicator.id, Indicator.description, Indicator.asn_desc)
+                .where(or_(Indicator.description != None, Indicator.asn_desc != None))
+            ))
+
+            rows = [{'indicator_id': id, 'message': _fts_text(m)}
+                    for id, m in conn.execute(select(Message.indicator_id, Message.message))]
+            if rows:
+                conn.execute(IndicatorFts.insert(), rows)
+
+        self.fts = True
+
+    def _upgrade_upsert_key(self, conn):
+        logger.info('generating upsert keys for existing indicators, this may take a while..')
+
+        # tags go in in submission order, the lowest id is the first tag the indicator was created with
+        tag = select(Tag.tag).where(Tag.indicator_id == Indicator.id).order_by(Tag.id).limit(1).scalar_subquery()
+
+        q = select(Indicator.id, Indicator.provider, Indicator.itype, Indicator.indicator, Indicator.rdata, tag) \
+            .order_by(desc(Indicator.reporttime), desc(Indicator.lasttime))
+
+        seen = set()
+        rows = []
+        for id, provider, itype, indicator, rdata, tag in conn.execute(q):
+            key = _upsert_key(provider, itype, indicator, rdata, tag)
+
+            # only the latest record of a set of duplicates gets a key, that's the one we'd have upserted anyway
+            if key in seen:
+                continue
 
-            if d['itype'] == 'fqdn':
-                i = i.join(Fqdn).filter(Fqdn.fqdn == d['indicator'])
+            seen.add(key)
+            rows.append({'_id': id, '_key': key})
 
-            if d['itype'] == 'url':
-                i = i.join(Url).filter(Url.url == d['indicator'])
+        if rows:
+            conn.execute(Indicator.__table__.update().where(Indicator.id == bindparam('_id'))
+                         .values(upsert_key=bindparam('_key')), rows)
 
-            if d['itype'] in HASH_TYPES:
-                i = i.join(Hash).filter(Hash.hash == d['indicator'])
+    def _upgrade_ip_range(self, conn, table, col, version):
+        logger.info('generating ip ranges for existing {} rows..'.format(table.__tablename__))
 
-            if len(tags):
-                i = i.join(Tag).filter(Tag.tag == tags[0])
+        rows = []
+        for id, ip, mask in conn.execute(select(table.id, col, table.mask)):
+            start, end, _ = ip_range('{}/{}'.format(ip, mask), version)
+            rows.append({'_id': id, '_start': start, '_end': end})
 
-            r = i.first()
+        if rows:
+            conn.execute(table.__table__.update().where(table.id == bindparam('_id'))
+                         .values(range_start=bindparam('_start'), range_end=bindparam('_end')), rows)
 
-            if r:
-                if not d.get('lasttime') or d.get('lasttime') == None:
-                    # If no lasttime submitted, presume a lasttime value of now
-                    d['lasttime'] = arrow.utcnow().datetime
+    def _upgrade_fqdn_rev(self, conn):
+        logger.info('generating reversed fqdns for existing rows..')
 
-                if d.get('lasttime') and arrow.get(d['lasttime']).datetime > arrow.get(r.lasttime).datetime:
-                    logger.debug('{} {}'.format(arrow.get(r.lasttime).datetime, arrow.get(d['lasttime']).datetime))
-                    logger.debug('upserting: %s' % d['indicator'])
+        rows = [{'_id': id, '_rev': reverse_fqdn(fqdn)} for id, fqdn in conn.execute(select(Fqdn.id, Fqdn.fqdn))]
 
-                    r.count += 1
-                    r.lasttime = arrow.get(d['lasttime']).datetime.replace(tzinfo=None)
+        if rows:
+            conn.execute(Fqdn.__table__.update().where(Fqdn.id == bindparam('_id'))
+                         .values(fqdn_rev=bindparam('_rev')), rows)
 
-                    if not d.get('reporttime'):
-                        d['reporttime'] = arrow.utcnow().datetime
+    def _upsert_prepare(self, token, d):
+        if not d.get('group'):
+            raise InvalidIndicator('missing group')
 
-                    r.reporttime = arrow.get(d['reporttime']).datetime.replace(tzinfo=None)
+        if isinstance(d['group'], list):
+            d['group'] = d['group'][0]
 
-                    if d.get('message'):
-                        try:
-                            d['message'] = b64decode(d['message'])
-                        except Exception as e:
-                            pass
-                        m = Message(message=d['message'], indicator=r)
-                        s.add(m)
+        # raises AuthError if invalid group
+        self._check_token_groups(token, d)
 
-                else:
-                    logger.debug('skipping: %s' % d['indicator'])
-                    n -= 1
-            else:
-                if tmp_added.get(d['indicator']):
-                    if d.get('lasttime') in tmp_added[d['indicator']]:
-                        logger.debug('skipping: %s' % d['indicator'])
-                        n -= 1
-                        return n
-                else:
-                    tmp_added[d['indicator']] = set()
+        if PYVERSION == 2:
+            if isinstance(d['indicator'], str):
+                d['indicator'] = unicode(d['indicator'])
+
+        self.test_valid_indicator(d)
+
+        tags = d['tags']
+        if isinstance(tags, basestring):
+            tags = tags.split(',')
+
+        row = dict((c, d.get(c)) for c in INDICATOR_FIELDS)
 
-                if not d.get('lasttime'):
-                    d['lasttime'] = arrow.utcnow().datetime.replace(tzinfo=None)
+        row['lasttime'] = _timestamp(d.get('lasttime'))
+        row['reporttime'] = _timestamp(d.get('reporttime'))
+        row['firsttime'] = _timestamp(d['firsttime']) if d.get('firsttime') else row['lasttime']
+        row['count'] = d.get('count') or 1
 
-                if not d.get('reporttime'):
-                    d['reporttime'] = arrow.utcnow().datetime.replace(tzinfo=None)
+        if row['portlist'] is not None:
+            row['portlist'] = str(row['portlist'])
 
-                if PYVERSION == 2:
-                    d['lasttime'] = arrow.get(d['lasttime']).datetime.replace(tzinfo=None)
-                    d['reporttime'] = arrow.get(d['reporttime']).datetime.replace(tzinfo=None)
+        if row['peers'] is not None:
+            row['peers'] = json.dumps(row['peers'])
 
-                if not d.get('firsttime'):
-                    d['firsttime'] = d['lasttime']
+        if row['additional_data'] is not None:
+            row['additional_data'] = json.dumps(row['additional_data'])
 
-                ii = Indicator(**d)
-                logger.debug('inserting: %s' % d['indicator'])
-                s.add(ii)
+        row['upsert_key'] = _upsert_key(row['provider'], row['itype'], row['indicator'], row['rdata'],
+                                        tags[0] if tags else None)
 
-                itype = resolve_itype(d['indicator'])
+        message = d.get('message')
+        if message:
+            try:
+                message = b64decode(message)
+            except Exception as e:
+                pass
 
-                if itype == 'ipv4':
-                    match = re.search(r'^(\S+)\/(\d+)$', d['indicator'])  # TODO -- use ipaddress
-                    if match:
-                        ipv4 = Ipv4(ipv4=match.group(1), mask=match.group(2), indicator=ii)
-                    else:
-                        ipv4 = Ipv4(ipv4=d['indicator'], indicator=ii)
+        return row, tags, message, self._upsert_child(row['indicator'])
 
-                    s.add(ipv4)
+    def _upsert_child(self, indicator):
+        # resolved up front so a bad indicator is skipped on its own instead of failing the batch later
+        itype = resolve_itype(indicator)
 
-                elif itype == 'ipv6':
-                    match = re.search(r'^(\S+)\/(\d+)$', d['indicator']) # TODO -- use ipaddress
-                    if match:
-                        ip = Ipv6(ip=match.group(1), mask=match.group(2), indicator=ii)
-                    else:
-                        ip = Ipv6(ip=d['indicator'], indicator=ii)
+        if itype == 'ipv4':
+            start, end, mask = ip_range(indicator)
+            return Ipv4, {'ipv4': indicator.split('/')[0], 'mask': mask, 'range_start': start, 'range_end': end}
 
-                    s.add(ip)
+        if itype == 'ipv6':
+            start, end, mask = ip_range(indicator, 6)
+            return Ipv6, {'ip': indicator.split('/')[0], 'mask': mask, 'range_start': start, 'range_end': end}
 
-                if itype == 'fqdn':
-                    fqdn = Fqdn(fqdn=d['indicator'], indicator=ii)
-                    s.add(fqdn)
+        if itype == 'fqdn':
+            return Fqdn, {'fqdn': indicator, 'fqdn_rev': reverse_fqdn(indicator)}
 
-                if itype == 'url':
-                    url = Url(url=d['indicator'], indicator=ii)
-                    s.add(url)
+        if itype == 'url':
+            return Url, {'url': indicator}
 
-                if itype in HASH_TYPES:
-                    h = Hash(hash=d['indicator'], indicator=ii)
-                    s.add(h)
+        if itype in HASH_TYPES:
+            return Hash, {'hash': indicator}
 
-                for t in tags:
-                    t = Tag(tag=t, indicator=ii)
-                    s.add(t)
+        return None, None
 
-                if d.get('message'):
-                    try:
-                        d['message'] = b64decode(d['message'])
-                    except Exception as e:
-                        pass
+    def _upsert_batch(self, s, batch):
+        keys = list(batch)
 
-                    m = Message(message=d['message'], indicator=ii)
-                    s.add(m)
+        # resolve what already exists with a handful of IN () lookups rather than a SELECT per indicator
+        existing = {}
+        for chunk in _chunks(keys):
+            q = select(Indicator.upsert_key, Indicator.id, Indicator.lasttime).where(Indicator.upsert_key.in_(chunk))
+            for key, id, lasttime in s.execute(q):
+                existing[key] = (id, lasttime)
 
-                tmp_added[d['indicator']].add(d['lasttime'])
+        n = 0
+        rows = []
+        created = OrderedDict()
+        messages = []
+
+        for key in keys:
+            lasttime = None
+            if key in existing:
+                lasttime = existing[key][1]
+
+            # apply re-submissions within a batch oldest first, as if they'd arrived one at a time
+            row = None
+            for r, tags, message, child in sorted(batch[key], key=lambda x: x[0]['lasttime']):
+                if lasttime is not None and r['lasttime'] <= lasttime:
+                    logger.debug('skipping: %s' % r['indicator'])
+                    continue
+
+                n += 1
+                lasttime = r['lasttime']
+
+                if message:
+                    messages.append((key, message))
+
+                if row is not None:
+                    logger.debug('upserting: %s' % r['indicator'])
+                    row['count'] += 1
+                    row['lasttime'] = r['lasttime']
+                    row['reporttime'] = r['reporttime']
+                    continue
+
+                row = dict(r)
+                if key in existing:
+                    logger.debug('upserting: %s' % r['indicator'])
+                    # on conflict the existing count is bumped by this much
+                    row['count'] = 1
+                else:
+                    logger.debug('inserting: %s' % r['indicator'])
+                    created[key] = (tags, child)
+
+            if row is not None:
+                rows.append(row)
+
+        if not rows:
+            return n
+
+        stmt = sqlite_insert(Indicator.__table__)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Indicator.upsert_key],
+            set_={
+                'count': Indicator.count + stmt.excluded.count,
+                'lasttime': stmt.excluded.lasttime,
+                'reporttime': stmt.excluded.reporttime,
+            },
+            where=(stmt.excluded.lasttime > Indicator.lasttime)
+        )
+        s.execute(stmt, rows)
+
+        ids = dict((key, existing[key][0]) for key in existing)
+        for chunk in _chunks(list(created)):
+            q = select(Indicator.upsert_key, Indicator.id).where(Indicator.upsert_key.in_(chunk))
+            for key, id in s.execute(q):
+                ids[key] = id
+
+        children = OrderedDict()
+        for row in rows:
+            key = row['upsert_key']
+            if key not in created:
+                continue
 
-            # if we're in testing mode, this needs re-attaching since we've manipulated the dict for Indicator()
-            # see test_store_sqlite
-            d['tags'] = ','.join(tags)
+            tags, (table, child) = created[key]
+            if table is not None:
+                child = dict(child)
+                child['indicator_id'] = ids[key]
+                children.setdefault(table, []).append(child)
 
-        except Exception as e:
-            logger.error(e)
-            if batch:
-                logger.debug('Failing batch - passing exception to upper layer')
-                raise
-            else:
-                n -= 1
-                logger.debug('Rolling back individual transaction..')
-                s.rollback()
+            for t in tags:
+                children.setdefault(Tag, []).append({'tag': t, 'indicator_id': ids[key]})
 
-        # When this function is called in non-batch mode, we need to commit each individual indicator at this point.
-        # For batches, the commit happens at a higher layer.
+        fts = []
+        for row in rows:
+            if row['upsert_key'] in created and (row['description'] or row['asn_desc']):
+                fts.append({'indicator_id': ids[row['upsert_key']], 'message': None,
+                            'description': row['description'], 'asn_desc': row['asn_desc']})
 
-        if not batch:
-            try:
-                logger.debug('Committing individual indicator')
-                start = time.time()
-                s.commit()
-            except Exception as e:
-                n -= 1
-                logger.error(e)
-                logger.debug('Rolling back individual transaction..')
-                s.rollback()
+        for key, message in messages:
+            children.setdefault(Message, []).append({'message': message, 'indicator_id': ids[key]})
+            fts.append({'indicator_id': ids[key], 'message': _fts_text(message), 'description': None,
+                        'asn_desc': None})
+
+        for table in children:
+            s.execute(table.__table__.insert(), children[table])
+
+        if self.fts and fts:
+            s.execute(IndicatorFts.insert(), fts)
 
         return n
 
@@ -690,25 +1048,41 @@ class IndicatorManager(IndicatorManagerPlugin):
         if type(data) == dict:
             data = [data]
 
-        s = self.handle()
+        batch = OrderedDict()
+        for d in data:
+            try:
+                row, tags, message, child = self._upsert_prepare(token, d)
+            except Exception as e:
+                logger.error(e)
+                continue
 
-        n = 0
-        tmp_added = {}
+            batch.setdefault(row['upsert_key'], []).append((row, tags, message, child))
+
+        if not batch:
+            return 0
+
+        s = self.handle()
 
         try:
-            for d in data:
-               n = self.upsert_indicators(s, n, d, token, tmp_added, True)
+            n = self._upsert_batch(s, batch)
             logger.debug('committing entire batch')
             start = time.time()
             s.commit()
             logger.debug('done: %0.2f' % (time.time() - start))
+        except OperationalError as e:
+            # nothing was written, the caller keeps the batch to try again
+            logger.error(e)
+            logger.debug('rolling back transaction..')
+            s.rollback()
+
+            if 'locked' in str(e) or 'busy' in str(e):
+                raise StoreLockError(str(e))
+            raise
+
         except Exception as e:
-            n = 0
-            tmp_added = {}
             logger.error(e)
             logger.debug('rolling back transaction..')
             s.rollback()
-            logger.debug('Trying batch again in non-batch mode')
-            for d in data:
-                n = self.upsert_indicators(s, n, d, token, tmp_added, False)
+            return 0
+
         return n
@@ -2,6 +2,7 @@ from sqlalchemy.types import UserDefinedType
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import types
 import socket
+import ipaddress
 
 Base = declarative_base()
 
@@ -13,6 +14,7 @@ class Ip(UserDefinedType):
     # https://github.com/zzzeek/sqlalchemy/blob/master/lib/sqlalchemy/sql/sqltypes.py#L852
 
     impl = types.BINARY(16)
+    cache_ok = True
 
     def __init__(self, version=4):
         self.version = version
@@ -35,11 +37,50 @@ class Ip(UserDefinedType):
         return process
 
     def result_processor(self, dialect, coltype):
+        family = socket.AF_INET
+        if self.version == 6:
+            family = socket.AF_INET6
+
         def process(value):
-            return socket.inet_ntop(value)
+            if value is None:
+                return value
+
+            return socket.inet_ntop(family, value)
 
         return process
 
     @property
     def python_type(self):
-        return self.impl.type.python_type
\ No newline at end of file
+        return self.impl.type.python_type
+
+
+# network bounds are stored as plain integers for v4 and as 16 byte big-endian blobs for v6, sqlite compares
+# blobs with memcmp() so both sort numerically and a (start, end) index turns CIDR matching into range scans
+def _bound(ip, version):
+    if version == 6:
+        return ip.packed
+
+    return int(ip)
+
+
+def ip_network(i, version=4):
+    if version == 6:
+        return ipaddress.IPv6Network(i, strict=False)
+
+    return ipaddress.IPv4Network(i, strict=False)
+
+
+def ip_range(i, version=4):
+    ip = ip_network(i, version)
+    return _bound(ip.network_address, version), _bound(ip.broadcast_address, version), ip.prefixlen
+
+
+def ip_supernets(i, version=4):
+    # every CIDR that could contain i, /0 through i itself
+    ip = ip_network(i, version)
+    rv = []
+    for p in range(ip.prefixlen + 1):
+        n = ip.supernet(new_prefix=p)
+        rv.append((_bound(n.network_address, version), _bound(n.broadcast_address, version)))
+
+    return rv
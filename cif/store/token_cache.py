@@ -0,0 +1,111 @@
+import multiprocessing
+from collections import OrderedDict
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+from cif.constants import TOKEN_CACHE_SIZE
+
+
+class TokenCache(MutableMapping):
+    """
+    token dicts by token str, cached in each process that looks them up
+
+    the entries are the process's own, so a lookup never leaves it. what's shared is a generation counter in shared
+    memory: an edit or delete in any process bumps it, and every process drops its entries the next time it looks
+    and sees it's moved. what a process has touched is kept apart from the entries and outlives the drop, it goes
+    onto the token's fresh copy. entries are handed around by forking, a copy taken before start() shares the counter
+
+    :param size: entries kept, least recently used go first
+    """
+    def __init__(self, size=TOKEN_CACHE_SIZE):
+        self.size = size
+        self.generation = multiprocessing.Value('L', 0)
+        self.seen = 0
+        self.entries = OrderedDict()
+        self.touched = {}
+
+    def _sync(self):
+        g = self.generation.value
+        if g != self.seen:
+            self.entries.clear()
+            self.seen = g
+
+    def __getitem__(self, token_str):
+        self._sync()
+
+        # popped and put back rather than move_to_end(), which py2's OrderedDict doesn't have
+        token_dict = self.entries.pop(token_str)
+        self.entries[token_str] = token_dict
+        return token_dict
+
+    def __setitem__(self, token_str, token_dict):
+        self._sync()
+        if token_str in self.touched:
+            token_dict.update(self.touched[token_str])
+
+        self.entries.pop(token_str, None)
+        self.entries[token_str] = token_dict
+
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def __delitem__(self, token_str):
+        self._sync()
+        del self.entries[token_str]
+        self.touched.pop(token_str, None)
+
+    def __iter__(self):
+        self._sync()
+        return iter(list(self.entries))
+
+    def __len__(self):
+        self._sync()
+        return len(self.entries)
+
+    def __contains__(self, token_str):
+        self._sync()
+        return token_str in self.entries
+
+    def clear(self):
+        self.entries.clear()
+        self.touched.clear()
+
+    def touch(self, token_str, **fields):
+        """
+        updates fields of a cached token, it goes back to the store with the next flush
+        """
+        self[token_str].update(fields)
+        self.touched.setdefault(token_str, {}).update(fields)
+
+    def changed(self, lookup=None):
+        """
+        the tokens this process has touched since it last flushed
+
+        :param lookup: fn(token_str) -> token dict or None, for touched tokens that have since been dropped
+        """
+        self._sync()
+
+        rv = {}
+        for t, fields in self.touched.items():
+            d = self.entries.get(t)
+            if d is None and lookup:
+                d = lookup(t)
+                if d is not None:
+                    d.update(fields)
+
+            if d is not None:
+                rv[t] = d
+
+        return rv
+
+    def invalidate(self):
+        """
+        drops every process's entries, for when a token's been edited or deleted
+        """
+        with self.generation.get_lock():
+            self.generation.value += 1
+
+        self._sync()
@@ -1,5 +1,6 @@
 import arrow
 from cif.constants import TOKEN_CACHE_DELAY, TOKEN_LENGTH
+from cif.store.token_cache import TokenCache
 from cif.utils import strtobool
 from cifsdk.exceptions import AuthError
 import os
@@ -20,7 +21,9 @@ class TokenManagerPlugin(object):
     __metaclass__ = abc.ABCMeta
 
     def __init__(self, *args, **kwargs):
-        self._cache = kwargs.get('token_cache', {})
+        self._cache = kwargs.get('token_cache')
+        if not isinstance(self._cache, TokenCache):
+            self._cache = TokenCache()
         self._cache_check_next = arrow.utcnow().int_timestamp + TOKEN_CACHE_DELAY
 
     @abc.abstractmethod
@@ -44,12 +47,7 @@ class TokenManagerPlugin(object):
         raise NotImplementedError
 
     def _update_token_cache_field(self, token_str, field, new_value):
-        # since self._cache is a mp.Manager.dict, directly updating a nested dict inside
-        # won't propagate. need to re-assign modified nested dict
-        # https://docs.python.org/3.8/library/multiprocessing.html#proxy-objects
-        token_dict = self._cache[token_str]
-        token_dict[field] = new_value
-        self._cache[token_str] = token_dict
+        self._cache.touch(token_str, **{field: new_value})
 
     def _update_last_activity_at(self, token_str, timestamp):
         # internal method and should only be called by auth_search
@@ -64,8 +62,11 @@ class TokenManagerPlugin(object):
     def _flush_cache(self, force=False):
         if force or arrow.utcnow().int_timestamp > self._cache_check_next:
             logger.debug('flushing token cache...')
-            # write cache back to store, where _cache is a dict of dicts with token_strs as keys
-            self.edit(self._cache, bulk=True)
+            # write what this process has touched back to store, a dict of dicts with token_strs as keys. a token
+            # dropped since it was touched is read again so the update goes onto its current copy
+            changed = self._cache.changed(lookup=lambda t: next(iter(self.search({'token': t})), None))
+            if changed:
+                self.edit(changed, bulk=True)
             self._cache.clear()
             self._cache_check_next = arrow.utcnow().int_timestamp + TOKEN_CACHE_DELAY
 
@@ -78,6 +79,10 @@ class TokenManagerPlugin(object):
 
         return self._cache[token_str]
 
+    def cache_invalidate(self):
+        # a token's been edited or deleted, every process looks it up fresh
+        self._cache.invalidate()
+
     def admin_exists(self):
         t = list(self.search({'admin': True}))
         if len(t) > 0:
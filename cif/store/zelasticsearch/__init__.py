@@ -44,7 +44,7 @@ class _ElasticSearch(Store):
 
         self.indicators_prefix = kwargs.get('indicators_prefix', 'indicators')
         self.tokens_prefix = kwargs.get('tokens_prefix', 'tokens')
-        self.token_cache = kwargs.get('token_cache', {})
+        self.token_cache = kwargs.get('token_cache')
 
         logger.info('setting es nodes {}'.format(nodes))
 
@@ -25,8 +25,23 @@ if UPSERT_MODE == '1':
 else:
     UPSERT_MODE = False
 
+# upsert by a doc id derived from UPSERT_MATCH with a scripted merge instead of search-then-write
+UPSERT_ID = os.getenv('CIF_STORE_ES_UPSERT_ID', False)
+if UPSERT_ID == '1':
+    UPSERT_ID = True
+else:
+    UPSERT_ID = False
+
+# existence lookups per _msearch request when upserting a batch
+UPSERT_MSEARCH_CHUNK = 200
+UPSERT_MSEARCH_CHUNK = int(os.getenv('CIF_STORE_ES_UPSERT_MSEARCH_CHUNK', UPSERT_MSEARCH_CHUNK))
+
 PARTITION = os.getenv('CIF_STORE_ES_PARTITION', 'month')
 
+# searches with a reporttime bound name the partitions they need, past this many fall back to the wildcard
+SEARCH_INDICES_MAX = 100
+SEARCH_INDICES_MAX = int(os.getenv('CIF_STORE_ES_SEARCH_INDICES_MAX', SEARCH_INDICES_MAX))
+
 DELETE_FILTERS = os.getenv('CIF_STORE_ES_DELETE_FILTERS', 'id, indicator, provider')
 DELETE_FILTERS = DELETE_FILTERS.split(',')
 DELETE_FILTERS = list(set((x.strip() for x in DELETE_FILTERS)))
@@ -10,6 +10,7 @@ from collections import OrderedDict
 
 from cif.store.zelasticsearch.constants import WINDOW_LIMIT
 from cif.store.zelasticsearch.helpers import cidr_to_range
+from cif.utils import reverse_fqdn
 from cif.httpd.common import VALID_FILTERS
 from cif.store.zelasticsearch.constants import UPSERT_MATCH
 
@@ -168,6 +169,10 @@ def filter_indicator(s, filters, find_relatives=False):
             i = i.replace('%', '*')
 
         if '*' in i:
+            # *.example.com -> prefix on the reversed labels instead of a leading wildcard scan
+            if i.startswith('*.') and '*' not in i[2:] and '?' not in i:
+                return s.filter('prefix', indicator_fqdn_rev='{}.'.format(reverse_fqdn(i[2:])))
+
             return s.query("wildcard", indicator=i)
 
         s = s.query("match", message=i)
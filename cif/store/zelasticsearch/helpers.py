@@ -5,11 +5,24 @@ import socket
 import uuid
 from hashlib import sha256
 import ipaddress
+import arrow
+from cif.utils import reverse_fqdn
+from .constants import UPSERT_MATCH
+
+PARTITION_FORMATS = {
+    'day': 'YYYY.MM.DD',
+    'month': 'YYYY.MM',
+    'year': 'YYYY',
+}
 
 
 def expand_indicator(data):
     itype = resolve_itype(data['indicator'])
-    if itype not in ['ipv4', 'ipv6', 'ssdeep']:
+    if itype not in ['ipv4', 'ipv6', 'fqdn', 'ssdeep']:
+        return
+
+    if itype == 'fqdn':
+        data['indicator_fqdn_rev'] = reverse_fqdn(data['indicator'])
         return
 
     if itype == 'ipv4':
@@ -47,6 +60,25 @@ def expand_indicator(data):
         data['indicator_ssdeep_double_chunk'] = double_chunk
 
 
+def partition_indices(prefix, partition, low, now=None):
+    """Names of the partition indices that can hold a doc with reporttime >= low
+
+    docs are written to the partition of their ingest time and reporttime is never later than that,
+    so it's every partition from the one low falls in up to the current one
+
+    :param prefix: index prefix, eg: indicators
+    :param partition: day, month or year
+    :param low: lower reporttime bound, anything arrow can parse
+    :return: list of index names
+    """
+    fmt = PARTITION_FORMATS[partition]
+
+    now = now or arrow.utcnow()
+    low = min(arrow.get(low).to('utc'), now)
+
+    return ['{}-{}'.format(prefix, dt.format(fmt)) for dt in arrow.Arrow.range(partition, low.floor(partition), now)]
+
+
 def cidr_to_range(cidr):
     try:
         ip = ipaddress.IPv4Network(cidr)
@@ -78,6 +110,26 @@ def _id_deterministic(i):
     return id
 
 
+def _upsert_value(v):
+    if isinstance(v, (list, tuple, set)):
+        return ','.join(sorted(_upsert_value(x) for x in v))
+
+    # 7 and 7.0 are the same confidence
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        return str(float(v))
+
+    if isinstance(v, bytes):
+        return v.decode('utf-8')
+
+    return '{}'.format(v)
+
+
+def i_to_upsert_id(i, fields=UPSERT_MATCH):
+    # same dedup fields -> same doc id, so a resubmission lands on the existing doc without a lookup
+    id = '|'.join('{}={}'.format(f, _upsert_value(i[f]) if i.get(f) else '') for f in sorted(fields))
+    return sha256(id.encode('utf-8')).hexdigest()
+
+
 def i_to_id(i):
     #id = _id_random(i)
     id = _id_deterministic(i)
@@ -1,24 +1,29 @@
 from elasticsearch_dsl import Index
 from elasticsearch import helpers
+from elasticsearch.serializer import Deserializer
 import elasticsearch.exceptions
 from elasticsearch_dsl.connections import connections
 from elasticsearch_dsl.exceptions import IllegalOperation
 from cif.store.indicator_plugin import IndicatorManagerPlugin
 from cif.utils import strtobool
+from cif.constants import SEARCH_BATCH_LIMIT
 from cifsdk.exceptions import AuthError, CIFException, InvalidSearch
 from datetime import datetime, timedelta
 from cifsdk.constants import PYVERSION
 import logging
-from .helpers import expand_indicator, i_to_id
+from .helpers import expand_indicator, i_to_id, i_to_upsert_id, partition_indices, PARTITION_FORMATS
 from .filters import filter_build
-from .constants import LIMIT, WINDOW_LIMIT, TIMEOUT, UPSERT_MODE, PARTITION, \
-    DELETE_FILTERS, UPSERT_MATCH, REQUEST_TIMEOUT, ReIndexError, SHARDS_PER_INDEX
+from .constants import LIMIT, LIMIT_HARD, WINDOW_LIMIT, TIMEOUT, UPSERT_MODE, PARTITION, \
+    DELETE_FILTERS, UPSERT_MATCH, REQUEST_TIMEOUT, ReIndexError, SHARDS_PER_INDEX, UPSERT_MSEARCH_CHUNK, \
+    UPSERT_ID, SEARCH_INDICES_MAX
 from .locks import LockManager
 from .schema import Indicator
 import time
 import os
 import contextlib
+import copy
 import random
+from collections import OrderedDict
 
 logger = logging.getLogger('cif.store.zelasticsearch')
 if PYVERSION > 2:
@@ -26,6 +31,22 @@ if PYVERSION > 2:
 
 UPSERT_TRACE = strtobool(os.environ.get('CIF_STORE_ES_UPSERT_TRACE', False))
 
+# merge a resubmission into the existing doc, or leave it alone (noop) if it isn't newer
+UPSERT_SCRIPT = """
+if (ctx._source.lasttime == null || params.lasttime.compareTo(ctx._source.lasttime) > 0) {
+    ctx._source.count = (ctx._source.count == null ? 0 : ctx._source.count) + params.count;
+    ctx._source.lasttime = params.lasttime;
+    ctx._source.reporttime = params.reporttime;
+    if (params.message != null) {
+        if (ctx._source.message == null) { ctx._source.message = []; }
+        ctx._source.message.add(params.message);
+    }
+    if (params.description != null) { ctx._source.description = params.description; }
+} else {
+    ctx.op = 'none';
+}
+"""
+
 class IndicatorManager(IndicatorManagerPlugin):
     class Deserializer(object):
         def __init__(self):
@@ -43,6 +64,12 @@ class IndicatorManager(IndicatorManagerPlugin):
         self.last_index_check = datetime.now() - timedelta(minutes=5)
         self.last_index_value = None
         self.handle = connections.get_connection()
+
+        # the same client, connection pool and settings, but search bodies come back undecoded so they can be
+        # passed through to the caller
+        self.raw_handle = copy.copy(self.handle)
+        self.raw_handle.transport = copy.copy(self.handle.transport)
+        self.raw_handle.transport.deserializer = Deserializer({'application/json': self.Deserializer()})
         self.lockm = LockManager(self.handle, logger)
 
         self._create_index()
@@ -131,32 +158,57 @@ class IndicatorManager(IndicatorManagerPlugin):
         self.last_index_value = idx
         return idx
 
+    def _search_index(self, filters):
+        wildcard = '{}-*'.format(self.indicators_prefix)
+
+        # no lower reporttime bound (days/hours are turned into one by the store), every partition is fair game
+        if not filters.get('reporttime') or self.partition not in PARTITION_FORMATS:
+            return wildcard
+
+        try:
+            indices = partition_indices(self.indicators_prefix, self.partition, filters['reporttime'])
+        except Exception as e:
+            logger.debug('unable to work out partitions for reporttime {}: {}'.format(filters['reporttime'], e))
+            return wildcard
+
+        if len(indices) > SEARCH_INDICES_MAX:
+            return wildcard
+
+        return indices
+
     def search(self, token, filters, raw=False, sindex=False, timeout=TIMEOUT, 
                find_relatives=False):
         limit = filters.get('limit', LIMIT)
+        dedup = strtobool(filters.pop('dedup', False))
 
         # search a given index - used in upserts
         if sindex:
             s = Indicator.search(index=sindex)
             find_relatives=False # don't find indicator relatives in upsert searches
         else:
-            s = Indicator.search(index='{}-*'.format(self.indicators_prefix))
+            s = Indicator.search(index=self._search_index(filters))
             # in non-upsert searches, permit finding relatives
             find_relatives = filters.get('find_relatives', False)
 
         s = s.params(size=limit, timeout=timeout, request_timeout=REQUEST_TIMEOUT)
 
+        # a named partition in the reporttime range may never have been created
+        if not sindex:
+            s = s.params(ignore_unavailable=True)
+
         s = filter_build(s, filters, token=token, find_relatives=find_relatives, 
             narrow_query=sindex)
 
+        # the top hit per indicator by the search's own sort, so limit counts unique indicators
+        if dedup:
+            s = s.extra(collapse={'field': 'indicator'})
+
         #logger.debug(s.to_dict())
 
         start = time.time()
         try:
-            es = connections.get_connection(s._using)
-            old_serializer = es.transport.deserializer
-
             if raw:
+                es = connections.get_connection(s._using)
                 rv = es.search(
                     index=s._index,
                     doc_type=s._doc_type,
@@ -166,27 +218,22 @@ class IndicatorManager(IndicatorManagerPlugin):
                     )
 
             else:
-                es.transport.deserializer = self.Deserializer()
-
-                rv = es.search(
+                # the body comes back as the str elasticsearch sent, the store splices it into the reply as is
+                rv = self.raw_handle.search(
                     index=s._index,
                     doc_type=s._doc_type,
                     body=s.to_dict(),
                     filter_path=['hits.hits._source'],
                     **s._params,
                     error_trace=UPSERT_TRACE)
-                # transport caches this, so the tokens mis-fire
-                es.transport.deserializer = old_serializer
 
         except elasticsearch.exceptions.RequestError as e:
             logger.error(e)
-            es.transport.deserializer = old_serializer
             return
         
         except elasticsearch.exceptions.TransportError as e:
             logger.error('Error {} on indicator search by user {} with query params {}'.format(
                 e, token.get('username'), s.to_dict()))
-            es.transport.deserializer = old_serializer
             err = 'search criteria created an error condition for elasticsearch'
             if e.status_code == 503 and 'sort' in s.to_dict().keys():
                 err += ', possibly related to sort params'
@@ -195,13 +242,161 @@ class IndicatorManager(IndicatorManagerPlugin):
         # catch all other es errors
         except elasticsearch.ElasticsearchException as e:
             logger.error(e)
-            es.transport.deserializer = old_serializer
             return
 
         logger.debug('query took: %0.2f' % (time.time() - start))
 
         return rv
 
+    def search_pages(self, token, filters, page_size=1000, timeout=TIMEOUT):
+        # search_after on the sort keys, with _uid breaking ties, so only one page is ever held in memory and
+        # the feed isn't bound by WINDOW_LIMIT. no point-in-time on 5.x, docs written mid-stream can shift pages
+        limit = min(int(filters.get('limit', LIMIT)), int(LIMIT_HARD))
+        page_size = min(int(page_size), int(WINDOW_LIMIT))
+
+        filters = dict(filters)
+        filters['limit'] = page_size
+
+        # collapse can't be combined with search_after, the indicators already sent are tracked here instead
+        seen = set() if strtobool(filters.pop('dedup', False)) else None
+
+        s = Indicator.search(index=self._search_index(filters))
+        s = filter_build(s, filters, token=token, find_relatives=filters.get('find_relatives', False))
+        s = s.sort(*(s._sort + ['_uid']))
+
+        es = connections.get_connection(s._using)
+
+        n = 0
+        search_after = None
+        while n < limit:
+            size = min(page_size, limit - n)
+
+            body = s.to_dict()
+            body['size'] = size
+            if search_after:
+                body['search_after'] = search_after
+
+            try:
+                rv = es.search(index=s._index, doc_type=s._doc_type, body=body, timeout=timeout,
+                               request_timeout=REQUEST_TIMEOUT, ignore_unavailable=True,
+                               filter_path=['hits.hits._source', 'hits.hits.sort'])
+
+            except elasticsearch.exceptions.TransportError as e:
+                logger.error('Error {} on paged indicator search by user {} with query params {}'.format(
+                    e, token.get('username'), body))
+                raise InvalidSearch(': search criteria created an error condition for elasticsearch')
+
+            hits = rv.get('hits', {}).get('hits', [])
+            if not hits:
+                return
+
+            search_after = hits[-1]['sort']
+
+            docs = []
+            for h in hits:
+                if seen is not None:
+                    if h['_source']['indicator'] in seen:
+                        continue
+                    seen.add(h['_source']['indicator'])
+
+                docs.append(h['_source'])
+
+            docs = docs[:limit - n]
+            n += len(docs)
+
+            if docs:
+                yield docs
+
+            if len(hits) < size:
+                return
+
+    def search_batch(self, token, filters, timeout=TIMEOUT):
+        """
+        looks up a set of indicators at once, each one's own search sent together in _msearch requests
+
+        :param filters: search filters with 'indicators' (list) in place of 'indicator', limit is per indicator
+        :return: {indicator: [results]}
+        """
+        filters = dict(filters)
+        indicators = filters.pop('indicators')
+        limit = min(int(filters.pop('limit', SEARCH_BATCH_LIMIT)), int(WINDOW_LIMIT))
+        find_relatives = filters.pop('find_relatives', False)
+        filters.pop('dedup', None)
+
+        index = self._search_index(filters)
+        if not isinstance(index, basestring):
+            index = ','.join(index)
+
+        rv = OrderedDict((i, []) for i in indicators)
+        keys = list(rv)
+        for x in range(0, len(keys), UPSERT_MSEARCH_CHUNK):
+            chunk = keys[x:x + UPSERT_MSEARCH_CHUNK]
+
+            body = []
+            for i in chunk:
+                s = Indicator.search(index=index)
+                s = filter_build(s, dict(filters, indicator=i), token=token, find_relatives=find_relatives)
+
+                q = s.to_dict()
+                q['size'] = limit
+                q['timeout'] = timeout
+                body.append({'index': index, 'type': 'indicator', 'ignore_unavailable': True})
+                body.append(q)
+
+            try:
+                # no filter_path, a response with no hits could be dropped from the list and throw the zip off
+                resp = self.handle.msearch(body=body, request_timeout=REQUEST_TIMEOUT)
+
+            except elasticsearch.exceptions.TransportError as e:
+                logger.error('Error {} on batch indicator search by user {}'.format(e, token.get('username')))
+                raise InvalidSearch(': search criteria created an error condition for elasticsearch')
+
+            for i, r in zip(chunk, resp['responses']):
+                if r.get('error'):
+                    logger.error('batch lookup of {} failed: {}'.format(i, r['error']))
+                    raise InvalidSearch(': search criteria created an error condition for elasticsearch')
+
+                rv[i] = [h['_source'] for h in r.get('hits', {}).get('hits', [])]
+
+        return rv
+
+    def _upsert_lookup(self, token, index, lookups):
+        # {key: filters} -> {key: hits}, chunked into _msearch requests rather than a _search per key
+        rv = {}
+        keys = list(lookups)
+        for x in range(0, len(keys), UPSERT_MSEARCH_CHUNK):
+            chunk = keys[x:x + UPSERT_MSEARCH_CHUNK]
+
+            body = []
+            for key in chunk:
+                filters = lookups[key]
+                limit = filters.get('limit', LIMIT)
+
+                s = Indicator.search(index=index)
+                s = filter_build(s, filters, token=token, find_relatives=False, narrow_query=index)
+
+                q = s.to_dict()
+                q['size'] = limit
+                q['timeout'] = TIMEOUT
+                body.append({'index': index, 'type': 'indicator'})
+                body.append(q)
+
+            try:
+                resp = self.handle.msearch(body=body, request_timeout=REQUEST_TIMEOUT,
+                                           error_trace=UPSERT_TRACE)
+            except elasticsearch.ElasticsearchException as e:
+                logger.error(e)
+                raise CIFException(e)
+
+            for key, r in zip(chunk, resp['responses']):
+                if r.get('error'):
+                    logger.error('upsert lookup failed: {}'.format(r['error']))
+                    raise CIFException(r['error'])
+
+                rv[key] = r['hits']['hits']
+
+        return rv
+
     def create(self, token, data, raw=False, bulk=False):
         index = self._create_index()
 
@@ -250,7 +445,65 @@ class IndicatorManager(IndicatorManagerPlugin):
 
         return len(actions)
 
+    def upsert_id(self, token, indicators, flush=False):
+        index = self._create_index()
+
+        # newest wins within a batch, same as the search based upsert
+        agg = OrderedDict()
+        for d in sorted(indicators, key=lambda k: k['lasttime'], reverse=True):
+            if d.get('group') and type(d['group']) != list:
+                d['group'] = [d['group']]
+
+            id = i_to_upsert_id(d)
+            if id not in agg:
+                agg[id] = d
+
+        actions = []
+        for id, d in agg.items():
+            if not d.get('count'):
+                d['count'] = 1
+
+            expand_indicator(d)
+
+            actions.append({
+                '_op_type': 'update',
+                '_index': index,
+                '_type': 'indicator',
+                '_id': id,
+                '_retry_on_conflict': 3,
+                'script': {
+                    'lang': 'painless',
+                    'inline': UPSERT_SCRIPT,
+                    'params': {
+                        'count': 1,
+                        'lasttime': d['lasttime'],
+                        'reporttime': d['reporttime'],
+                        'message': d.get('message'),
+                        'description': d.get('description'),
+                    },
+                },
+                'upsert': d,
+            })
+
+        count = 0
+        for ok, item in helpers.streaming_bulk(self.handle, actions, raise_on_error=False):
+            item = item['update']
+            if not ok:
+                logger.error('upsert failed: {}'.format(item.get('error')))
+                continue
+
+            if item.get('result') != 'noop':
+                count += 1
+
+        if flush:
+            self.flush()
+
+        return count
+
     def upsert(self, token, indicators, flush=False):
+        if UPSERT_ID:
+            return self.upsert_id(token, indicators, flush=flush)
+
         if not UPSERT_MODE:
             return self.create_bulk(token, indicators, flush=flush)
 
@@ -293,9 +546,10 @@ class IndicatorManager(IndicatorManagerPlugin):
 
         actions = []
 
-        #self.lockm.lock_aquire()
-        for d in agg:
-            d = agg[d]
+        # look up every aggregated indicator up front, a handful of _msearch round trips per batch
+        lookups = OrderedDict()
+        for key in agg:
+            d = agg[key]
 
             # start assembling search filters
             filters = {'limit': 1}
@@ -316,19 +570,16 @@ class IndicatorManager(IndicatorManagerPlugin):
                     else:
                         filters[x] = d[x]
 
-            # search for existing, return latest record
-            try:
-                # search the current index only
-                filters['sort'] = '-reporttime,-lasttime'
-                rv = self.search(token, filters, raw=True, sindex=index)
-            except Exception as e:
-                logger.error(e)
-                raise e
-            
-            try:
-                rv = rv['hits']['hits']
-            except Exception as e:
-                raise CIFException(e)
+            # search the current index only, return latest record
+            filters['sort'] = '-reporttime,-lasttime'
+            lookups[key] = filters
+
+        existing = self._upsert_lookup(token, index, lookups)
+
+        #self.lockm.lock_aquire()
+        for key in agg:
+            d = agg[key]
+            rv = existing[key]
 
             # Indicator does not exist in results
             if len(rv) == 0:
@@ -18,6 +18,7 @@ class Indicator(DocType):
     indicator_iprange = IpRange() # works for both IPv4 and v6
     indicator_ipv6 = Keyword()
     indicator_ipv6_mask = Integer()
+    indicator_fqdn_rev = Keyword()  # com.example.www, lets *.example.com be a prefix query
     indicator_ssdeep_chunksize = Integer()
     indicator_ssdeep_chunk = Text(analyzer=ssdeep_analyzer)
     indicator_ssdeep_double_chunk = Text(analyzer=ssdeep_analyzer)
@@ -185,6 +185,7 @@ class TokenManager(TokenManagerPlugin):
                 t.update(data)
                 logger.debug('Updating token with info {}'.format(t))
                 self._cache[token_str] = t
+                self._cache.touch(token_str)
                 logger.debug('Cached token info now {}'.format(self._cache[token_str]))
                 self._flush_cache(force=True)
 
@@ -3,9 +3,15 @@ from dns.resolver import NoAnswer, NXDOMAIN, NoNameservers, Timeout
 from dns.name import EmptyLabel
 from cif.constants import HUNTER_RESOLVER_TIMEOUT
 import logging
+import ujson as json
 
 logger = logging.getLogger(__name__)
 
+# what an elasticsearch search body looks like when it's trimmed with filter_path=['hits.hits._source']
+ES_HITS_PREFIX = '{"hits":{"hits":[{"_source":'
+ES_HITS_SEP = '},{"_source":'
+ES_HITS_SUFFIX = '}]}}'
+
 
 def resolve_ns(data, t='A', timeout=HUNTER_RESOLVER_TIMEOUT):
     resolver = dns.resolver.Resolver()
@@ -43,3 +49,34 @@ def strtobool(val):
         return False
     else:
         raise ValueError('invalid truth value {!r}'.format(val))
+
+
+def reverse_fqdn(fqdn):
+    """
+    reverses the labels of a domain so suffix matching can be done as a prefix match
+    :param fqdn: www.example.com
+    :return: com.example.www
+    """
+    return '.'.join(reversed(fqdn.rstrip('.').lower().split('.')))
+
+
+def es_hits_to_array(body):
+    """
+    cuts the JSON array of _source docs out of a raw hits.hits._source search body without decoding it
+
+    a bare " can't appear inside a JSON string, so "_source": is only ever a key. when every one of them opens a hit
+    the separators are all hit boundaries, a doc with a _source key of its own gets the body decoded instead
+    :param body: {"hits":{"hits":[{"_source":{..}},{"_source":{..}}]}}
+    :return: [{..},{..}], or None if it isn't a hits body
+    """
+    if body == '{}':
+        return '[]'
+
+    if not body.startswith(ES_HITS_PREFIX) or not body.endswith(ES_HITS_SUFFIX):
+        return
+
+    hits = body[len(ES_HITS_PREFIX):-len(ES_HITS_SUFFIX)]
+    if body.count('"_source":') != hits.count(ES_HITS_SEP) + 1:
+        return json.dumps([h['_source'] for h in json.loads(body)['hits']['hits']])
+
+    return '[{}]'.format(hits.replace(ES_HITS_SEP, ','))
@@ -0,0 +1,202 @@
+import logging
+import os
+import threading
+import zlib
+from contextlib import contextmanager
+
+import ujson as json
+import zmq
+from cifsdk.client.plugin import Client
+from cifsdk.client.zeromq import ZMQ, SNDTIMEO, RCVTIMEO, LINGER
+from cifsdk.msg import Msg
+from cifsdk.exceptions import AuthError, CIFBusy, InvalidSearch, TimeoutError
+
+from cif.constants import HTTPD_ROUTER_POOL, PYVERSION
+
+logger = logging.getLogger(__name__)
+
+if PYVERSION > 2:
+    basestring = (str, bytes)
+
+
+class ClientPool(object):
+    """
+    long-lived DEALER connections to one router address, lent out a request at a time
+
+    the router hands a reply back to the connection it came in on, not to a request, so a connection only
+    ever carries one request. one that's been given up on (a timeout, a stream closed early) can still get
+    a reply later, so it's closed rather than handed to the next borrower
+
+    :param remote: router address
+    :param size: max connections, borrowers wait when they're all in use
+    """
+    def __init__(self, remote, size=HTTPD_ROUTER_POOL):
+        self.remote = remote
+        self.size = size
+        self.pid = os.getpid()
+        # its own context, cifsdk clients term the shared instance when they're done with it
+        self.context = zmq.Context()
+        self.free = []
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        s = self.context.socket(zmq.DEALER)
+        s.RCVTIMEO = int(RCVTIMEO)
+        s.SNDTIMEO = int(SNDTIMEO)
+        s.setsockopt(zmq.LINGER, LINGER)
+        s.connect(self.remote)
+        return s
+
+    def get(self):
+        """
+        borrow a connection, every get needs a put
+        """
+        if not self.slots.acquire(timeout=int(RCVTIMEO) / 1000.0):
+            raise TimeoutError('no router connection free')
+
+        try:
+            with self.lock:
+                if self.free:
+                    return self.free.pop()
+
+            return self._connect()
+
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def put(self, s):
+        """
+        hand a connection back, one that's been closed (it may still have a reply coming) is dropped
+        """
+        try:
+            if not s.closed:
+                with self.lock:
+                    self.free.append(s)
+
+        finally:
+            self.slots.release()
+
+    @contextmanager
+    def socket(self):
+        """
+        borrow a connection for the block, close it inside the block to keep it from going back to the pool
+        """
+        s = self.get()
+        try:
+            yield s
+
+        except BaseException:
+            s.close()
+            raise
+
+        finally:
+            self.put(s)
+
+    def close(self):
+        with self.lock:
+            for s in self.free:
+                s.close()
+            self.free = []
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(remote):
+    """
+    the pool for this process and router address, a forked worker gets its own
+    """
+    with _pools_lock:
+        p = _pools.get(remote)
+        if p is None or p.pid != os.getpid():
+            p = _pools[remote] = ClientPool(remote)
+
+        return p
+
+
+class PooledClient(ZMQ):
+    """
+    cifsdk's ZMQ client, sending over a pooled router connection instead of a new socket per client
+    """
+    def __init__(self, remote, token, **kwargs):
+        Client.__init__(self, remote, token)
+
+        self.pool = kwargs.get('pool') or get_pool(remote)
+        self.context = self.pool.context
+        self.socket = None
+        self.autoclose = kwargs.get('autoclose', True)
+        self.nowait = kwargs.get('nowait', False)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # fireball mode still opens a socket of its own
+        if self.socket is not None:
+            self.socket.close()
+
+    def _request(self, s, mtype, data):
+        # the empty frame is the delimiter a REQ socket would have added for us
+        m = Msg(mtype=mtype, token=self.token, data=data).to_list()
+        s.send_multipart([b''] + m)
+
+    def _reply(self, s):
+        try:
+            _, _, data = Msg().recv(s)
+        except zmq.Again:
+            raise TimeoutError('timed out waiting for a reply')
+
+        return data
+
+    def _check(self, data):
+        if data.get('message') == 'unauthorized':
+            raise AuthError()
+
+        if data.get('message') == 'busy':
+            raise CIFBusy()
+
+        if data.get('message', '').startswith('invalid search'):
+            raise InvalidSearch(data['message'])
+
+        if data.get('status') != 'success':
+            raise RuntimeError(data.get('message'))
+
+        return data
+
+    def _send(self, mtype, data='[]', nowait=False, decode=True):
+        with self.pool.socket() as s:
+            self._request(s, mtype, data)
+
+            if self.nowait or nowait:
+                # the reply still comes back, so nobody else can have this connection
+                s.close()
+                logger.debug('not waiting for a resp')
+                return
+
+            data = self._reply(s)
+
+        if not decode:
+            return data
+
+        data = self._check(json.loads(data))
+
+        if data.get('data') is None:
+            raise RuntimeError('invalid response')
+
+        if isinstance(data.get('data'), bool):
+            return data['data']
+
+        # is this a straight up elasticsearch string?
+        if data['data'] == '{}':
+            return []
+
+        if isinstance(data['data'], basestring) and data['data'].startswith('{"hits":{"hits":[{"_source":'):
+            data['data'] = json.loads(data['data'])
+            data['data'] = [r['_source'] for r in data['data']['hits']['hits']]
+
+        try:
+            data['data'] = zlib.decompress(data['data'])
+        except (zlib.error, TypeError):
+            pass
+
+        return data.get('data')
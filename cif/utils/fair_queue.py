@@ -0,0 +1,66 @@
+import time
+from collections import deque
+
+
+class FairQueue(object):
+    """
+    a FIFO per traffic class, handed out by weight
+
+    each round a class gets up to its weight in items, and rounds repeat until the budget is spent or every queue is
+    empty, so a class is only held to its share while the others have work waiting. items of the deadline class that
+    have waited past the deadline go ahead of everything
+
+    :param weights: [(class, weight), ..], in the order classes are served within a round
+    :param budget: items handed out per batch()
+    :param depth: items a class holds before full() says to stop reading for it
+    :param deadline: (class, seconds) or None
+    """
+    def __init__(self, weights, budget=64, depth=10000, deadline=None):
+        self.weights = [(c, max(1, int(w))) for c, w in weights]
+        self.budget = budget
+        self.depth = depth
+        self.deadline = deadline
+        self.queues = dict((c, deque()) for c, _ in self.weights)
+
+    def __len__(self):
+        return sum(len(q) for q in self.queues.values())
+
+    def push(self, c, item):
+        self.queues[c].append((time.time(), item))
+
+    def full(self, c):
+        return len(self.queues[c]) >= self.depth
+
+    def depths(self):
+        return dict((c, len(q)) for c, q in self.queues.items())
+
+    def wait(self, c):
+        """
+        seconds the oldest item of a class has been waiting
+        """
+        q = self.queues[c]
+        return time.time() - q[0][0] if q else 0
+
+    def batch(self):
+        """
+        the next budget's worth of items, in dispatch order
+        """
+        n = 0
+
+        if self.deadline:
+            c, secs = self.deadline
+            q = self.queues[c]
+            cutoff = time.time() - secs
+            while q and n < self.budget and q[0][0] <= cutoff:
+                n += 1
+                yield q.popleft()[1]
+
+        while n < self.budget and len(self):
+            for c, w in self.weights:
+                q = self.queues[c]
+                for _ in range(w):
+                    if not q or n >= self.budget:
+                        break
+
+                    n += 1
+                    yield q.popleft()[1]
@@ -0,0 +1,45 @@
+import ujson as json
+import logging
+from cifsdk.msg import Msg
+
+from cif.utils.client_pool import PooledClient
+
+logger = logging.getLogger(__name__)
+
+
+class SearchClient(PooledClient):
+    """ZMQ client that reads a streamed (stream=1) indicator search back a page at a time
+
+    a REQ socket takes exactly one reply per request, so this talks to the router over a (pooled) DEALER
+    and keeps reading until the store marks the last page
+    """
+    def indicators_search_pages(self, filters):
+        filters = dict(filters)
+        filters['stream'] = 1
+
+        # a stream that's closed before its last page leaves the connection closed with it
+        with self.pool.socket() as s:
+            self._request(s, Msg.INDICATORS_SEARCH, json.dumps(filters))
+
+            more = True
+            while more:
+                data = self._check(json.loads(self._reply(s)))
+                more = data.get('more', False)
+                if data.get('data'):
+                    yield data['data']
+
+    def indicators_search(self, filters, decode=True):
+        return [i for page in self.indicators_search_pages(filters) for i in page]
+
+    def changes(self, itype=None, groups=None):
+        """
+        the store's indicator change marker, and the groups, admin flag and acl the feed search resolves to
+        :param itype: the feed's itype, checked against the token's acl
+        :param groups: the feed's groups filter, narrowed to what the token can read
+        :return: {'changes': '6f1c2a9e.42', 'groups': ['everyone'], 'admin': False, 'acl': []}
+        """
+        with self.pool.socket() as s:
+            self._request(s, Msg.PING, json.dumps({'changes': 1, 'itype': itype, 'groups': groups}))
+            data = self._reply(s)
+
+        return self._check(json.loads(data)).get('data')
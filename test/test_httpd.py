@@ -10,6 +10,7 @@ from cifsdk.constants import PYVERSION
 
 ROUTER_ADDR = 'ipc://{}'.format(tempfile.NamedTemporaryFile().name)
 
+
 @pytest.fixture
 def client(request):
     httpd.app.config['TESTING'] = True
@@ -108,6 +109,7 @@ def test_httpd_feed(client):
     r = json.loads(rv.data.decode('utf-8'))
     assert len(r['data']) == 0
 
+
 def test_httpd_feed_fqdn(client):
     import arrow
     httpd.app.config['feed'] = {}
@@ -154,6 +156,367 @@ def test_httpd_feed_fqdn(client):
     assert len(r['data']) == 1
 
 
+def test_httpd_feed_since(client):
+    import arrow
+    from cif.httpd.views.feed import cursor
+
+    t1 = arrow.utcnow().shift(hours=-2)
+    t2 = arrow.utcnow().shift(hours=-1)
+
+    httpd.app.config['feed'] = {}
+    httpd.app.config['feed']['data'] = [
+        {'indicator': '128.205.1.1', 'confidence': '8', 'tags': ['malware'], 'reporttime': str(t1)},
+        {'indicator': '1.1.1.1', 'confidence': '8', 'tags': ['malware'], 'reporttime': str(t1)},
+        {'indicator': '2.2.2.2', 'confidence': '8', 'tags': ['malware'], 'reporttime': str(t2)},
+    ]
+    httpd.app.config['feed']['wl'] = [
+        {'indicator': '128.205.0.0/16', 'confidence': '8', 'tags': ['whitelist'], 'reporttime': str(t2)},
+    ]
+
+    rv = client.get('/feed?itype=ipv4', headers={'Authorization': 'Token token=1234'})
+    assert rv.status_code == 200
+
+    r = json.loads(rv.data.decode('utf-8'))
+    assert sorted(i['indicator'] for i in r['data']) == ['1.1.1.1', '2.2.2.2']
+    assert cursor.decode(r['cursor']) == cursor.key({'indicator': '2.2.2.2', 'reporttime': str(t2)})
+    assert 'removed' not in r
+
+    # same reporttime as the cursor, the indicator breaks the tie
+    since = cursor.encode(cursor.key({'indicator': '1.1.1.1', 'reporttime': str(t1)}))
+    rv = client.get('/feed?itype=ipv4&since=%s' % since, headers={'Authorization': 'Token token=1234'})
+    assert rv.status_code == 200
+
+    r = json.loads(rv.data.decode('utf-8'))
+    assert [i['indicator'] for i in r['data']] == ['2.2.2.2']
+    assert r['removed'] == ['128.205.0.0/16']
+
+    # nothing new, the cursor stays put
+    rv = client.get('/feed?itype=ipv4&since=%s' % r['cursor'], headers={'Authorization': 'Token token=1234'})
+    r2 = json.loads(rv.data.decode('utf-8'))
+    assert r2['data'] == [] and r2['cursor'] == r['cursor']
+
+    rv = client.get('/feed?itype=ipv4&since=abc', headers={'Authorization': 'Token token=1234'})
+    assert rv.status_code == 400
+
+
 def test_httpd_tokens(client):
     rv = client.get('/tokens', headers={'Authorization': 'Token token=1234'})
-    assert rv.status_code == 200
\ No newline at end of file
+    assert rv.status_code == 200
+
+
+def test_httpd_feed_whitelist_cache():
+    import time
+    from cif.httpd.views.feed import _whitelist_compile
+    from cif.httpd.views.feed.whitelist import WhitelistCache
+
+    fetches = []
+    wl = [{'indicator': 'ex.com'}]
+
+    def _fetch(token, filters):
+        fetches.append(token)
+        return list(wl)
+
+    c = WhitelistCache(_fetch, _whitelist_compile, ttl=60)
+
+    m = c.get('fqdn', '1234', {'days': 45})
+    assert 'a.b.ex.com' in m and 'ex.com' in m and 'badex.com' not in m
+    assert 'www.google.com' in m
+
+    # built once, then served from the cache
+    assert c.get('fqdn', '1234', {'days': 45}) is m
+    assert fetches == ['1234']
+
+    # shared between tokens, one per itype and filters
+    assert c.get('fqdn', '5678', {'days': 45}) is m
+    c.get('fqdn', '5678', {'days': 45, 'groups': 'admin'})
+    assert fetches == ['1234', '5678']
+
+    # a whitelist write rebuilds it in the background, the old one is served until then
+    wl.append({'indicator': 'example.org'})
+    c.invalidate(['fqdn'], delay=0)
+    for _ in range(50):
+        if 'example.org' in c.get('fqdn', '1234', {'days': 45}):
+            break
+        time.sleep(0.01)
+
+    assert 'example.org' in c.get('fqdn', '1234', {'days': 45})
+
+
+def test_httpd_feed_whitelist_url():
+    from cif.httpd.views.feed.url import Url
+
+    data = [{'indicator': i} for i in ['http://example.com/bad', 'http://ex.com/a', 'https://ex.com/b?c=d',
+                                        'http://exx.com/a', 'example.org/path']]
+    wl = [{'indicator': 'http://example.com/bad'}, {'indicator': 'ex.com/'}, {'indicator': 'example.org/other'}]
+
+    assert [x['indicator'] for x in Url().process(data, wl)] == ['http://exx.com/a', 'example.org/path']
+
+
+def test_httpd_feed_cache():
+    import threading
+    import time
+    import zlib
+    from cif.httpd.views.feed.cache import FeedCache
+
+    builds = []
+
+    def _build():
+        builds.append(1)
+        time.sleep(0.05)
+        return '{"message":"success","data":[]}'
+
+    c = FeedCache(ttl=60, size=2)
+    key = c.key({'itype': 'fqdn', 'days': 1}, ['everyone'])
+    assert key == c.key({'days': '1', 'itype': 'fqdn'}, ['everyone'])
+
+    etag = c.etag(key, 'abc.1')
+    assert etag == c.etag(key, 'abc.1')
+    assert etag != c.etag(key, 'abc.2')
+    assert etag != c.etag(c.key({'itype': 'fqdn', 'days': 1}, ['admin']), 'abc.1')
+
+    # concurrent misses share the one build
+    rv = []
+    threads = [threading.Thread(target=lambda: rv.append(c.get(key, etag, _build))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(builds) == 1
+    assert all(b is rv[0] for b in rv)
+    assert zlib.decompress(rv[0].compressed("deflate")) == rv[0].data
+
+    # a write moves the marker, the next pull rebuilds
+    c.get(key, c.etag(key, 'abc.2'), _build)
+    assert len(builds) == 2
+
+
+def test_httpd_feed_ndjson(client):
+    import arrow
+    httpd.app.config['feed'] = {
+        'data': [{'indicator': '1.1.1.1', 'confidence': '8', 'tags': ['malware'], 'reporttime': str(arrow.utcnow())}],
+        'wl': [{'indicator': '2.2.2.2', 'confidence': '8', 'tags': ['whitelist'], 'reporttime': str(arrow.utcnow())}],
+    }
+
+    rv = client.get('/feed?itype=ipv4', headers={'Authorization': 'Token token=1234',
+                                                 'Accept': 'application/x-ndjson'})
+    assert rv.status_code == 200
+    assert rv.is_streamed
+    assert rv.mimetype == 'application/x-ndjson'
+
+    lines = [json.loads(l) for l in rv.data.decode('utf-8').splitlines()]
+    assert [l['indicator'] for l in lines[:-1]] == ['1.1.1.1']
+    assert lines[-1]['message'] == 'success' and lines[-1]['cursor']
+
+
+def test_httpd_stream_encoders():
+    import zlib
+    from cif.httpd.common import stream_json, stream_ndjson, stream_compress
+
+    pages = [[{'indicator': 'example.com'}, {'indicator': 'example.org'}], [], [{'indicator': 'example.net'}]]
+
+    r = json.loads(''.join(stream_json(iter(pages), lambda: {'cursor': 'abc'})))
+    assert r == {'message': 'success', 'data': [i for p in pages for i in p], 'cursor': 'abc'}
+    assert json.loads(''.join(stream_json(iter([])))) == {'message': 'success', 'data': []}
+
+    body = b''.join(stream_compress(stream_ndjson(iter(pages))))
+    assert [json.loads(l) for l in zlib.decompress(body).decode('utf-8').splitlines()] == \
+        [i for p in pages for i in p]
+
+
+def test_httpd_router_pool():
+    import threading
+    import zmq
+    from cif.utils.client_pool import ClientPool, PooledClient
+
+    addr = 'ipc://{}'.format(tempfile.NamedTemporaryFile().name)
+    ctx = zmq.Context()
+    router = ctx.socket(zmq.ROUTER)
+    router.bind(addr)
+
+    seen = set()
+    done = threading.Event()
+
+    def _router():
+        while not done.is_set():
+            if not router.poll(50):
+                continue
+
+            id, null, token, mtype, data = router.recv_multipart()
+            seen.add(id)
+            router.send_multipart([id, null, mtype, json.dumps({'status': 'success', 'data': 'pong'}).encode()])
+
+    t = threading.Thread(target=_router)
+    t.start()
+
+    pool = ClientPool(addr, size=2)
+    rv = []
+    try:
+        threads = [threading.Thread(target=lambda: rv.append(PooledClient(addr, '1234', pool=pool).ping()))
+                   for _ in range(8)]
+        for x in threads:
+            x.start()
+        for x in threads:
+            x.join()
+
+    finally:
+        done.set()
+        t.join()
+        pool.close()
+        router.close()
+        ctx.term()
+
+    # eight requests over at most two connections
+    assert rv == ['pong'] * 8
+    assert 0 < len(seen) <= 2
+
+
+def test_httpd_accept_encoding(client):
+    import gzip
+    import zlib
+    import arrow
+    httpd.app.config['feed'] = {
+        'data': [{'indicator': '1.1.1.1', 'confidence': '8', 'tags': ['malware'], 'reporttime': str(arrow.utcnow())}],
+        'wl': [{'indicator': '2.2.2.2', 'confidence': '8', 'tags': ['whitelist'], 'reporttime': str(arrow.utcnow())}],
+    }
+
+    h = {'Authorization': 'Token token=1234'}
+
+    rv = client.get('/feed?itype=ipv4', headers=dict(h, **{'Accept-Encoding': 'gzip, deflate, br'}))
+    assert rv.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(rv.data))['data'][0]['indicator'] == '1.1.1.1'
+
+    rv = client.get('/feed?itype=ipv4', headers=dict(h, **{'Accept-Encoding': 'gzip;q=0.5, deflate'}))
+    assert rv.headers['Content-Encoding'] == 'deflate'
+    assert json.loads(zlib.decompress(rv.data))['data'][0]['indicator'] == '1.1.1.1'
+
+    rv = client.get('/ping', headers=dict(h, **{'Accept-Encoding': 'gzip'}))
+    assert rv.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in rv.headers['Vary']
+    assert json.loads(gzip.decompress(rv.data))['message'] == 'success'
+
+    rv = client.get('/ping', headers=dict(h, **{'Accept-Encoding': 'br'}))
+    assert 'Content-Encoding' not in rv.headers
+
+
+def test_httpd_indicators_bulk(client):
+    import gzip
+    import threading
+    import zmq
+    from cif.httpd.views import bulk
+
+    lines = [json.dumps({'indicator': 'example{}.com'.format(n), 'tags': 'malware'}) for n in range(5)]
+    lines.insert(2, '{"tags": "malware"}')
+    lines.insert(4, 'not json')
+    body = ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+    h = {'Authorization': 'Token token=1234', 'Content-Type': 'application/x-ndjson'}
+
+    rv = client.post('/indicators/bulk', data=body, headers=h)
+    assert rv.status_code == 201
+
+    r = json.loads(rv.data.decode('utf-8'))['data']
+    assert (r['accepted'], r['rejected'], r['stored']) == (5, 2, 5)
+    assert [e['line'] for e in r['chunks'][0]['errors']] == [3, 5]
+
+    rv = client.post('/indicators/bulk', data=b'not json\n', headers=h)
+    assert rv.status_code == 422
+
+    # through a router, two indicators a chunk
+    addr = 'ipc://{}'.format(tempfile.NamedTemporaryFile().name)
+    ctx = zmq.Context()
+    router = ctx.socket(zmq.ROUTER)
+    router.bind(addr)
+
+    sent = []
+    done = threading.Event()
+
+    def _router():
+        while not done.is_set():
+            if not router.poll(50):
+                continue
+
+            id, null, token, mtype, data = router.recv_multipart()
+            sent.append(len(json.loads(data)))
+            router.send_multipart([id, null, mtype, json.dumps({'status': 'success', 'data': sent[-1]}).encode()])
+
+    t = threading.Thread(target=_router)
+    t.start()
+
+    chunk = bulk.HTTPD_BULK_CHUNK
+    bulk.HTTPD_BULK_CHUNK = 2
+    httpd.app.config['dummy'] = False
+    httpd.app.config['CIF_ROUTER_ADDR'] = addr
+    try:
+        rv = client.post('/indicators/bulk', data=gzip.compress(body), headers=dict(h, **{'Content-Encoding': 'gzip'}))
+
+    finally:
+        bulk.HTTPD_BULK_CHUNK = chunk
+        httpd.app.config['dummy'] = True
+        httpd.app.config['CIF_ROUTER_ADDR'] = ROUTER_ADDR
+        done.set()
+        t.join()
+        router.close()
+        ctx.term()
+
+    assert rv.status_code == 201
+    r = json.loads(rv.data.decode('utf-8'))['data']
+    assert sent == [2, 2, 1]
+    assert [c['stored'] for c in r['chunks']] == [2, 2, 1]
+    assert r['stored'] == 5
+
+
+def test_httpd_indicators_bulk_send_error(client, monkeypatch):
+    import zmq
+    from cif.httpd.views import bulk
+    from cif.utils.client_pool import ClientPool, PooledClient
+    from cifsdk.exceptions import TimeoutError
+
+    lines = [json.dumps({'indicator': 'example{}.com'.format(n), 'tags': 'malware'}) for n in range(5)]
+    body = ('\n'.join(lines) + '\n').encode('utf-8')
+    h = {'Authorization': 'Token token=1234', 'Content-Type': 'application/x-ndjson'}
+
+    def _request(self, s, mtype, data):
+        raise zmq.Again()
+
+    def _get(self):
+        raise TimeoutError('no router connection free')
+
+    monkeypatch.setattr(bulk, 'HTTPD_BULK_CHUNK', 2)
+    monkeypatch.setitem(httpd.app.config, 'dummy', False)
+    monkeypatch.setitem(httpd.app.config, 'CIF_ROUTER_ADDR', 'ipc://{}'.format(tempfile.NamedTemporaryFile().name))
+
+    # the first chunk can't be sent, the rest of the body isn't forwarded and the summary says why
+    for name, fn, err in [('_request', _request, str(zmq.Again())),
+                          ('get', _get, 'no router connection free')]:
+        with monkeypatch.context() as m:
+            m.setattr(PooledClient if name == '_request' else ClientPool, name, fn)
+            rv = client.post('/indicators/bulk', data=body, headers=h)
+
+        assert rv.status_code == 201
+        r = json.loads(rv.data.decode('utf-8'))['data']
+        assert (r['accepted'], r['stored']) == (2, 0)
+        assert len(r['chunks']) == 1
+        assert r['chunks'][0]['error'] == err
+
+
+def test_httpd_search_batch(client):
+    h = {'Authorization': 'Token token=1234'}
+
+    rv = client.post('/search/batch', data=json.dumps(['example.com', ' 192.168.1.1 ', 'example.com']), headers=h)
+    assert rv.status_code == 200
+    assert json.loads(rv.data.decode('utf-8'))['data'] == {'example.com': [], '192.168.1.1': []}
+
+    rv = client.post('/search/batch?limit=5', data=json.dumps({'indicators': ['example.com'], 'tags': 'malware'}),
+                     headers=h)
+    assert rv.status_code == 200
+
+    for body in ['not json', json.dumps({'indicator': 'example.com'}), json.dumps(['example.com', ''])]:
+        rv = client.post('/search/batch', data=body, headers=h)
+        assert rv.status_code == 400
+
+    from cif.httpd.views import search_batch
+    rv = client.post('/search/batch', data=json.dumps(['{}.example.com'.format(n)
+                                                       for n in range(search_batch.HTTPD_SEARCH_BATCH_MAX + 1)]),
+                     headers=h)
+    assert rv.status_code == 400
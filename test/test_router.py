@@ -5,3 +5,148 @@ from cif.router import Router
 def test_router_basics():
     with Router(test=True) as r:
         pass
+
+
+def test_router_shard_address():
+    from cif.router import shard_address
+
+    assert shard_address('ipc:///tmp/store.ipc', 1) == 'ipc:///tmp/store.ipc.1'
+    assert shard_address('tcp://127.0.0.1:5000', 0) == 'tcp://127.0.0.1:5001'
+
+
+def test_router_store_split():
+    import json
+    import time
+    from collections import OrderedDict
+    from cif.router import STORE_WRITE_TIMEOUT
+
+    with Router(test=True, store_workers=4) as r:
+        data = [{'indicator': 'example{}.com'.format(n), 'n': n} for n in range(50)]
+        parts = r._store_split(json.dumps(data))
+        assert len(parts) > 1
+
+        # every indicator lands on the one worker, in the order it was sent
+        for n, p in parts.items():
+            p = json.loads(p)
+            assert all(r._shard(i['indicator']) == n for i in p)
+            assert [i['n'] for i in p] == sorted(i['n'] for i in p)
+
+        assert sorted(i['n'] for p in parts.values() for i in json.loads(p)) == list(range(50))
+
+        one = json.dumps([{'indicator': 'example.com'}, {'indicator': 'example.com', 'tags': 'malware'}])
+        assert r._store_split(one) == {r._shard('example.com'): one}
+
+        # replies fold back into the write they answer, matched on the sequence number it went out under
+        r.store_pending = [OrderedDict() for _ in range(4)]
+        w = {'id': b'f1', 'mtype': b'\x03', 'left': 2, 'data': 0, 'error': None}
+        v = {'id': b'f2', 'mtype': b'\x03', 'left': 1, 'data': 0, 'error': None}
+        r.store_pending[0][b'1'] = (time.time(), w)
+        r.store_pending[3][b'2'] = (time.time(), w)
+        r.store_pending[3][b'3'] = (time.time(), v)
+
+        assert r._store_merge(3, b'3', json.dumps({'status': 'failed', 'message': 'invalid JSON'}))['id'] == b'f2'
+        assert r._store_merge(3, b'2', json.dumps({'status': 'success', 'data': 2})) is None
+        assert r._store_merge(0, b'1', json.dumps({'status': 'success', 'data': 3}))['data'] == 5
+        assert r._store_merge(0, b'1', json.dumps({'status': 'success', 'data': 3})) is None
+
+        # a write a worker never answers fails once it's past the timeout
+        replies = []
+        r._store_reply = replies.append
+        w = {'id': b'f3', 'mtype': b'\x03', 'left': 2, 'data': 0, 'error': None}
+        r.store_pending[1][b'4'] = (time.time() - STORE_WRITE_TIMEOUT - 1, w)
+        r.store_pending[1][b'5'] = (time.time(), v)
+        r.store_pending[2][b'6'] = (time.time(), w)
+        assert r._store_merge(2, b'6', json.dumps({'status': 'success', 'data': 1})) is None
+
+        r._store_expire()
+        assert list(r.store_pending[1]) == [b'5']
+        assert replies == [w] and w['error']['message'] == 'timeout'
+
+    with Router(test=True) as r:
+        assert r.store_workers == 1
+        assert r._shard('example.com') == 0
+
+
+def test_router_fair_queue():
+    import time
+    from cif.router import parse_weights
+    from cif.utils.fair_queue import FairQueue
+
+    w = parse_weights('read:3,hunter:2')
+    assert w == [('read', 3), ('write', 4), ('gatherer', 2), ('hunter', 2)]
+
+    q = FairQueue(w, budget=10, depth=20)
+    for n in range(20):
+        q.push('hunter', ('h', n))
+        q.push('read', ('r', n))
+
+    assert q.full('read') and not q.full('write')
+
+    # a hunter storm still lets reads through at their weight, within the budget
+    x = [c for c, _ in q.batch()]
+    assert x == ['r', 'r', 'r', 'h', 'h', 'r', 'r', 'r', 'h', 'h']
+    assert q.depths() == {'read': 14, 'write': 0, 'gatherer': 0, 'hunter': 16}
+
+    # with nothing else waiting a class gets the whole budget
+    q = FairQueue(w, budget=10)
+    for n in range(15):
+        q.push('hunter', n)
+    assert list(q.batch()) == list(range(10))
+
+    # reads that have waited past the deadline go first
+    q = FairQueue(w, budget=4, deadline=('read', 0.01))
+    q.push('read', 'late')
+    time.sleep(0.02)
+    for n in range(4):
+        q.push('write', n)
+    q.push('read', 'new')
+    assert list(q.batch()) == ['late', 'new', 0, 1]
+
+    with Router(test=True) as r:
+        r.queue.push('gatherer', None)
+        assert r.queue_depths()['gatherer']['depth'] == 1
+
+
+class _Socket(object):
+    def __init__(self):
+        self.sent = []
+
+    def send_multipart(self, m, copy=True):
+        self.sent.append([f.bytes if hasattr(f, 'bytes') else f for f in m])
+
+
+def test_router_forwarding():
+    import msgpack
+    import zmq
+    from cif.router import TAG_FRONTEND, TAG_HUNTER, TAG_INTERNAL
+
+    with Router(test=True) as r:
+        r.store_s, r.frontend_s, r.hunter_sink_s, r.gatherer_s = _Socket(), _Socket(), _Socket(), _Socket()
+        r.internal_s = _Socket()
+        r.hunters = []
+        r.hunter_token_dict = {'username': 'hunter'}
+        r.hunter_token_dict_as_str = '{"username": "hunter"}'
+
+        search = msgpack.packb(4)
+        data = zmq.Frame(b'{"indicator": "example.com"}')
+
+        # requests go to the store with their origin on the id, tokens and data untouched
+        r.handle_message_request([b'c1', b'', b'{"username": "u"}', search, data], TAG_FRONTEND)
+        r.handle_message_backend_request([b'c2', b'', b'1234', search, b'{}'])
+        assert r.store_s.sent[0] == [b'fc1', b'', b'{"username": "u"}', search, b'{"indicator": "example.com"}']
+        assert r.store_s.sent[1][0] == b'hc2' and r.store_s.sent[1][2] == b'{"username": "hunter"}'
+
+        # and the replies find their way back by it
+        r._reply_client(b'fc1', search, zmq.Frame(b'{"status": "success"}'))
+        r._reply_client(b'hc2', search, b'{}')
+        assert r.frontend_s.sent == [[b'c1', b'', search, b'{"status": "success"}']]
+        assert r.hunter_sink_s.sent == [[b'c2', b'', search, b'{}']]
+
+        # httpd's own requests carry a tag of their own, hunters' replies never go their way
+        r.handle_message_backend_request([b'c4', b'', b'1234', search, b'{}'], origin=TAG_INTERNAL)
+        assert r.store_s.sent[2][0] == b'ic4'
+        r._reply_client(b'ic4', search, b'{}')
+        assert r.internal_s.sent == [[b'c4', b'', search, b'{}']]
+
+        r.handle_message_request([b'c3', b'', b'{"username": "u"}', msgpack.packb(2), b'[]'], TAG_FRONTEND)
+        assert r.frontend_s.sent[1][0] == b'c3'
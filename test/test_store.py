@@ -34,3 +34,309 @@ def indicator():
         'lasttime': arrow.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
         'itype': 'fqdn',
     }
+
+
+def test_store_ping_changes(store):
+    t = {'groups': ['everyone', 'admin'], 'read': True}
+
+    x = store.handle_ping(t, {'changes': 1})
+    assert x['groups'] == ['admin', 'everyone']
+
+    store._changed(0)
+    assert store.handle_ping(t, {'changes': 1})['changes'] == x['changes']
+
+    store._changed(2)
+    assert store.handle_ping(t, {'changes': 1})['changes'] != x['changes']
+
+    # search logging writes indicators too, only the marker of the itype written moves
+    x = store.handle_ping(t, {'changes': 1, 'itype': 'fqdn'})
+    y = store.handle_ping(t, {'changes': 1, 'itype': 'ipv4'})
+    store._log_search({'username': 'admin', 'groups': ['everyone']}, {'indicator': 'example.com'})
+    assert store.handle_ping(t, {'changes': 1, 'itype': 'fqdn'})['changes'] != x['changes']
+    assert store.handle_ping(t, {'changes': 1, 'itype': 'ipv4'})['changes'] == y['changes']
+
+    # an acl limited token's marker covers its itypes
+    a = dict(t, acl=['ipv4', 'url'])
+    y = store.handle_ping(a, {'changes': 1})
+    store._changed(1, [{'indicator': 'http://example.com/a'}])
+    assert store.handle_ping(a, {'changes': 1})['changes'] != y['changes']
+
+
+def test_store_ping_changes_auth(store):
+    # a token that can't run the feed search doesn't get a marker to key a cached feed with
+    rv = store._handle(store.handle_ping, {'groups': ['everyone']}, {'changes': 1})
+    assert rv['message'] == 'unauthorized'
+
+    t = {'groups': ['everyone'], 'read': True, 'acl': ['ipv4']}
+    rv = store._handle(store.handle_ping, t, {'changes': 1, 'itype': 'fqdn'})
+    assert rv['message'] == 'unauthorized'
+
+    rv = store._handle(store.handle_ping, t, {'changes': 1, 'itype': 'ipv4'})
+    assert rv['data']['acl'] == ['ipv4']
+
+
+def test_store_ping_changes_groups(store):
+    # the feed is keyed on the groups its search will use, an admin's aren't narrowed to its own
+    t = {'groups': ['everyone'], 'read': True}
+    a = dict(t, admin=True)
+
+    x = store.handle_ping(t, {'changes': 1})
+    y = store.handle_ping(a, {'changes': 1})
+    assert x['groups'] == y['groups'] == ['everyone']
+    assert not x['admin'] and y['admin']
+
+    assert store.handle_ping(t, {'changes': 1, 'groups': 'everyone,admin'})['groups'] == ['everyone']
+    assert store.handle_ping(t, {'changes': 1, 'groups': 'admin'})['groups'] == []
+    assert store.handle_ping(a, {'changes': 1, 'groups': 'admin'})['groups'] == ['admin']
+
+
+def test_store_invalid_json_acked_in_order(store):
+    import time
+
+    # a write still waiting on its ack keeps the error behind it from overtaking it
+    store.create_acks = [(time.time(), b'1', b'c1', 'indicators_create', '1234', {'status': 'success', 'data': 1})]
+    store.handle_message((b'2', b'c2', '1234', 'indicators_create', 'not json'))
+
+    assert [a[2] for a in store.create_acks] == [b'c1', b'c2']
+    assert store.create_acks[1][-1] == {'status': 'failed', 'message': 'invalid JSON'}
+
+def test_store_reply_raw(store):
+    import ujson as json
+
+    docs = [{'indicator': 'example.com', 'description': 'has },{"_source": in it'}, {'indicator': 'example.org'}]
+    body = json.dumps({'hits': {'hits': [{'_source': d} for d in docs]}})
+
+    x = store._reply_raw({'status': 'success', 'data': body})
+    assert json.loads(x) == {'status': 'success', 'data': docs}
+
+    assert json.loads(store._reply_raw({'status': 'success', 'data': '{}'})) == {'status': 'success', 'data': []}
+
+    # a doc carrying an array of objects with _source keys of its own can't be cut at the separators
+    docs.insert(1, {'indicator': 'example.net', 'additional_data': [{'_source': {'a': 1}}, {'_source': {'b': 2}}]})
+    body = json.dumps({'hits': {'hits': [{'_source': d} for d in docs]}})
+    assert json.loads(store._reply_raw({'status': 'success', 'data': body})) == {'status': 'success', 'data': docs}
+
+    # anything that isn't a search body is encoded as usual
+    assert store._reply_raw({'status': 'success', 'data': 'example.com'}) is None
+    assert store._reply_raw({'status': 'success', 'data': [body]}) is None
+    assert store._reply_raw({'status': 'failed', 'message': body}) is None
+
+
+def test_store_create_log():
+    import shutil
+    import ujson as json
+    from cif.store.create_log import CreateLog
+
+    path = tempfile.mkdtemp()
+    try:
+        log = CreateLog(path, 64)
+        for n in range(5):
+            log.append(json.dumps({'n': n}).encode('utf-8'))
+        log.sync()
+        log.close()
+
+        # records spill over into more segments, a torn record ends its segment
+        assert len(os.listdir(path)) > 1
+        last = os.path.join(path, sorted(os.listdir(path))[-1])
+        with open(last, 'r+b') as f:
+            f.seek(9)
+            f.write(b'X')
+
+        log = CreateLog(path, 64)
+        assert [r['n'] for r in log.replay()] == [0, 1, 2, 3]
+
+        log.truncate([json.dumps({'n': 9}).encode('utf-8')])
+        assert [r['n'] for r in CreateLog(path, 64).replay()] == [9]
+
+    finally:
+        shutil.rmtree(path)
+
+
+def test_store_create_queue(indicator):
+    import shutil
+    from cif.exceptions import StoreLockError
+
+    dbfile = tempfile.mktemp()
+    path = tempfile.mkdtemp()
+    t = {'token': '1234', 'username': 'test', 'groups': ['everyone'], 'write': True}
+
+    try:
+        with Store(store_type='sqlite', dbfile=dbfile, create_log=path) as s:
+            s._load_plugin(dbfile=dbfile)
+            s.store.tokens.create(dict(t))
+            s._replay_create_log()
+            s.create_queue_limit = 2
+
+            for n in range(2):
+                i = dict(indicator, indicator='example{}.com'.format(n))
+                assert s.handle_indicators_create(t, [i]) == -2
+
+            # over the token's limit it's turned away as busy
+            with pytest.raises(StoreLockError):
+                s.handle_indicators_create(t, [dict(indicator)])
+
+            s.create_log.sync()
+
+            # the log keeps the token str, not the token
+            assert [tok for tok, _ in s.create_log.replay()] == ['1234', '1234']
+
+        # a restart before the flush picks them back up from the log
+        with Store(store_type='sqlite', dbfile=dbfile, create_log=path) as s:
+            s._load_plugin(dbfile=dbfile)
+            s._replay_create_log()
+            assert s.create_queue_count == 2
+
+            s._flush_create_queue()
+            x = s.store.indicators.search(t, {'indicator': 'example1.com'})
+            assert len(x) == 1
+            assert not list(s.create_log.replay())
+
+    finally:
+        shutil.rmtree(path)
+        if os.path.isfile(dbfile):
+            os.unlink(dbfile)
+
+
+def test_store_create_log_adopt(indicator):
+    import shutil
+    import ujson as json
+    from cif.store.create_log import CreateLog
+
+    dbfile = tempfile.mktemp()
+    path = tempfile.mkdtemp()
+    t = {'token': '1234', 'username': 'test', 'groups': ['everyone'], 'write': True}
+
+    def _left(p, i, token=t['token']):
+        log = CreateLog(p, 4096)
+        log.append(json.dumps([token, dict(indicator, indicator=i)]).encode('utf-8'))
+        log.close()
+
+    try:
+        # left by an unsharded run and by a run with more workers than this one
+        _left(path, 'example1.com')
+        _left(os.path.join(path, '3'), 'example2.com')
+        _left(os.path.join(path, '1'), 'example3.com')
+        # a token that's gone since takes its records with it
+        _left(os.path.join(path, '1'), 'example4.com', token='5678')
+
+        with Store(store_type='sqlite', dbfile=dbfile, create_log=path, worker=0, workers=2) as s:
+            s._load_plugin(dbfile=dbfile)
+            s.store.tokens.create(dict(t))
+            s._replay_create_log()
+            assert s.create_queue_count == 2
+            assert not os.path.exists(os.path.join(path, '3'))
+
+        # back down to one store, the worker logs are its to replay
+        with Store(store_type='sqlite', dbfile=dbfile, create_log=path) as s:
+            s._load_plugin(dbfile=dbfile)
+            s._replay_create_log()
+            assert s.create_queue_count == 3
+
+            s._flush_create_queue()
+            for n in range(1, 4):
+                assert len(s.store.indicators.search(t, {'indicator': 'example{}.com'.format(n)})) == 1
+
+            assert os.listdir(path) == []
+
+    finally:
+        shutil.rmtree(path)
+        if os.path.isfile(dbfile):
+            os.unlink(dbfile)
+
+
+def test_store_create_queue_failed(indicator, monkeypatch):
+    import shutil
+    import sqlite3
+
+    # the plugin's loaded fresh with each store, a locked database fails straight away
+    monkeypatch.setenv('CIF_STORE_SQLITE_BUSY_TIMEOUT', '0')
+
+    dbfile = tempfile.mktemp()
+    path = tempfile.mkdtemp()
+    t = {'token': '1234', 'username': 'test', 'groups': ['everyone'], 'write': True}
+
+    try:
+        with Store(store_type='sqlite', dbfile=dbfile, create_log=path) as s:
+            s._load_plugin(dbfile=dbfile)
+            s.store.tokens.create(dict(t))
+            s._replay_create_log()
+            assert s.handle_indicators_create(t, [dict(indicator)]) == -2
+
+            # another writer holds the database, the upsert fails and the record stays queued and logged
+            db = sqlite3.connect(dbfile)
+            db.execute('BEGIN EXCLUSIVE')
+            s._flush_create_queue()
+            db.rollback()
+            db.close()
+
+            assert s.create_queue_count == 1
+            assert len(list(s.create_log.replay())) == 1
+
+            # an idle token isn't pruned while it has records waiting
+            s.create_queue_wait = -1
+            s._prune_create_queue()
+            assert s.create_queue[t['token']]['messages']
+
+        with Store(store_type='sqlite', dbfile=dbfile, create_log=path) as s:
+            s._load_plugin(dbfile=dbfile)
+            s._replay_create_log()
+            s._flush_create_queue()
+            assert len(s.store.indicators.search(t, {'indicator': 'example.com'})) == 1
+
+            # busy past its retries, or failing in a way another try won't fix, it's dropped
+            s.create_queue_retries = 2
+            assert s.handle_indicators_create(t, [dict(indicator, indicator='example.org')]) == -2
+
+            db = sqlite3.connect(dbfile)
+            db.execute('BEGIN EXCLUSIVE')
+            s._flush_create_queue()
+            assert len(list(s.create_log.replay())) == 1
+            s._flush_create_queue()
+            db.rollback()
+            db.close()
+
+            assert not s.create_queue[t['token']]['messages']
+            assert not list(s.create_log.replay())
+
+            assert s.handle_indicators_create(t, [dict(indicator, indicator='not an indicator')]) == -2
+            s._flush_create_queue()
+            assert not s.create_queue[t['token']]['messages']
+            assert not list(s.create_log.replay())
+
+    finally:
+        shutil.rmtree(path)
+        if os.path.isfile(dbfile):
+            os.unlink(dbfile)
+
+
+def test_store_token_cache():
+    import multiprocessing
+    from cif.store.token_cache import TokenCache
+
+    c = TokenCache(size=2)
+    c['a'] = {'token': 'a'}
+    c['b'] = {'token': 'b'}
+    c['a']
+    c['c'] = {'token': 'c'}
+    assert sorted(c) == ['a', 'c']
+
+    c.touch('a', last_activity_at='2020-01-01T00:00:00.000000Z')
+    assert c.changed() == {'a': {'token': 'a', 'last_activity_at': '2020-01-01T00:00:00.000000Z'}}
+
+    # an edit in another process clears this one's entries
+    p = multiprocessing.Process(target=c.invalidate)
+    p.start()
+    p.join()
+
+    assert 'a' not in c and not c.changed()
+
+    # what this one touched isn't lost with them, it goes onto the fresh copy or one looked up for the flush
+    ts = {'last_activity_at': '2020-01-01T00:00:00.000000Z'}
+    assert c.changed(lookup=lambda t: {'token': t, 'groups': ['everyone']}) == \
+        {'a': dict(ts, token='a', groups=['everyone'])}
+
+    c['a'] = {'token': 'a', 'groups': ['admin']}
+    assert c.changed() == {'a': dict(ts, token='a', groups=['admin'])}
+
+    c.clear()
+    assert not c.changed(lookup=lambda t: {'token': t})
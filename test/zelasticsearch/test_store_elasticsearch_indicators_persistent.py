@@ -359,3 +359,31 @@ def test_search_ssdeep_1_frontend(store, token, indicator_ssdeep_1, indicator_ss
     # ensure it didn't fuzzy match ssdeep_3
     for i in y:
         assert i['indicator'] is not indicator_ssdeep_3.__dict__()['indicator']
+
+# paged searches walk the same hits as a regular search, a page at a time
+@pytest.mark.skipif(DISABLE_TESTS, reason='need to set CIF_ELASTICSEARCH_TEST=1 to run')
+def test_search_pages(store, token):
+    x = store.handle_indicators_search(token, {'itype': 'ipv4', 'nolog': 1})
+    x = json.loads(x)
+    y = sorted(i['_source']['indicator'] for i in x['hits']['hits'])
+    assert len(y) > 2
+
+    pages = list(store.store.indicators.search_pages(token, {'itype': 'ipv4', 'nolog': 1}, page_size=2))
+    assert all(len(p) <= 2 for p in pages)
+    assert sorted(i['indicator'] for p in pages for i in p) == y
+
+    pages = list(store.store.indicators.search_pages(token, {'itype': 'ipv4', 'nolog': 1, 'limit': 3}, page_size=2))
+    assert [len(p) for p in pages] == [2, 1]
+
+# dedup'd searches come back with one hit per indicator
+@pytest.mark.skipif(DISABLE_TESTS, reason='need to set CIF_ELASTICSEARCH_TEST=1 to run')
+def test_search_dedup(store, token):
+    x = json.loads(store.handle_indicators_search(token, {'itype': 'ipv4', 'nolog': 1}))
+    y = set(i['_source']['indicator'] for i in x['hits']['hits'])
+
+    x = json.loads(store.handle_indicators_search(token, {'itype': 'ipv4', 'nolog': 1, 'dedup': 1}))
+    x = [i['_source']['indicator'] for i in x['hits']['hits']]
+    assert sorted(x) == sorted(y)
+
+    pages = store.store.indicators.search_pages(token, {'itype': 'ipv4', 'nolog': 1, 'dedup': 1}, page_size=2)
+    assert sorted(i['indicator'] for p in pages for i in p) == sorted(y)
@@ -0,0 +1,104 @@
+import pytest
+from csirtg_indicator import Indicator
+from elasticsearch_dsl.connections import connections
+from cif.store import Store
+import os
+import arrow
+import ujson as json
+
+DISABLE_TESTS = True
+if os.environ.get('CIF_ELASTICSEARCH_TEST') and os.environ.get('CIF_STORE_ES_UPSERT_ID'):
+    if os.environ['CIF_ELASTICSEARCH_TEST'] == '1' and os.environ['CIF_STORE_ES_UPSERT_ID'] == '1':
+        DISABLE_TESTS = False
+
+
+@pytest.fixture
+def store():
+    try:
+        connections.get_connection().indices.delete(index='indicators-*')
+        connections.get_connection().indices.delete(index='tokens')
+    except Exception as e:
+        pass
+
+    with Store(store_type='elasticsearch', nodes='127.0.0.1:9200') as s:
+        s._load_plugin(nodes='127.0.0.1:9200')
+        yield s
+
+    try:
+        assert connections.get_connection().indices.delete(index='indicators-*')
+        assert connections.get_connection().indices.delete(index='tokens')
+    except Exception:
+        pass
+
+
+@pytest.fixture
+def token(store):
+    t = store.store.tokens.create({
+        'username': 'test_admin',
+        'groups': ['everyone', 'everyone2'],
+        'read': '1',
+        'write': '1',
+        'admin': '1'
+    })
+
+    assert t
+    yield t
+
+
+def _indicator(**kwargs):
+    i = dict(
+        indicator='example.com',
+        tags='botnet',
+        provider='csirtg.io',
+        group='everyone',
+        lasttime=arrow.utcnow().datetime,
+        reporttime=arrow.utcnow().datetime,
+        confidence=7.0
+    )
+    i.update(kwargs)
+    return Indicator(**i).__dict__()
+
+
+def _search(store, token, indicator='example.com'):
+    x = store.handle_indicators_search(token, {'indicator': indicator, 'nolog': 1})
+    x = json.loads(x)
+    return [i['_source'] for i in x['hits']['hits']]
+
+
+@pytest.mark.skipif(DISABLE_TESTS, reason='need to set CIF_ELASTICSEARCH_TEST=1 and CIF_STORE_ES_UPSERT_ID=1 to run')
+def test_store_elasticsearch_indicators_upsert_id(store, token):
+    i = _indicator()
+
+    assert store.handle_indicators_create(token, dict(i), flush=True) == 1
+
+    # same lasttime is a noop
+    assert store.handle_indicators_create(token, dict(i), flush=True) == 0
+
+    x = _search(store, token)
+    assert len(x) == 1
+    assert x[0]['count'] == 1
+
+    # newer lasttime merges into the same doc
+    newer = _indicator(lasttime=arrow.utcnow().shift(days=+1), reporttime=arrow.utcnow().shift(days=+1),
+                       description='seen again')
+    assert store.handle_indicators_create(token, newer, flush=True) == 1
+
+    x = _search(store, token)
+    assert len(x) == 1
+    assert x[0]['count'] == 2
+    assert x[0]['lasttime'] == newer['lasttime']
+    assert x[0]['description'] == 'seen again'
+
+
+@pytest.mark.skipif(DISABLE_TESTS, reason='need to set CIF_ELASTICSEARCH_TEST=1 and CIF_STORE_ES_UPSERT_ID=1 to run')
+def test_store_elasticsearch_indicators_upsert_id_match_fields(store, token):
+    data = [
+        _indicator(),
+        _indicator(tags='botnet,malware'),
+        _indicator(confidence=8.0),
+        _indicator(provider='test-provider'),
+        _indicator(group='everyone2'),
+    ]
+
+    assert store.handle_indicators_create(token, data, flush=True) == 5
+    assert len(_search(store, token)) == 5
@@ -106,3 +106,294 @@ def test_store_indicators_search_reporttime(store, token, indicator):
 
     for indicator in y:
         assert arrow.get(indicator['reporttime']) <= arrow.get(days_ago_str)
+
+
+def test_store_indicators_upsert_batch(store, token, indicator):
+    now = arrow.utcnow()
+
+    data = []
+    for n in range(3):
+        i = copy.deepcopy(indicator)
+        i['lasttime'] = i['reporttime'] = now.shift(minutes=-n).datetime.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        data.append(i)
+
+    # re-submitting the same lasttime within a batch is a no-op
+    data.append(copy.deepcopy(data[0]))
+
+    i = copy.deepcopy(indicator)
+    i['indicator'] = '192.168.1.0/24'
+    i['itype'] = 'ipv4'
+    data.append(i)
+
+    x = store.handle_indicators_create(token, data, flush=True)
+    assert x == 4
+
+    x = store.handle_indicators_search(token, {'indicator': 'example.com', 'nolog': 1})
+    assert len(x) == 1
+    assert x[0]['count'] == 3
+    assert x[0]['tags'] == ['botnet']
+
+    # older than what we have, skipped
+    x = store.handle_indicators_create(token, [data[2], data[4]], flush=True)
+    assert x == 0
+
+    i = copy.deepcopy(indicator)
+    i['lasttime'] = i['reporttime'] = now.shift(minutes=1).datetime.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    x = store.handle_indicators_create(token, [i, data[4]], flush=True)
+    assert x == 1
+
+    x = store.handle_indicators_search(token, {'indicator': 'example.com', 'nolog': 1})
+    assert x[0]['count'] == 4
+
+    # matched on the first tag, picking up another one later is still the same indicator
+    i = copy.deepcopy(indicator)
+    i['tags'] = ['botnet', 'malware']
+    i['lasttime'] = i['reporttime'] = now.shift(minutes=2).datetime.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    x = store.handle_indicators_create(token, i, flush=True)
+    assert x == 1
+
+    x = store.handle_indicators_search(token, {'indicator': 'example.com', 'nolog': 1})
+    assert len(x) == 1
+    assert x[0]['count'] == 5
+
+    x = store.handle_indicators_search(token, {'indicator': '192.168.1.0/24', 'nolog': 1})
+    assert len(x) == 1
+
+
+def test_store_indicators_search_relatives(store, token, indicator):
+    data = []
+    for i, itype in [('192.168.0.0/16', 'ipv4'), ('192.168.1.0/24', 'ipv4'), ('192.168.1.1', 'ipv4'),
+                     ('192.168.2.1', 'ipv4'), ('10.0.0.1', 'ipv4'), ('2001:4860::/32', 'ipv6'),
+                     ('2001:4860:4860::8888', 'ipv6')]:
+        ii = copy.deepcopy(indicator)
+        ii['indicator'] = i
+        ii['itype'] = itype
+        data.append(ii)
+
+    x = store.handle_indicators_create(token, data, flush=True)
+    assert x == 7
+
+    def _search(i, find_relatives=False):
+        x = store.handle_indicators_search(token, {'indicator': i, 'find_relatives': find_relatives, 'nolog': 1})
+        return sorted(xx['indicator'] for xx in x)
+
+    assert _search('192.168.1.1') == ['192.168.1.1']
+    assert _search('192.168.1.0/24') == ['192.168.1.0/24', '192.168.1.1']
+    assert _search('192.168.0.0/16') == ['192.168.0.0/16', '192.168.1.0/24', '192.168.1.1', '192.168.2.1']
+
+    assert _search('192.168.1.1', True) == ['192.168.0.0/16', '192.168.1.0/24', '192.168.1.1']
+    assert _search('192.168.1.0/24', True) == ['192.168.0.0/16', '192.168.1.0/24', '192.168.1.1']
+    assert _search('192.168.2.0/24', True) == ['192.168.0.0/16', '192.168.2.1']
+
+    assert _search('2001:4860:4860::8888') == ['2001:4860:4860::8888']
+    assert _search('2001:4860:4860::8888', True) == ['2001:4860:4860::8888', '2001:4860::/32']
+
+
+def test_store_indicators_search_fqdn_subdomains(store, token, indicator):
+    data = []
+    for i in ['example.com', 'www.example.com', 'a.b.example.com', 'badexample.com', 'example.com.evil.net',
+              'example-x.com', 'INVALID.Example.com']:
+        ii = copy.deepcopy(indicator)
+        ii['indicator'] = i
+        data.append(ii)
+
+    # the invalid one is skipped, the rest of the batch still goes in
+    x = store.handle_indicators_create(token, data, flush=True)
+    assert x == 6
+
+    x = store.handle_indicators_search(token, {'indicator': 'example.com', 'nolog': 1})
+    assert sorted(xx['indicator'] for xx in x) == ['a.b.example.com', 'example.com', 'www.example.com']
+
+    x = store.handle_indicators_search(token, {'indicator': 'www.example.com', 'nolog': 1})
+    assert [xx['indicator'] for xx in x] == ['www.example.com']
+
+
+def test_store_indicators_search_readers(store, token, indicator):
+    assert store.store.engine.execute('PRAGMA journal_mode').scalar() == 'wal'
+
+    # searches come off the read-only pool and still see what the writer just committed
+    assert store.store.read_handle is not store.store.handle
+    assert store.store.read_handle().execute('PRAGMA query_only').scalar() == 1
+    store.store.read_handle.remove()
+
+    x = store.handle_indicators_create(token, [indicator, dict(indicator, indicator='example.org')], flush=True)
+    assert x == 2
+
+    x = store.handle_indicators_search(token, {'indicator': 'example.org', 'nolog': 1})
+    assert [xx['indicator'] for xx in x] == ['example.org']
+
+
+def test_store_indicators_search_rows(store, token, indicator):
+    indicator['tags'] = ['malware', 'botnet']
+    indicator['message'] = 'aGVsbG8gd29ybGQ='
+    indicator['reporttime'] = indicator['lasttime'] = '2017-01-01T01:02:03.456789Z'
+    assert store.handle_indicators_create(token, [indicator, dict(indicator, indicator='example.org')], flush=True) == 2
+
+    x = store.handle_indicators_search(token, {'indicator': indicator['indicator'], 'nolog': 1})
+    assert len(x) == 1
+
+    x = x[0]
+    assert 'upsert_key' not in x
+    assert x['indicator'] == indicator['indicator']
+    assert x['tags'] == ['malware', 'botnet']
+    assert x['message'] == [b'aGVsbG8gd29ybGQ=']
+    assert x['reporttime'] == x['lasttime'] == '2017-01-01T01:02:03.456789Z'
+    assert x['count'] == 1
+
+
+def test_store_indicators_search_text(store, token, indicator):
+    assert store.store.indicators.fts
+
+    data = [
+        dict(indicator, indicator='example.com', description='known phishing kit', message='c2VlbiBpbiBzcGFtIHJ1bg=='),
+        dict(indicator, indicator='example.org', description='benign'),
+        dict(indicator, indicator='192.168.1.1', itype='ipv4', asn_desc='EXAMPLE-AS Example Networks'),
+    ]
+    assert store.handle_indicators_create(token, data, flush=True) == 3
+
+    def _search(f):
+        f['nolog'] = 1
+        return sorted(x['indicator'] for x in store.handle_indicators_search(token, f))
+
+    assert _search({'indicator': 'phishing'}) == ['example.com']
+    assert _search({'indicator': 'spam run'}) == ['example.com']  # from the message
+    assert _search({'indicator': 'phish*'}) == ['example.com']
+    assert _search({'indicator': 'networks'}) == ['192.168.1.1']
+    assert _search({'indicator': 'nothing here'}) == []
+    assert _search({'indicator': 'bad "quoting AND'}) == []
+
+    assert _search({'asn_desc': 'example'}) == ['192.168.1.1']
+    assert _search({'asn_desc': 'phishing'}) == []
+
+    assert store.handle_indicators_delete(token, data=[{'indicator': 'example.com'}]) == 1
+    assert _search({'indicator': 'phishing'}) == []
+
+
+def test_store_indicators_search_stream(store, token, indicator, monkeypatch):
+    import zmq
+    import ujson as json
+    from concurrent.futures import ThreadPoolExecutor
+    from cifsdk.msg import Msg
+    import cif.store
+
+    data = [dict(indicator, indicator='example{}.com'.format(n)) for n in range(5)]
+    assert store.handle_indicators_create(token, data, flush=True) == 5
+
+    monkeypatch.setattr(cif.store, 'SEARCH_PAGE_SIZE', 2)
+
+    ctx = zmq.Context.instance()
+    store.router, client = ctx.socket(zmq.PAIR), ctx.socket(zmq.PAIR)
+    store.router.bind('inproc://store-stream')
+    client.connect('inproc://store-stream')
+
+    def _pages():
+        pages = []
+        while client.poll(1000):
+            _, _, _, _, data = Msg().recv(client)
+            pages.append(json.loads(data))
+            if not pages[-1].get('more'):
+                break
+        return pages
+
+    m = (b'id', b'client', json.dumps(token), 'indicators_search', json.dumps({'itype': 'fqdn', 'nolog': 1,
+                                                                                'stream': 1}))
+
+    # inline
+    store.handle_message(m)
+    pages = _pages()
+    assert [len(p['data']) for p in pages] == [2, 2, 1, 0]
+    assert [p['more'] for p in pages] == [True, True, True, False]
+    assert sorted(i['indicator'] for p in pages for i in p['data']) == sorted(i['indicator'] for i in data)
+
+    # off a search worker, sent from the main loop
+    store.search_pool = ThreadPoolExecutor(max_workers=1)
+    store.handle_message(m)
+    store.search_pool.shutdown(wait=True)
+    store._reply_searches()
+    assert not store.searches
+    assert [len(p['data']) for p in _pages()] == [2, 2, 1, 0]
+
+    # a failed search ends the stream with the failure
+    store.search_pool = None
+    store.handle_message(m[:4] + (json.dumps({'indicator': '', 'asn_desc': '*', 'stream': 1}),))
+    pages = _pages()
+    assert len(pages) == 1
+    assert pages[0]['status'] == 'failed'
+
+    store.router.close()
+    client.close()
+
+
+def test_store_indicators_search_dedup(store, token, indicator):
+    data = []
+    for n, i in enumerate(['example.com', 'example.org', 'example.net']):
+        for c in [5, 9, 7]:
+            data.append(dict(indicator, indicator=i, confidence=c, provider='p{}.example'.format(c),
+                             lasttime='2017-01-0{}T00:00:00Z'.format(n + 1)))
+
+    assert store.handle_indicators_create(token, data, flush=True) == 9
+
+    def _search(f):
+        f.update({'itype': 'fqdn', 'nolog': 1})
+        return [(x['indicator'], x['confidence']) for x in store.handle_indicators_search(token, f)]
+
+    assert len(_search({})) == 9
+
+    # best row per indicator by the search's own sort, limit counts indicators
+    assert sorted(_search({'dedup': 1, 'sort': '-confidence'})) == [
+        ('example.com', 9.0), ('example.net', 9.0), ('example.org', 9.0)]
+    assert len(_search({'dedup': 1, 'sort': '-confidence', 'limit': 2})) == 2
+    assert sorted(_search({'dedup': 1, 'sort': 'confidence'})) == [
+        ('example.com', 5.0), ('example.net', 5.0), ('example.org', 5.0)]
+
+    assert len(_search({'dedup': 1, 'tags': 'botnet'})) == 3
+
+
+def test_store_indicators_search_batch(store, token, indicator):
+    from csirtg_indicator import resolve_itype
+
+    data = []
+    for i in ['example.com', 'www.example.com', 'example.org', '192.168.1.1', '192.168.2.0/24', '10.0.0.1',
+              'http://example.net/a', 'user@example.com', 'd41d8cd98f00b204e9800998ecf8427e']:
+        data.append(dict(indicator, indicator=i, itype=resolve_itype(i)))
+
+    assert store.handle_indicators_create(token, data, flush=True) == len(data)
+
+    lookups = ['example.com', 'example.org', 'example.io', '192.168.0.0/16', '10.0.0.1', 'http://example.net/a',
+               'user@example.com', 'd41d8cd98f00b204e9800998ecf8427e', 'not an indicator']
+
+    rv = store.handle_indicators_search(token, {'indicators': lookups, 'nolog': 1})
+
+    assert list(rv) == lookups
+    assert sorted(x['indicator'] for x in rv['example.com']) == ['example.com', 'www.example.com']
+    assert [x['indicator'] for x in rv['example.org']] == ['example.org']
+    assert rv['example.io'] == []
+    assert sorted(x['indicator'] for x in rv['192.168.0.0/16']) == ['192.168.1.1', '192.168.2.0/24']
+    for i in lookups[4:8]:
+        assert [x['indicator'] for x in rv[i]] == [i]
+    assert rv['not an indicator'] == []
+
+    # filters and the per indicator limit apply to every lookup
+    rv = store.handle_indicators_search(token, {'indicators': lookups, 'nolog': 1, 'limit': 1})
+    assert len(rv['example.com']) == 1
+    assert store.handle_indicators_search(token, {'indicators': lookups, 'nolog': 1, 'tags': 'malware'}) == \
+        {i: [] for i in lookups}
+
+    # logged as searches, in one go
+    store.handle_indicators_search(token, {'indicators': ['example.com', 'example.io']})
+    rv = store.handle_indicators_search(token, {'indicator': 'example.io', 'nolog': 1, 'tags': 'search'})
+    assert [x['indicator'] for x in rv] == ['example.io']
+
+
+def test_store_indicators_search_batch_limit(store, token, indicator):
+    # a domain with more (and newer) subdomains than the limit doesn't crowd out the rest of the batch
+    now = arrow.utcnow()
+    data = [dict(indicator, indicator='example.org', reporttime=now.shift(days=-1).strftime('%Y-%m-%dT%H:%M:%SZ'))]
+    for n in range(10):
+        data.append(dict(indicator, indicator='{}.example.com'.format(n), reporttime=now.strftime('%Y-%m-%dT%H:%M:%SZ')))
+
+    assert store.handle_indicators_create(token, data, flush=True) == len(data)
+
+    rv = store.handle_indicators_search(token, {'indicators': ['example.com', 'example.org'], 'nolog': 1, 'limit': 2})
+    assert len(rv['example.com']) == 2
+    assert [x['indicator'] for x in rv['example.org']] == ['example.org']